@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+import os
+import io
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import contextlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from lxml import etree
+from lxml.cssselect import CSSSelector
+from lxml.html import builder as html_builder
+
+import transport
+from rate_limit import RetryPolicy
+from chapter_cleaner import ChapterCleaner
+from mock_servers import TranslatorStub, NovelFullStub, CdReaderStub
+from novelfull_reader import NovelFullReader
+from moboreader import MoboReader
+from pdf_converter import PdfConverter, WKHTMLTOPDF, make_converter
+from instrumentation import metrics
+from translator import MicrosoftTranslator
+from translation_memory import TranslationMemory
+
+"""
+Benchmarks against the local stand-ins of mock_servers, no network needed.
+$ python3 bench.py translate --paragraphs 500 --latency 0.02 --workers 8
+$ python3 bench.py clean --chapters 300 --paragraphs 80
+$ python3 bench.py render --chapters 100 --workers 2 --batch-size 50
+$ python3 bench.py suite --chapters 200 --latency 0.01 --error-rate 0.01 --workers 8 --output run.json --baseline old.json
+"""
+
+
+def _paragraphs(count):
+    return ['Paragraph %d: the young master raised his sword and the whole sect fell silent.' % i for i in range(count)]
+
+
+def bench_translate(paragraphs=500, latency=0.02, workers=8):
+    """
+    Per-paragraph requests (the old translate_py_chapter) against batched and concurrent batched requests,
+    then the same texts twice through a translation memory.
+    """
+    texts = _paragraphs(paragraphs)
+    results = {}
+    stub = TranslatorStub(latency=latency)
+    url = stub.start()
+    try:
+        translator = MicrosoftTranslator(url=url, http_pool=transport.HttpPool())
+        runs = [('per_paragraph', lambda: [translator.translate_raw([t]) for t in texts]),
+                ('batched', lambda: translator.translate_texts(texts))]
+        executor = ThreadPoolExecutor(max_workers=workers)
+        runs.append(('batched_concurrent', lambda: translator.translate_texts(texts, executor)))
+        memory_dir = tempfile.mkdtemp()
+        cached_translator = MicrosoftTranslator(url=url, http_pool=transport.HttpPool(),
+                                                memory=TranslationMemory(os.path.join(memory_dir, 'memory.sqlite')))
+        runs.append(('memory_cold', lambda: cached_translator.translate_texts(texts, executor)))
+        runs.append(('memory_warm', lambda: cached_translator.translate_texts(texts, executor)))
+        for name, run in runs:
+            requests_before = stub.requests
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            results[name] = {'seconds': round(elapsed, 4), 'requests': stub.requests - requests_before,
+                             'paragraphs_per_s': round(paragraphs / elapsed, 1)}
+        executor.shutdown()
+    finally:
+        stub.stop()
+    return results
+
+
+def _chapter_page(paragraphs):
+    """A novelfull like chapter page: site chrome, scripts and ad blocks around and inside #chapter-content."""
+    body = []
+    for i in range(paragraphs):
+        body.append('<p>Paragraph %d: the young master raised his sword and the whole sect fell silent.</p>' % i)
+        if i % 10 == 5:
+            body.append('<script>window.ads = window.ads || [];</script><ins class="adsbygoogle"></ins>'
+                        '<div class="ads ads-holder"><div class="google-auto-placed"><iframe></iframe></div></div>')
+    chrome = ''.join('<li><a href="/genre/%d">Genre %d</a></li>' % (i, i) for i in range(60))
+    return ('<html><head><title>x</title><script src="app.js"></script></head><body><ul class="nav">%s</ul>'
+            '<div id="chapter-content">%s</div><script>track();</script></body></html>' % (chrome, ''.join(body))).encode()
+
+
+def _legacy_clean(raw_material, file_name, chapter_url=''):
+    # the cleaning of _process_raw before ChapterCleaner: selectors compiled per chapter, three removal walks
+    chapter_content = CSSSelector('#chapter-content')(raw_material)[0]
+    for script in list(chapter_content.iter('script')):
+        script.getparent().remove(script)
+    for google_content in CSSSelector('.google-auto-placed, .ads, .ads-holder')(chapter_content):
+        if google_content.getparent() is not None:
+            google_content.getparent().remove(google_content)
+    for ins in list(chapter_content.iter('ins')):
+        ins.getparent().remove(ins)
+    gen_html = html_builder.HTML(
+        html_builder.HEAD(html_builder.TITLE(file_name), html_builder.STYLE('')),
+        html_builder.BODY(chapter_content, html_builder.DIV(html_builder.CLASS("end"), html_builder.P('The End...'),
+                                                            html_builder.A(chapter_url, href=chapter_url))))
+    return etree.tostring(gen_html, pretty_print=True, method="html")
+
+
+def bench_clean(chapters=300, paragraphs=80):
+    """Per-chapter cleaning time of the old _process_raw cleaning against a compiled ChapterCleaner."""
+    page = _chapter_page(paragraphs)
+    cleaner = ChapterCleaner.for_site('novelfull')
+    results = {}
+    runs = [('parse_only', lambda raw_material: None),
+            ('legacy', lambda raw_material: _legacy_clean(raw_material, 'Chapter_00001 x')),
+            ('chapter_cleaner', lambda raw_material: cleaner.clean(raw_material, 'Chapter_00001 x'))]
+    for name, run in runs:
+        started = time.perf_counter()
+        for _ in range(chapters):
+            run(etree.HTML(page))
+        elapsed = time.perf_counter() - started
+        results[name] = {'seconds': round(elapsed, 4), 'ms_per_chapter': round(elapsed / chapters * 1000, 3)}
+    return results
+
+
+def bench_render(chapters=100, paragraphs=40, workers=2, batch_size=50, command=WKHTMLTOPDF):
+    """Per-chapter pdf conversion time of one wkhtmltopdf process per chapter against warm batched processes."""
+    if not shutil.which(command):
+        return {'skipped': {'reason': '%s not found' % command}}
+    cleaner = ChapterCleaner.for_site('novelfull')
+    work_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        jobs = []
+        for no in range(1, chapters + 1):
+            source = os.path.join(work_dir, 'Chapter_%05d x.html' % no)
+            with open(source, 'wb') as f2:
+                f2.write(cleaner.clean(etree.HTML(_chapter_page(paragraphs)), 'Chapter_%05d x' % no))
+            jobs.append((source, source.replace('.html', '.pdf')))
+        for renderer in ('process', 'batch'):
+            converter = make_converter(renderer, workers=workers, force=True, batch_size=batch_size)
+            converter.command = command
+            metrics.reset()
+            started = time.perf_counter()
+            summary = converter.convert(jobs)
+            elapsed = time.perf_counter() - started
+            timings = metrics.snapshot()['stages'].get('convert', {'count': 0, 'seconds': 0.0, 'p50': 0.0, 'p99': 0.0})
+            results[renderer] = {'seconds': round(elapsed, 3), 'chapters_per_s': round(chapters / elapsed, 2),
+                                 'ms_per_chapter': round(timings['seconds'] / timings['count'] * 1000, 2)
+                                 if timings['count'] else None,
+                                 'p50_ms': round(timings['p50'] * 1000, 2), 'p99_ms': round(timings['p99'] * 1000, 2),
+                                 'failed': len(summary['failed'])}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def _timed(samples, function):
+    """function, appending the duration of every call to samples."""
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - started)
+    return wrapper
+
+
+def _percentile(samples, percent):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(percent / 100.0 * (len(ordered) - 1))))]
+
+
+def _dir_bytes(path):
+    total = 0
+    for dir_path, _, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(dir_path, file))
+            except OSError:
+                pass
+    return total
+
+
+def _peak_rss_kb():
+    # ru_maxrss is in kilobytes on linux, the children are the process pool and wkhtmltopdf
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def _stage(run, samples, out_dir, count=None):
+    """
+    Run one pipeline stage: its throughput, per-item p50/p99, peak rss and the bytes it added under out_dir.
+    The items are the timed calls in samples unless count() says otherwise.
+    """
+    bytes_before = _dir_bytes(out_dir)
+    started = time.perf_counter()
+    # the readers print progress per file and per word, that would be measured too
+    with contextlib.redirect_stdout(io.StringIO()):
+        run()
+    elapsed = time.perf_counter() - started
+    p50, p99 = _percentile(samples, 50), _percentile(samples, 99)
+    items = count() if count else len(samples)
+    return {'items': items, 'seconds': round(elapsed, 4),
+            'items_per_s': round(items / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(p50 * 1000, 3) if p50 is not None else None,
+            'p99_ms': round(p99 * 1000, 3) if p99 is not None else None,
+            'peak_rss_kb': _peak_rss_kb(), 'bytes_written': _dir_bytes(out_dir) - bytes_before}
+
+
+def bench_suite(chapters=200, paragraphs=40, latency=0.01, error_rate=0.0, workers=8, translate_chapters=10):
+    """
+    The pipelines end to end against the local stand-ins: novelfull crawl, _process_raw, clean_raw,
+    pdf conversion (when wkhtmltopdf is installed), epub bundling, translate_by_word and the MoboReader crawl.
+    """
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='bench_')
+    site = NovelFullStub(chapters=chapters, paragraphs=paragraphs, latency=latency, error_rate=error_rate)
+    api = CdReaderStub(chapters=chapters, paragraphs=paragraphs, latency=latency, error_rate=error_rate)
+    translator_stub = TranslatorStub(latency=latency, error_rate=error_rate)
+    try:
+        site_url, api_url, translator_url = site.start(), api.start(), translator_stub.start()
+        # no rate limiter, the suite measures the code rather than the politeness towards the site
+        http_pool = transport.HttpPool(retry=RetryPolicy())
+        translator = MicrosoftTranslator(url=translator_url, http_pool=http_pool)
+        novel_dest = os.path.join(work_dir, 'novelfull')
+        reader = NovelFullReader(file_dest=novel_dest, workers=workers, http_pool=http_pool, translator=translator,
+                                 raw_archive=True)
+        reader.URL = site_url
+
+        samples = []
+        reader._read_chapter = _timed(samples, reader._read_chapter)
+        last_page = -(-chapters // NovelFullStub.CHAPTERS_PER_PAGE)
+        results['fetch'] = _stage(lambda: reader.read_by_page(1, last_page), samples, novel_dest)
+        results['fetch']['requests'] = site.requests
+        results['fetch']['bytes_received'] = site.bytes_sent
+
+        samples = []
+        entries = reader.raw_archive.entries('chapter:')
+        process_raw = _timed(samples, reader._process_raw)
+        results['process_raw'] = _stage(
+            lambda: [process_raw(etree.HTML(reader.raw_archive.read(location)), meta['chapter_no'],
+                                 meta['file_name'], meta['url']) for _, meta, location in entries],
+            samples, novel_dest)
+
+        clean_stats = []
+        results['clean_raw'] = _stage(lambda: clean_stats.extend(reader.clean_raw(workers=workers)), [], novel_dest,
+                                      count=lambda: sum(stats['files'] for stats in clean_stats))
+
+        pdf_dest = os.path.join(work_dir, 'pdf')
+        if shutil.which('wkhtmltopdf'):
+            samples = []
+            convert_one = PdfConverter._convert_one
+            PdfConverter._convert_one = _timed(samples, convert_one)
+            try:
+                results['convert_to_pdf'] = _stage(lambda: reader.convert_to_pdf(pdf_dest, workers=workers),
+                                                   samples, pdf_dest)
+            finally:
+                PdfConverter._convert_one = convert_one
+        else:
+            results['convert_to_pdf'] = {'skipped': 'wkhtmltopdf not found'}
+
+        samples = []
+        epub_dest = os.path.join(work_dir, 'epub')
+        bundle = _timed(samples, reader.convert_bundle)
+        results['bundle_epub'] = _stage(lambda: bundle(epub_dest, 1, chapters, fmt='epub', workers=workers),
+                                        samples, epub_dest, count=lambda: chapters)
+
+        samples = []
+        reader.translator.lookup_raw = _timed(samples, reader.translator.lookup_raw)
+        results['translate_by_word'] = _stage(lambda: reader.translate_by_word(1, translate_chapters, workers),
+                                              samples, os.path.join(novel_dest, 'translation'))
+        results['translate_by_word']['chapters'] = translate_chapters
+
+        samples = []
+        mobo_dest = os.path.join(work_dir, 'moboreader')
+        mobo_reader = MoboReader(file_dest=mobo_dest, http_pool=http_pool)
+        mobo_reader.URL = api_url
+        for i in range(workers):
+            mobo_reader.set_account('bench%d@example.com' % i, 'password')
+        mobo_reader.acc_list = mobo_reader._read_acc()
+        mobo_reader._fetch_chapter = _timed(samples, mobo_reader._fetch_chapter)
+        results['mobo_fetch'] = _stage(lambda: mobo_reader.read_by_chapter(1, chapters, accounts=workers), samples,
+                                       mobo_dest)
+    finally:
+        site.stop()
+        api.stop()
+        translator_stub.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def _compare(results, baseline):
+    """Throughput of every stage relative to a saved run, > 1.0 is faster."""
+    ratios = {}
+    for stage, values in results.items():
+        old = baseline.get('stages', {}).get(stage, {})
+        if values.get('items_per_s') and old.get('items_per_s'):
+            ratios[stage] = {'speedup': round(values['items_per_s'] / old['items_per_s'], 3),
+                             'p99_ratio': round(values['p99_ms'] / old['p99_ms'], 3)
+                             if values.get('p99_ms') and old.get('p99_ms') else None}
+    return ratios
+
+
+def _print_results(name, results):
+    print(name)
+    for run_name, values in results.items():
+        print('  %-20s %s' % (run_name, ', '.join('%s=%s' % kv for kv in values.items())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='simple_utils benchmarks against local mock servers')
+    sub_parsers = parser.add_subparsers(dest='bench', required=True)
+    translate_parser = sub_parsers.add_parser('translate')
+    translate_parser.add_argument('--paragraphs', type=int, default=500)
+    translate_parser.add_argument('--latency', type=float, default=0.02)
+    translate_parser.add_argument('--workers', type=int, default=8)
+    clean_parser = sub_parsers.add_parser('clean')
+    clean_parser.add_argument('--chapters', type=int, default=300)
+    clean_parser.add_argument('--paragraphs', type=int, default=80)
+    render_parser = sub_parsers.add_parser('render')
+    render_parser.add_argument('--chapters', type=int, default=100)
+    render_parser.add_argument('--paragraphs', type=int, default=40)
+    render_parser.add_argument('--workers', type=int, default=2)
+    render_parser.add_argument('--batch-size', type=int, default=50)
+    render_parser.add_argument('--command', default=WKHTMLTOPDF)
+    suite_parser = sub_parsers.add_parser('suite')
+    suite_parser.add_argument('--chapters', type=int, default=200)
+    suite_parser.add_argument('--paragraphs', type=int, default=40)
+    suite_parser.add_argument('--latency', type=float, default=0.01)
+    suite_parser.add_argument('--error-rate', type=float, default=0.0)
+    suite_parser.add_argument('--workers', type=int, default=8)
+    suite_parser.add_argument('--translate-chapters', type=int, default=10)
+    suite_parser.add_argument('--output', help='save the results to this json file')
+    suite_parser.add_argument('--baseline', help='a json file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    if args.bench == 'translate':
+        _print_results('translate', bench_translate(args.paragraphs, args.latency, args.workers))
+    elif args.bench == 'clean':
+        _print_results('clean', bench_clean(args.chapters, args.paragraphs))
+    elif args.bench == 'render':
+        _print_results('render', bench_render(args.chapters, args.paragraphs, args.workers, args.batch_size,
+                                              args.command))
+    elif args.bench == 'suite':
+        stages = bench_suite(args.chapters, args.paragraphs, args.latency, args.error_rate, args.workers,
+                             args.translate_chapters)
+        _print_results('suite', stages)
+        run_record = {'at': f'{datetime.now()}', 'params': vars(args), 'stages': stages}
+        if args.baseline:
+            with open(args.baseline, 'rt') as f1:
+                run_record['compared_to'] = _compare(stages, json.loads(f1.read()))
+            _print_results('compared to %s' % args.baseline, run_record['compared_to'])
+        if args.output:
+            with open(args.output, 'wt') as f2:
+                f2.write(json.dumps(run_record, indent=2))
@@ -0,0 +1,212 @@
+import os
+import uuid
+import shutil
+import zipfile
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+from lxml import etree, html
+
+from pdf_converter import PdfConverter
+from instrumentation import metrics
+
+"""
+Bundles many chapter files into one document: a single HTML (rendered once by wkhtmltopdf) or an EPUB.
+>>> import bundler
+>>> chapters = [(1, '.../00000/Chapter_00001 x.html', 'Chapter_00001 x'), ...]
+>>> bundler.write_epub(chapters, 'martial-peak 00000-00099', 'martial-peak 00000-00099.epub')
+"""
+
+BUNDLE_STYLE = """
+    .chapter {
+        page-break-before: always;
+    }
+    .toc a {
+        text-decoration: none;
+    }
+    """
+XHTML_NS = 'http://www.w3.org/1999/xhtml'
+
+
+def group_chapters(chapters, bundle_size=100, ranges=None):
+    """
+    Split sorted (chapter_no, path, title) tuples into {(first, last): [chapters]}.
+    By default one bundle per `bundle_size` bucket, the same buckets as the chapter directories,
+    or one bundle per (first, last) of the given ranges.
+    """
+    bundles = {}
+    for chapter in chapters:
+        chapter_no = chapter[0]
+        if ranges:
+            bundle_range = next((r for r in ranges if r[0] <= chapter_no <= r[1]), None)
+            if not bundle_range: continue
+        else:
+            first = (chapter_no // bundle_size) * bundle_size
+            bundle_range = (first, first + bundle_size - 1)
+        bundles.setdefault(bundle_range, []).append(chapter)
+    return bundles
+
+
+def is_up_to_date(chapters, dest_file):
+    if not os.path.exists(dest_file):
+        return False
+    dest_mtime = os.path.getmtime(dest_file)
+    return all(os.path.getmtime(path) <= dest_mtime for _, path, _ in chapters)
+
+
+def _chapter_body(path):
+    """The body children of one chapter file, without the trailing 'The End...' block."""
+    with open(path, 'rb') as f1:
+        content = html.fromstring(f1.read())
+    body = content.find('body')
+    if body is None:
+        body = content
+    return [e for e in body if not (e.tag == 'div' and 'end' in (e.get('class') or '').split())]
+
+
+@contextmanager
+def _replacing(dest_file):
+    """
+    A temporary path next to dest_file that replaces it once written, a bundle that fails halfway
+    leaves no partial file (it would look newer than its chapters and never be written again).
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_file) or '.', prefix='.tmp_', suffix='.part')
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, dest_file)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_html(chapters, title, dest_file, style=''):
+    """Stream the chapters into one HTML file with a table of contents, one chapter parsed at a time."""
+    with _replacing(dest_file) as tmp_path, open(tmp_path, 'wb') as f1:
+        f1.write(b'<!DOCTYPE html>\n<html><head><meta charset="utf-8">')
+        f1.write(('<title>%s</title><style>%s%s</style></head><body>\n' % (escape(title), style, BUNDLE_STYLE)).encode('utf-8'))
+        f1.write(('<h1>%s</h1>\n<ul class="toc">\n' % escape(title)).encode('utf-8'))
+        for chapter_no, _, chapter_title in chapters:
+            f1.write(('<li><a href="#chapter-%d">%s</a></li>\n' % (chapter_no, escape(chapter_title))).encode('utf-8'))
+        f1.write(b'</ul>\n')
+        for chapter_no, path, chapter_title in chapters:
+            f1.write(('<div class="chapter" id="chapter-%d"><h2>%s</h2>\n' % (chapter_no, escape(chapter_title))).encode('utf-8'))
+            for element in _chapter_body(path):
+                f1.write(html.tostring(element, method='html', encoding='utf-8'))
+            f1.write(b'</div>\n')
+        f1.write(b'</body></html>\n')
+    return dest_file
+
+
+def _xhtml_chapter(chapter_no, path, chapter_title, style):
+    root = etree.Element('{%s}html' % XHTML_NS, nsmap={None: XHTML_NS})
+    head = etree.SubElement(root, '{%s}head' % XHTML_NS)
+    etree.SubElement(head, '{%s}title' % XHTML_NS).text = chapter_title
+    etree.SubElement(head, '{%s}style' % XHTML_NS).text = style
+    body = etree.SubElement(root, '{%s}body' % XHTML_NS)
+    etree.SubElement(body, '{%s}h2' % XHTML_NS, id='chapter-%d' % chapter_no).text = chapter_title
+    for element in _chapter_body(path):
+        # lxml.html elements carry no namespace, move every tag into the xhtml one
+        for e in element.iter():
+            if isinstance(e.tag, str):
+                e.tag = '{%s}%s' % (XHTML_NS, e.tag)
+        body.append(element)
+    return etree.tostring(root, xml_declaration=True, encoding='utf-8', doctype='<!DOCTYPE html>')
+
+
+def write_epub(chapters, title, dest_file, style=''):
+    """Write the chapters as an EPUB 3 (with an EPUB 2 toc.ncx for older readers), one chapter parsed at a time."""
+    book_id = 'urn:uuid:%s' % uuid.uuid5(uuid.NAMESPACE_URL, title)
+    items = [('chapter_%05d.xhtml' % chapter_no, chapter_no, chapter_title) for chapter_no, _, chapter_title in chapters]
+    with _replacing(dest_file) as tmp_path, zipfile.ZipFile(tmp_path, 'w') as epub:
+        # the mimetype must be the first entry and must not be compressed
+        epub.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        epub.writestr('META-INF/container.xml',
+                      '<?xml version="1.0" encoding="utf-8"?>\n'
+                      '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                      '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                      '</rootfiles></container>', compress_type=zipfile.ZIP_DEFLATED)
+        for (chapter_no, path, chapter_title), (item_name, _, _) in zip(chapters, items):
+            epub.writestr('OEBPS/%s' % item_name, _xhtml_chapter(chapter_no, path, chapter_title, style),
+                          compress_type=zipfile.ZIP_DEFLATED)
+
+        nav_points = ''.join('<li><a href="%s">%s</a></li>' % (item_name, escape(chapter_title))
+                             for item_name, _, chapter_title in items)
+        epub.writestr('OEBPS/nav.xhtml',
+                      '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+                      '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+                      '<head><title>%s</title></head><body><nav epub:type="toc"><h1>%s</h1><ol>%s</ol></nav></body></html>'
+                      % (escape(title), escape(title), nav_points), compress_type=zipfile.ZIP_DEFLATED)
+        ncx_points = ''.join('<navPoint id="nav-%d" playOrder="%d"><navLabel><text>%s</text></navLabel>'
+                             '<content src="%s"/></navPoint>' % (chapter_no, order, escape(chapter_title), item_name)
+                             for order, (item_name, chapter_no, chapter_title) in enumerate(items, 1))
+        epub.writestr('OEBPS/toc.ncx',
+                      '<?xml version="1.0" encoding="utf-8"?>\n'
+                      '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+                      '<head><meta name="dtb:uid" content="%s"/></head><docTitle><text>%s</text></docTitle>'
+                      '<navMap>%s</navMap></ncx>' % (book_id, escape(title), ncx_points), compress_type=zipfile.ZIP_DEFLATED)
+
+        manifest = ''.join('<item id="c%d" href="%s" media-type="application/xhtml+xml"/>' % (chapter_no, item_name)
+                           for item_name, chapter_no, _ in items)
+        spine = ''.join('<itemref idref="c%d"/>' % chapter_no for _, chapter_no, _ in items)
+        epub.writestr('OEBPS/content.opf',
+                      '<?xml version="1.0" encoding="utf-8"?>\n'
+                      '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">'
+                      '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                      '<dc:identifier id="book-id">%s</dc:identifier><dc:title>%s</dc:title><dc:language>en</dc:language>'
+                      '<meta property="dcterms:modified">%s</meta></metadata>'
+                      '<manifest><item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+                      '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>%s</manifest>'
+                      '<spine toc="ncx">%s</spine></package>'
+                      % (book_id, escape(title), datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), manifest, spine),
+                      compress_type=zipfile.ZIP_DEFLATED)
+    return dest_file
+
+
+def bundle(chapters, dest_dir, name, fmt='pdf', bundle_size=100, ranges=None, style='', workers=1, timeout=None,
+           force=False):
+    """
+    Write one document per bundle into dest_dir, named '<name> <first>-<last>.<fmt>' after the first and last
+    chapter it holds, so a bundle of part of a bucket does not overwrite the bundle of the whole bucket.
+    fmt is 'html', 'epub' or 'pdf', pdf renders the bundled html with a single wkhtmltopdf run per bundle.
+    Returns the same summary as PdfConverter.convert.
+    """
+    if fmt not in ('html', 'epub', 'pdf'):
+        raise Exception('unknown bundle format %s' % fmt)
+    summary = {'converted': 0, 'skipped': 0, 'failed': []}
+    pdf_jobs = []
+    tmp_dir = tempfile.mkdtemp() if fmt == 'pdf' else None
+    try:
+        for _, bundle_chapters in sorted(group_chapters(chapters, bundle_size, ranges).items()):
+            title = '%s %05d-%05d' % (name, bundle_chapters[0][0], bundle_chapters[-1][0])
+            dest_file = os.path.join(dest_dir, '%s.%s' % (title, fmt))
+            if not force and is_up_to_date(bundle_chapters, dest_file):
+                summary['skipped'] += 1
+                continue
+            try:
+                with metrics.timer('bundle'):
+                    if fmt == 'epub':
+                        write_epub(bundle_chapters, title, dest_file, style)
+                        summary['converted'] += 1
+                    elif fmt == 'html':
+                        write_html(bundle_chapters, title, dest_file, style)
+                        summary['converted'] += 1
+                    else:
+                        pdf_jobs.append((write_html(bundle_chapters, title, os.path.join(tmp_dir, '%s.html' % title),
+                                                    style), dest_file))
+            except Exception as e:
+                summary['failed'].append((dest_file, str(e)))
+
+        if pdf_jobs:
+            # the temporary html is always newer than an out of date pdf, so the converter never skips it
+            pdf_summary = PdfConverter(workers=workers, timeout=timeout, force=True).convert(pdf_jobs)
+            summary['converted'] += pdf_summary['converted']
+            dest_files = dict(pdf_jobs)
+            summary['failed'].extend((dest_files[source], error) for source, error in pdf_summary['failed'])
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return summary
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import threading
+from bisect import bisect_left, bisect_right
+
+from crawl_journal import atomic_write
+
+"""
+The chapter files of a novel directory by chapter number, so a chapter range is found without listing every bucket.
+>>> from catalog import ChapterCatalog
+>>> catalog = ChapterCatalog('/path/to/novel_dir', file_kind)  # file_kind('Chapter_00012 x.html') -> (12, 'clean')
+>>> catalog.range(2704, 2800)  # only the buckets 02700 and 02800 are looked at
+[{'chapter_no': 2704, 'bucket': '02700', 'clean': '/path/to/novel_dir/02700/Chapter_02704 x.html', ...}, ...]
+>>> catalog.save()
+"""
+
+BUCKET_SIZE = 100
+# a directory changed this close to its scan may change again within the same mtime tick, it is scanned next time too
+RACY_NS = 2 * 10 ** 9
+
+
+class ChapterCatalog:
+    """
+    Every bucket directory is listed once with os.scandir and remembered with its mtime, a file added, replaced
+    or removed changes that mtime, so later queries only list the buckets that changed and only the buckets
+    of the range. file_kind(file_name) returns (chapter_no, kind) or None for the files to leave out.
+    An entry has a path per kind, and the mtime (ns) and size of its first kind in `kinds`.
+    Stored as catalog.json in the novel directory.
+    """
+
+    def __init__(self, novel_dir, file_kind, kinds=('clean', 'raw', 'translation'), path=None):
+        self.novel_dir = novel_dir
+        self.file_kind = file_kind
+        self.kinds = tuple(kinds)
+        self.path = path or os.path.join(novel_dir, 'catalog.json')
+        self._lock = threading.Lock()
+        self._dir_mtime = None
+        self._buckets = {}
+        self._dirty = False
+        self._stats = {'queries': 0, 'scanned_buckets': 0}
+        if os.path.exists(self.path):
+            with open(self.path, 'rt') as f1:
+                content = json.loads(f1.read() or '{}')
+            if tuple(content.get('kinds', ())) == self.kinds:
+                self._dir_mtime = content.get('dir_mtime')
+                self._buckets = {name: (bucket['mtime'], [list(row) for row in bucket['rows']])
+                                 for name, bucket in content.get('buckets', {}).items()}
+
+    def _refresh_buckets(self):
+        mtime = os.stat(self.novel_dir).st_mtime_ns
+        if mtime == self._dir_mtime:
+            return
+        names = set()
+        with os.scandir(self.novel_dir) as entries:
+            for entry in entries:
+                if entry.name.isdigit() and entry.is_dir():
+                    names.add(entry.name)
+        for name in set(self._buckets) - names:
+            del self._buckets[name]
+        for name in names - set(self._buckets):
+            self._buckets[name] = (None, [])
+        self._dir_mtime = mtime if time.time_ns() - mtime > RACY_NS else None
+        self._dirty = True
+
+    def _refresh_bucket(self, name):
+        bucket_dir = os.path.join(self.novel_dir, name)
+        started = time.time_ns()
+        try:
+            mtime = os.stat(bucket_dir).st_mtime_ns
+        except FileNotFoundError:
+            self._buckets.pop(name, None)
+            return
+        if mtime == self._buckets[name][0]:
+            return
+        chapters = {}
+        with os.scandir(bucket_dir) as entries:
+            for entry in entries:
+                kind = self.file_kind(entry.name)
+                if kind is None or kind[1] not in self.kinds or not entry.is_file():
+                    continue
+                chapter = chapters.setdefault(kind[0], [kind[0]] + [None] * (len(self.kinds) + 2))
+                chapter[1 + self.kinds.index(kind[1])] = entry.name
+                if kind[1] == self.kinds[0]:
+                    stat = entry.stat()
+                    chapter[-2:] = [stat.st_mtime_ns, stat.st_size]
+        rows = sorted(chapters.values(), key=lambda row: row[0])
+        self._buckets[name] = (mtime if started - mtime > RACY_NS else None, rows)
+        self._stats['scanned_buckets'] += 1
+        self._dirty = True
+
+    def _bucket_names(self, first_chapter, last_chapter):
+        return sorted(name for name in self._buckets
+                      if int(name) <= last_chapter and int(name) + BUCKET_SIZE - 1 >= first_chapter)
+
+    def range(self, first_chapter=1, last_chapter=100000, kind=None):
+        """
+        The entries first_chapter <= chapter number <= last_chapter, in order, as dicts
+        {'chapter_no', 'bucket', <kind>: path, ..., 'mtime', 'size'}. With kind, only the entries that have that file.
+        """
+        entries = []
+        with self._lock:
+            self._stats['queries'] += 1
+            self._refresh_buckets()
+            for name in self._bucket_names(first_chapter, last_chapter):
+                self._refresh_bucket(name)
+                if name not in self._buckets:
+                    continue
+                rows = self._buckets[name][1]
+                numbers = [row[0] for row in rows]
+                for row in rows[bisect_left(numbers, first_chapter):bisect_right(numbers, last_chapter)]:
+                    entry = {'chapter_no': row[0], 'bucket': name, 'mtime': row[-2], 'size': row[-1]}
+                    for i, file_kind in enumerate(self.kinds):
+                        entry[file_kind] = row[1 + i] and os.path.join(self.novel_dir, name, row[1 + i])
+                    if kind is None or entry[kind]:
+                        entries.append(entry)
+        return entries
+
+    def get(self, chapter_no):
+        entries = self.range(chapter_no, chapter_no)
+        return entries[0] if entries else None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, buckets=len(self._buckets),
+                        chapters=sum(len(rows) for _, rows in self._buckets.values()))
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            content = {'kinds': self.kinds, 'dir_mtime': self._dir_mtime,
+                       'buckets': {name: {'mtime': mtime, 'rows': rows}
+                                   for name, (mtime, rows) in sorted(self._buckets.items())}}
+            atomic_write(self.path, json.dumps(content, separators=(',', ':')).encode('utf-8'))
+            self._dirty = False
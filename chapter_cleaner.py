@@ -0,0 +1,76 @@
+from lxml import etree
+from lxml.html import builder as html_builder
+
+"""
+The chapter page cleaning shared by the readers: which element holds the chapter, which nodes are dropped
+and the page the clean chapter is written into.
+>>> from lxml import etree
+>>> from chapter_cleaner import ChapterCleaner
+>>> cleaner = ChapterCleaner.for_site('novelfull', style='body {margin: 5rem;}')
+>>> clean_content = cleaner.clean(etree.HTML(raw_bytes), 'Chapter_00012 x', 'https://novelfull.com/x/chapter-12.html')
+"""
+
+
+def has_class(name):
+    """XPath predicate of the css selector .name"""
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name
+
+
+# per-site rules, XPath expressions: 'content' finds the chapter element in the page (None when the chapter
+# arrives as bare html fragments), 'remove' the nodes dropped from inside it
+SITE_RULES = {
+    'novelfull': {
+        'content': "//*[@id='chapter-content']",
+        'remove': ['descendant::script', 'descendant::ins',
+                   'descendant::*[%s]' % ' or '.join(has_class(c) for c in ('google-auto-placed', 'ads', 'ads-holder'))],
+    },
+    'cdreader': {
+        'content': None,
+        'remove': ['descendant::script'],
+    },
+}
+
+
+class ChapterCleaner:
+    """
+    The rules are compiled once, the removal rules into a single XPath union, so a chapter is cleaned
+    in one query and one removal loop whatever the number of rules.
+    """
+
+    def __init__(self, rules, style=''):
+        self.rules = rules
+        self.style = style
+        self._content = etree.XPath(rules['content']) if rules.get('content') else None
+        self._remove = etree.XPath(' | '.join(rules['remove'])) if rules.get('remove') else None
+
+    @classmethod
+    def for_site(cls, site, style=''):
+        return cls(SITE_RULES[site], style)
+
+    def content(self, raw_material):
+        """The chapter element of a parsed page, stripped. IndexError when the page has none."""
+        return self.strip(self._content(raw_material)[0])
+
+    def strip(self, element):
+        if self._remove is not None:
+            # the matches are collected before anything is removed, removing while iterating skips nodes
+            for node in self._remove(element):
+                parent = node.getparent()
+                if parent is not None:
+                    parent.remove(node)
+        return element
+
+    def page(self, title, chapter_content, chapter_url='', headings=()):
+        """The clean chapter page as bytes: headings, the chapter and an end note linking to its source."""
+        gen_html = html_builder.HTML(
+            html_builder.HEAD(html_builder.TITLE(title), html_builder.STYLE(self.style)),
+            html_builder.BODY(*headings, chapter_content,
+                              html_builder.DIV(
+                                  html_builder.CLASS("end"),
+                                  html_builder.P('The End...'),
+                                  html_builder.A(chapter_url, href=chapter_url))
+                              ))
+        return etree.tostring(gen_html, pretty_print=True, method="html")
+
+    def clean(self, raw_material, title, chapter_url=''):
+        return self.page(title, self.content(raw_material), chapter_url)
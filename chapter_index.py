@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+
+"""
+>>> from chapter_index import ChapterIndex
+>>> index = ChapterIndex('/path/to/novel_dir')
+>>> index.record(12, chapter_id=389358, url='...', clean_size=1234, content_hash='...', status='full')
+>>> index.save()
+"""
+
+INDEX_FILE_NAME = 'chapter_index.json'
+FIELDS = ('chapter_no', 'chapter_id', 'url', 'page', 'file', 'raw_size', 'clean_size', 'content_hash',
+          'status', 'fetched_at')
+
+
+def content_hash(content):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+class ChapterIndex:
+    """Per-novel record of every downloaded chapter, kept in <novel_dir>/chapter_index.json"""
+
+    def __init__(self, novel_dir, file_name=INDEX_FILE_NAME):
+        self.novel_dir = novel_dir
+        self.path = os.path.join(novel_dir, file_name)
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.chapters = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'rt') as f1:
+                file_content = f1.read()
+                # json keys are strings, the chapter number is kept as int in memory
+                self.chapters = {int(k): v for k, v in json.loads(file_content).items()} if file_content else {}
+
+    def get(self, chapter_no):
+        return self.chapters.get(chapter_no)
+
+    def record(self, chapter_no, **fields):
+        """Insert or update one chapter, None fields keep the value already recorded."""
+        with self._lock:
+            entry = self.chapters.setdefault(chapter_no, {'chapter_no': chapter_no})
+            for k, v in fields.items():
+                if k not in FIELDS:
+                    raise KeyError('unknown chapter index field %s' % k)
+                if v is not None:
+                    entry[k] = v
+            if 'fetched_at' not in fields:
+                entry['fetched_at'] = f'{datetime.now()}'
+            self._dirty = True
+            return entry
+
+    def record_file(self, chapter_no, file_path, **fields):
+        """Index a chapter file that is already on disk, e.g. downloaded before the index existed."""
+        with open(file_path, 'rb') as f1:
+            file_content = f1.read()
+        return self.record(chapter_no, file=os.path.relpath(file_path, self.novel_dir), clean_size=len(file_content),
+                           content_hash=content_hash(file_content),
+                           fetched_at=f'{datetime.fromtimestamp(os.path.getmtime(file_path))}', **fields)
+
+    def needs_fetch(self, chapter_no, chapter_id=None, url=None):
+        """
+        True when the chapter is new, short, listed under another chapter_id or url than the recorded one,
+        or its file is gone from the bucket directory. Only the ids are compared, not the chapter content.
+        """
+        entry = self.chapters.get(chapter_no)
+        if not entry or entry.get('status') != 'full':
+            return True
+        if chapter_id is not None and entry.get('chapter_id') not in (None, chapter_id):
+            return True
+        if url is not None and entry.get('url') not in (None, url):
+            return True
+        return not (entry.get('file') and os.path.exists(os.path.join(self.novel_dir, entry['file'])))
+
+    def last_chapter_no(self):
+        return max(self.chapters) if self.chapters else 0
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp_path = '%s.tmp' % self.path
+            with open(tmp_path, 'wt') as f1:
+                f1.write(json.dumps({str(k): self.chapters[k] for k in sorted(self.chapters)}))
+            os.replace(tmp_path, self.path)
+            self._dirty = False
@@ -0,0 +1,110 @@
+import os
+import json
+import tempfile
+import threading
+from datetime import datetime
+
+"""
+>>> from crawl_journal import CrawlJournal
+>>> journal = CrawlJournal('/path/to/novel_dir/crawl_journal.jsonl')
+>>> journal.plan('chapter:12', ['/martial-peak/chapter-12.html', 12, 'Chapter_00012 x', 1])
+>>> journal.done('chapter:12')
+>>> journal.pending()
+>>> journal.close()  # or: with journal: ...
+"""
+
+PLANNED = 'planned'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def atomic_write(path, data):
+    """Write to a temporary file next to path and rename it over path, a killed process never leaves half a file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f1:
+            size = f1.write(data)
+            f1.flush()
+            os.fsync(f1.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size
+
+
+class CrawlJournal:
+    """
+    Write-ahead log of the crawl jobs: every job is recorded as planned before it runs and as done or failed after.
+    Each record is flushed and fsynced, the state of a job is its last record.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.jobs = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'rt') as f1:
+                for line in f1:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last record of a killed process may be cut short
+                        continue
+                    job = self.jobs.setdefault(record['job'], {})
+                    job.update({k: v for k, v in record.items() if v is not None})
+        # only unfinished jobs are carried over, so the journal does not grow from run to run
+        self._compact()
+        # opened on the first append after a close(), so a reader can close it at the end of each crawl
+        self._file = None
+
+    def _compact(self):
+        self.jobs = {k: v for k, v in self.jobs.items() if v.get('state') != DONE}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix='.tmp_')
+        with os.fdopen(fd, 'wt') as f1:
+            for job in self.jobs.values():
+                f1.write(json.dumps(job) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def _append(self, records):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'at')
+            for record in records:
+                job = self.jobs.setdefault(record['job'], {})
+                job.update({k: v for k, v in record.items() if v is not None})
+                self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def plan(self, job, args):
+        self.plan_many([(job, args)])
+
+    def plan_many(self, jobs):
+        now = f'{datetime.now()}'
+        self._append([{'job': job, 'state': PLANNED, 'args': args, 'at': now} for job, args in jobs])
+
+    def done(self, job):
+        self._append([{'job': job, 'state': DONE, 'at': f'{datetime.now()}'}])
+
+    def failed(self, job, error):
+        self._append([{'job': job, 'state': FAILED, 'error': str(error), 'at': f'{datetime.now()}'}])
+
+    def pending(self, prefix=''):
+        """(job, args) of every job that is still planned or failed."""
+        with self._lock:
+            return [(k, v.get('args')) for k, v in self.jobs.items()
+                    if k.startswith(prefix) and v.get('state') in (PLANNED, FAILED)]
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,163 @@
+import re
+import json
+import time
+import zlib
+import sqlite3
+import threading
+
+"""
+Response bodies of GET requests with their validators, so an unchanged page costs a 304 instead of its body.
+Only the listing and toc pages are cached, the chapter pages are kept by the raw archive and the (raw).html files.
+>>> from http_cache import shared_cache
+>>> cache = shared_cache('/path/to/novelfull/http_cache.sqlite')
+>>> res = transport.default_pool.request('GET', 'https://novelfull.com/martial-peak.html?page=1', cache=cache)
+>>> cache.stats()
+"""
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# (url pattern, seconds an entry is used without asking the server), the first match wins.
+# 0 revalidates every time, None (or no match) does not cache
+DEFAULT_TTLS = (
+    (re.compile(r'\.html\?page=\d+$'), 0),  # novelfull chapter listings
+    (re.compile(r'/Book/(BookDetail|ChapterList)\?'), 0),  # cdreader book detail and chapter list pages
+)
+
+
+class HttpCache:
+    """
+    One SQLite row per url: status, headers, zlib compressed body, ETag and Last-Modified.
+    The least recently used rows are evicted once the stored bodies exceed max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, ttls=DEFAULT_TTLS, default_ttl=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self._lock = threading.RLock()
+        self._conn = None
+        self._total_bytes = 0
+        self._stats = {'fresh': 0, 'revalidated': 0, 'misses': 0, 'puts': 0, 'evicted': 0}
+
+    def _connection(self):
+        # opened on first use, so a cache can be created before forking workers
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, status INTEGER NOT NULL, '
+                               'reason TEXT NOT NULL, headers TEXT NOT NULL, body BLOB NOT NULL, etag TEXT, '
+                               'last_modified TEXT, stored REAL NOT NULL, size INTEGER NOT NULL, '
+                               'last_used REAL NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+            self._total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        return self._conn
+
+    def ttl(self, url):
+        for pattern, seconds in self.ttls:
+            if pattern.search(url):
+                return seconds
+        return self.default_ttl
+
+    def get(self, url):
+        """{'status', 'reason', 'headers': [(name, value)], 'data', 'etag', 'last_modified', 'age'} or None"""
+        with self._lock:
+            row = self._connection().execute('SELECT status, reason, headers, body, etag, last_modified, stored '
+                                              'FROM responses WHERE url=?', (url,)).fetchone()
+        if row is None:
+            return None
+        status, reason, headers, body, etag, last_modified, stored = row
+        return {'status': status, 'reason': reason, 'headers': json.loads(headers), 'data': zlib.decompress(body),
+                'etag': etag, 'last_modified': last_modified, 'age': time.time() - stored}
+
+    def validators(self, entry):
+        """The conditional request headers of a cached entry."""
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def storable(self, url, status, headers):
+        """A 200 response that can be used again: a ttl for its url, and validators or a ttl above 0 to keep it fresh."""
+        ttl = self.ttl(url)
+        return status == 200 and ttl is not None and bool(headers.get('ETag') or headers.get('Last-Modified') or ttl)
+
+    def put(self, url, status, reason, headers, data):
+        """Store a response if storable(), returns whether it was stored."""
+        if not self.storable(url, status, headers):
+            return False
+        etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+        body = zlib.compress(data, 6)
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            old = conn.execute('SELECT size FROM responses WHERE url=?', (url,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (url, status, reason, json.dumps(list(headers.items())), body, etag, last_modified, now,
+                          len(body), now))
+            conn.commit()
+            self._total_bytes += len(body) - (old[0] if old else 0)
+            self._stats['puts'] += 1
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+        return True
+
+    def touch(self, url, revalidated=False):
+        """Mark an entry used, revalidated=True (a 304) also restarts its ttl."""
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            if revalidated:
+                conn.execute('UPDATE responses SET last_used=?, stored=? WHERE url=?', (now, now, url))
+            else:
+                conn.execute('UPDATE responses SET last_used=? WHERE url=?', (now, url))
+            conn.commit()
+            self._stats['revalidated' if revalidated else 'fresh'] += 1
+
+    def miss(self):
+        """A response fetched in full and stored."""
+        with self._lock:
+            self._stats['misses'] += 1
+
+    def _evict(self):
+        # drop the least recently used rows down to 90% of max_bytes, so eviction does not run on every put
+        conn = self._connection()
+        target = self.max_bytes * 0.9
+        evicted = []
+        for url, size in conn.execute('SELECT url, size FROM responses ORDER BY last_used'):
+            if self._total_bytes <= target:
+                break
+            evicted.append((url,))
+            self._total_bytes -= size
+        conn.executemany('DELETE FROM responses WHERE url=?', evicted)
+        conn.commit()
+        self._stats['evicted'] += len(evicted)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats['fresh'] + stats['revalidated'] + stats['misses']
+            stats['hit_rate'] = round((stats['fresh'] + stats['revalidated']) / lookups, 4) if lookups else 0.0
+            stats['bytes'] = self._total_bytes
+            stats['entries'] = self._connection().execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def shared_cache(path, **kwargs):
+    """One HttpCache per file in a process, so the readers of a library share it and its connection."""
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = HttpCache(path, **kwargs)
+        return cache
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+"""
+Stage timers, counters, byte totals and error classes for the readers, and their queue based logging.
+>>> from instrumentation import metrics, get_logger
+>>> with metrics.timer('clean'):
+...     clean_content = cleaner.clean(raw_material, file_name)
+>>> metrics.add_bytes('write', len(clean_content))
+>>> metrics.dump('metrics.jsonl')              # one json line per dump
+>>> metrics.dump('metrics.prom', 'prometheus')  # text exposition format
+>>> logger = get_logger('novelfull_reader.martial-peak', '/path/to/martial-peak_main_logfile.log')
+"""
+
+# upper bounds (seconds) of the histogram buckets of the stage timers
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# the latest durations of a stage that its p50/p99 are computed from
+RECENT_SAMPLES = 2048
+METRIC_PREFIX = 'simple_utils'
+
+
+class Metrics:
+    """Thread safe. A stage is timed by timer(stage), an exception leaving the timer is counted under its class."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self._recent = {}
+            self._bytes = {}
+            self._errors = {}
+            self._counters = {}
+            self.started = time.time()
+
+    def _stage(self, stage):
+        timings = self._stages.get(stage)
+        if timings is None:
+            timings = self._stages[stage] = {'count': 0, 'seconds': 0.0, 'max': 0.0, 'buckets': [0] * len(BUCKETS)}
+            self._recent[stage] = deque(maxlen=RECENT_SAMPLES)
+        return timings
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error(stage, e)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            timings = self._stage(stage)
+            timings['count'] += 1
+            timings['seconds'] += seconds
+            timings['max'] = max(timings['max'], seconds)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    timings['buckets'][i] += 1
+                    break
+            self._recent[stage].append(seconds)
+
+    def add_bytes(self, stage, size):
+        with self._lock:
+            self._bytes[stage] = self._bytes.get(stage, 0) + size
+
+    def error(self, stage, e):
+        key = (stage, e if isinstance(e, str) else e.__class__.__name__)
+        with self._lock:
+            self._errors[key] = self._errors.get(key, 0) + 1
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def snapshot(self):
+        """Everything as plain json types, also what merge() takes (e.g. from a pool worker)."""
+        with self._lock:
+            stages = {}
+            for stage, timings in self._stages.items():
+                recent = sorted(self._recent[stage])
+                stages[stage] = dict(timings, buckets=list(timings['buckets']), recent=list(self._recent[stage]),
+                                     p50=_percentile(recent, 50), p99=_percentile(recent, 99))
+            return {'stages': stages, 'bytes': dict(self._bytes),
+                    'errors': [[stage, error, n] for (stage, error), n in self._errors.items()],
+                    'counters': dict(self._counters)}
+
+    def merge(self, snapshot):
+        with self._lock:
+            for stage, other in snapshot['stages'].items():
+                timings = self._stage(stage)
+                timings['count'] += other['count']
+                timings['seconds'] += other['seconds']
+                timings['max'] = max(timings['max'], other['max'])
+                timings['buckets'] = [a + b for a, b in zip(timings['buckets'], other['buckets'])]
+                self._recent[stage].extend(other['recent'])
+            for stage, size in snapshot['bytes'].items():
+                self._bytes[stage] = self._bytes.get(stage, 0) + size
+            for stage, error, n in snapshot['errors']:
+                self._errors[(stage, error)] = self._errors.get((stage, error), 0) + n
+            for name, value in snapshot['counters'].items():
+                self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self):
+        """One line per stage, for the logs."""
+        snapshot = self.snapshot()
+        lines = []
+        for stage, timings in sorted(snapshot['stages'].items()):
+            lines.append('%s: count:%d, seconds:%.3f, p50:%.4f, p99:%.4f, max:%.4f, bytes:%d' % (
+                stage, timings['count'], timings['seconds'], timings['p50'], timings['p99'], timings['max'],
+                snapshot['bytes'].get(stage, 0)))
+        for stage, error, n in snapshot['errors']:
+            lines.append('%s error %s: %d' % (stage, error, n))
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = ['# TYPE %s_stage_seconds histogram' % METRIC_PREFIX]
+        for stage, timings in sorted(snapshot['stages'].items()):
+            cumulative = 0
+            for bound, n in zip(BUCKETS, timings['buckets']):
+                cumulative += n
+                lines.append('%s_stage_seconds_bucket{stage="%s",le="%s"} %d' % (METRIC_PREFIX, stage, bound, cumulative))
+            lines.append('%s_stage_seconds_bucket{stage="%s",le="+Inf"} %d' % (METRIC_PREFIX, stage, timings['count']))
+            lines.append('%s_stage_seconds_sum{stage="%s"} %.6f' % (METRIC_PREFIX, stage, timings['seconds']))
+            lines.append('%s_stage_seconds_count{stage="%s"} %d' % (METRIC_PREFIX, stage, timings['count']))
+        lines.append('# TYPE %s_bytes_total counter' % METRIC_PREFIX)
+        for stage, size in sorted(snapshot['bytes'].items()):
+            lines.append('%s_bytes_total{stage="%s"} %d' % (METRIC_PREFIX, stage, size))
+        lines.append('# TYPE %s_errors_total counter' % METRIC_PREFIX)
+        for stage, error, n in sorted(snapshot['errors']):
+            lines.append('%s_errors_total{stage="%s",error="%s"} %d' % (METRIC_PREFIX, stage, error, n))
+        lines.append('# TYPE %s_events_total counter' % METRIC_PREFIX)
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('%s_events_total{name="%s"} %d' % (METRIC_PREFIX, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path, fmt='jsonl'):
+        """Append a json line (fmt='jsonl') or rewrite the file in the prometheus text format (fmt='prometheus')."""
+        if fmt == 'prometheus':
+            tmp_path = '%s.tmp' % path
+            with open(tmp_path, 'wt') as f1:
+                f1.write(self.prometheus())
+            os.replace(tmp_path, path)
+            return
+        snapshot = self.snapshot()
+        for timings in snapshot['stages'].values():
+            del timings['recent']
+        snapshot.update({'at': f'{datetime.now()}', 'uptime': round(time.time() - self.started, 3)})
+        with open(path, 'at') as f1:
+            f1.write(json.dumps(snapshot) + '\n')
+
+
+def _percentile(ordered, percent):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(percent / 100.0 * (len(ordered) - 1))))]
+
+
+# the readers, the transport, the converters and the translator all report here
+metrics = Metrics()
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+def get_logger(name, log_file, level=logging.DEBUG):
+    """
+    A logger that hands its records to a queue, a listener thread writes them to log_file.
+    Asking again for the same logger and file adds no second handler, so constructing a reader twice
+    does not write every line twice.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    key = os.path.abspath(log_file)
+    with _listeners_lock:
+        entry = _listeners.get(key)
+        if entry is None:
+            log_queue = queue.SimpleQueue()
+            file_handler = logging.FileHandler(key)
+            file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+            listener = QueueListener(log_queue, file_handler)
+            listener.start()
+            entry = _listeners[key] = (QueueHandler(log_queue), listener)
+        for handler, _ in _listeners.values():
+            # a logger writes to the file it was last asked for
+            if handler is not entry[0] and handler in logger.handlers:
+                logger.removeHandler(handler)
+        if entry[0] not in logger.handlers:
+            logger.addHandler(entry[0])
+    return logger
+
+
+@atexit.register
+def stop_logging():
+    """Write out the queued records and close the log files."""
+    with _listeners_lock:
+        entries = list(_listeners.values())
+        _listeners.clear()
+    for handler, listener in entries:
+        listener.stop()
+        for file_handler in listener.handlers:
+            file_handler.close()
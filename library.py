@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import transport
+from rate_limit import AdaptiveRateLimiter, RetryPolicy
+from novelfull_reader import NovelFullReader
+from moboreader import MoboReader
+from instrumentation import metrics
+
+"""
+Run the readers over a whole library, described by a job manifest, instead of editing the bin scripts.
+$ python3 library.py run library.json --stages fetch,convert --report report.json
+$ python3 library.py novel novelfull martial-peak --stages fetch,convert --first-chapter 2718 --last-chapter 2750 \\
+      --dest-dir 'D:\\Currents\\027_Novels\\AUTO_READ'
+$ python3 library.py set-account someone@example.com password
+$ python3 library.py search novelfull martial-peak "yang kai" --limit 5 --update
+
+A manifest (see library.example.json):
+{
+  "defaults": {"pdf_dest": "D:\\Currents\\027_Novels\\AUTO_READ", "workers": 4},
+  "limits": {"novels": 4, "network": 8, "cpu": 4, "wkhtmltopdf": 2},
+  "novels": [
+    {"site": "novelfull", "name": "martial-peak", "stages": ["fetch", "convert"],
+     "fetch": {"first_chapter": 2718, "last_chapter": 2750}, "convert": {"starting_chapter": 2704}},
+    {"site": "moboreader", "name": "Apotheosis", "stages": ["fetch"], "fetch": {"accounts": 3}}
+  ]
+}
+Each novel runs its stages in order (fetch, clean, translate, convert, index), the novels run concurrently.
+Without a chapter range fetch is a sync, the options of a stage are passed on to the reader method it runs.
+"""
+
+SITES = {'novelfull': NovelFullReader, 'moboreader': MoboReader}
+STAGES = ('fetch', 'clean', 'translate', 'convert', 'index')
+# the limited resource a stage holds while it runs, its workers are units of it
+STAGE_RESOURCES = {'fetch': 'network', 'translate': 'network', 'clean': 'cpu', 'convert': 'wkhtmltopdf',
+                   'index': 'cpu'}
+DEFAULT_LIMITS = {'novels': 4, 'network': 8, 'cpu': os.cpu_count() or 2, 'wkhtmltopdf': 2}
+DEFAULT_WORKERS = 4
+
+
+class Budget:
+    """Units of a resource shared by all the novels, a stage waits for at least one and takes up to what it wants."""
+
+    def __init__(self, units):
+        self.units = max(1, units)
+        self.available = self.units
+        self._condition = threading.Condition()
+
+    def acquire(self, wanted):
+        """Returns the number of units taken, release() them when done."""
+        with self._condition:
+            while self.available < 1:
+                self._condition.wait()
+            granted = max(1, min(wanted, self.available))
+            self.available -= granted
+        return granted
+
+    def release(self, units):
+        with self._condition:
+            self.available += units
+            self._condition.notify_all()
+
+
+def load_manifest(path):
+    with open(path, 'rt') as f1:
+        manifest = json.loads(f1.read())
+    for novel in manifest.get('novels', []):
+        if novel.get('site') not in SITES:
+            raise Exception('%s: unknown site %s, expected one of %s' % (novel.get('name'), novel.get('site'),
+                                                                         ', '.join(SITES)))
+        unknown = set(novel.get('stages', ())) - set(STAGES)
+        if unknown:
+            raise Exception('%s: unknown stages %s' % (novel.get('name'), ', '.join(sorted(unknown))))
+    return manifest
+
+
+class Scheduler:
+    """Runs the novels of a manifest concurrently within the global limits of the manifest."""
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.defaults = manifest.get('defaults', {})
+        self.limits = dict(DEFAULT_LIMITS, **manifest.get('limits', {}))
+        self.budgets = {resource: Budget(self.limits[resource]) for resource in set(STAGE_RESOURCES.values())}
+        # one pool for all the novels, a stage's network grant cannot open more connections than the whole budget
+        self.http_pool = transport.HttpPool(rate_limiter=AdaptiveRateLimiter(), retry=RetryPolicy(),
+                                            max_connections=self.limits['network'])
+
+    def run(self, names=None, stages=None):
+        """Returns {novel name: {stage: {'seconds', 'workers', 'result' or 'error'}}}"""
+        novels = [novel for novel in self.manifest.get('novels', []) if not names or novel['name'] in names]
+        report = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.limits['novels'])) as executor:
+            futures = {executor.submit(self._run_novel, novel, stages): novel['name'] for novel in novels}
+            for future in as_completed(futures):
+                report[futures[future]] = future.result()
+                print('%s: %s' % (futures[future], ', '.join(
+                    '%s failed (%s)' % (stage, values['error']) if 'error' in values else '%s done' % stage
+                    for stage, values in report[futures[future]].items())))
+        return report
+
+    def _reader(self, novel):
+        reader_class = SITES[novel['site']]
+        file_dest = novel.get('file_dest') or self.defaults.get('%s_dest' % novel['site']) or reader_class.DEFAULT_FILE_DEST
+        return reader_class(novel_name=novel['name'], file_dest=file_dest, http_pool=self.http_pool)
+
+    def _run_novel(self, novel, stages=None):
+        report = {}
+        try:
+            reader = self._reader(novel)
+        except Exception as e:
+            return {'setup': {'error': '%s: %s' % (e.__class__.__name__, e)}}
+        for stage in [stage for stage in STAGES if stage in novel.get('stages', ()) and (not stages or stage in stages)]:
+            options = dict(novel.get(stage) or {})
+            budget = self.budgets[STAGE_RESOURCES[stage]]
+            workers = budget.acquire(options.pop('workers', self.defaults.get('workers', DEFAULT_WORKERS)))
+            started = time.perf_counter()
+            try:
+                result = getattr(self, '_%s' % stage)(reader, novel, options, workers)
+                report[stage] = {'result': result}
+            except Exception as e:
+                metrics.error(stage, e)
+                report[stage] = {'error': '%s: %s' % (e.__class__.__name__, e)}
+            finally:
+                budget.release(workers)
+            report[stage].update({'seconds': round(time.perf_counter() - started, 3), 'workers': workers})
+            if 'error' in report[stage]:
+                # the later stages work on what this one produces
+                break
+        return report
+
+    def _fetch(self, reader, novel, options, workers):
+        if novel['site'] == 'moboreader':
+            accounts = options.get('accounts', 0)
+            # the token pool keeps about the granted number of chapter requests in flight
+            reader.requests_per_token = max(1, workers // max(1, accounts))
+            if 'first_chapter' in options:
+                return reader.read_by_chapter(options['first_chapter'], options.get('last_chapter', 100000), accounts)
+            return reader.sync(accounts=accounts, full=options.get('full', False))
+        reader.workers = workers
+        if 'first_chapter' in options:
+            return reader.read_by_chapter(options['first_chapter'], options.get('last_chapter', 100000))
+        if 'start_page' in options:
+            return reader.read_by_page(options['start_page'], options.get('end_page', options['start_page']))
+        return reader.sync(full=options.get('full', False))
+
+    def _clean(self, reader, novel, options, workers):
+        if novel['site'] == 'moboreader':
+            return 'skipped, moboreader chapters are written clean'
+        return reader.clean_raw(workers=workers, **options)
+
+    def _translate(self, reader, novel, options, workers):
+        if novel['site'] == 'moboreader':
+            return 'skipped, not supported for moboreader'
+        if options.pop('by', 'word') == 'paragraph':
+            return reader.translate_py_chapter(workers=workers, **options)
+        # reading the chapters into the vocabulary is cpu work, it waits for the cpu budget, not the network one
+        cpu = self.budgets['cpu']
+        cpu_workers = cpu.acquire(workers)
+        try:
+            reader.update_vocabulary(options.get('starting_chapter', 1), options.get('ending_chapter', 100000),
+                                     cpu_workers)
+        finally:
+            cpu.release(cpu_workers)
+        return reader.translate_by_word(workers=workers, vocabulary_workers=0, **options)
+
+    def _convert(self, reader, novel, options, workers):
+        dest_dir = options.pop('dest_dir', None) or self.defaults.get('pdf_dest')
+        if options.pop('bundle', False):
+            return reader.convert_bundle(dest_dir, workers=workers, **options)
+        return reader.convert_to_pdf(dest_dir, workers=workers, **options)
+
+    def _index(self, reader, novel, options, workers):
+        return reader.index_chapters(workers=workers)
+
+
+def _novel_manifest(args):
+    """The one-novel manifest of the novel subcommand."""
+    novel = {'site': args.site, 'name': args.name, 'stages': args.stages.split(',')}
+    if args.file_dest:
+        novel['file_dest'] = args.file_dest
+    chapters = {}
+    if args.first_chapter is not None:
+        chapters = {'first_chapter': args.first_chapter, 'last_chapter': args.last_chapter}
+    novel['fetch'] = dict(chapters, **({'accounts': args.accounts} if args.accounts else {}))
+    novel['clean'] = {'filter_not_raw': True} if args.site == 'novelfull' else {}
+    if args.first_chapter is not None:
+        novel['translate'] = {'starting_chapter': args.first_chapter, 'ending_chapter': args.last_chapter}
+        novel['convert'] = {'starting_chapter': args.first_chapter, 'ending_chapter': args.last_chapter}
+    novel.setdefault('convert', {})
+    if args.bundle:
+        novel['convert'].update({'bundle': True, 'fmt': args.bundle})
+    return {'defaults': {'pdf_dest': args.dest_dir, 'workers': args.workers}, 'novels': [novel]}
+
+
+def _search(args):
+    reader_class = SITES[args.site]
+    reader = reader_class(novel_name=args.name, file_dest=args.file_dest or reader_class.DEFAULT_FILE_DEST)
+    if args.update:
+        reader.index_chapters(workers=args.workers)
+    started = time.perf_counter()
+    results = reader.search(args.query, args.first_chapter, args.last_chapter, args.limit, args.order)
+    for result in results:
+        print('chapter %(chapter_no)d (%(count)d): %(snippet)s' % result)
+    print('%d chapters in %.1f ms' % (len(results), (time.perf_counter() - started) * 1000))
+    return {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='read, clean, translate and convert the novels of a library')
+    sub_parsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub_parsers.add_parser('run', help='run a job manifest')
+    run_parser.add_argument('manifest')
+    run_parser.add_argument('--novel', action='append', help='only this novel (repeatable)')
+    run_parser.add_argument('--stages', help='only these stages, comma separated')
+
+    novel_parser = sub_parsers.add_parser('novel', help='run the stages of one novel')
+    novel_parser.add_argument('site', choices=sorted(SITES))
+    novel_parser.add_argument('name')
+    novel_parser.add_argument('--stages', default='fetch', help='comma separated, of %s' % ', '.join(STAGES))
+    novel_parser.add_argument('--first-chapter', type=int)
+    novel_parser.add_argument('--last-chapter', type=int, default=100000)
+    novel_parser.add_argument('--dest-dir', help='where convert writes the pdf/epub files')
+    novel_parser.add_argument('--bundle', choices=('pdf', 'epub', 'html'), help='convert to bundles of chapters')
+    novel_parser.add_argument('--accounts', type=int, default=0, help='moboreader accounts to read with at once')
+    novel_parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    novel_parser.add_argument('--file-dest')
+
+    for sub_parser in (run_parser, novel_parser):
+        sub_parser.add_argument('--report', help='save the run report to this json file')
+        sub_parser.add_argument('--metrics', help='save the metrics to this file (.prom for the prometheus format)')
+
+    search_parser = sub_parsers.add_parser('search', help='find the chapters with every word of a query')
+    search_parser.add_argument('site', choices=sorted(SITES))
+    search_parser.add_argument('name')
+    search_parser.add_argument('query')
+    search_parser.add_argument('--first-chapter', type=int, default=1)
+    search_parser.add_argument('--last-chapter', type=int, default=100000)
+    search_parser.add_argument('--limit', type=int, default=20)
+    search_parser.add_argument('--order', choices=('chapter', 'count'), default='chapter')
+    search_parser.add_argument('--update', action='store_true', help='index the new and changed chapters first')
+    search_parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    search_parser.add_argument('--file-dest')
+
+    account_parser = sub_parsers.add_parser('set-account', help='add a moboreader account')
+    account_parser.add_argument('email')
+    account_parser.add_argument('password')
+    account_parser.add_argument('--file-dest', default=MoboReader.DEFAULT_FILE_DEST)
+
+    args = parser.parse_args(argv)
+    if args.command == 'set-account':
+        MoboReader(file_dest=args.file_dest).set_account(args.email, args.password)
+        return {}
+
+    if args.command == 'search':
+        return _search(args)
+
+    if args.command == 'run':
+        manifest = load_manifest(args.manifest)
+        report = Scheduler(manifest).run(args.novel, args.stages and args.stages.split(','))
+    else:
+        report = Scheduler(_novel_manifest(args)).run()
+    if args.report:
+        with open(args.report, 'wt') as f2:
+            f2.write(json.dumps(report, indent=2, default=str))
+    if args.metrics:
+        metrics.dump(args.metrics, 'prometheus' if args.metrics.endswith('.prom') else 'jsonl')
+    return report
+
+
+def exit_status(report):
+    """The exit status of a run: 1 when a stage of a novel failed."""
+    return 1 if any('error' in stage for novel in report.values() for stage in novel.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(exit_status(main()))
@@ -6,17 +6,30 @@ import csv
 from subprocess import Popen, PIPE, run
 from inspect import getmembers
 import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 from lxml import etree, builder, html
 from lxml.html import builder as html_builder
 from lxml.cssselect import CSSSelector
-from urllib.request import Request, urlopen
 from urllib import parse
 
 import logging
 import logging.handlers
 from datetime import datetime
 
+import transport
+from http_cache import shared_cache
+from chapter_index import ChapterIndex, content_hash
+from instrumentation import metrics, get_logger
+from chapter_cleaner import ChapterCleaner
+from crawl_journal import atomic_write
+from toc import TableOfContents
+from pdf_converter import make_converter, format_summary
+import bundler
+from search_index import SearchIndex
+from catalog import ChapterCatalog
+
 
 CURR_DIR = os.path.dirname(__file__)
 CHAPTER_NO_RE = re.compile(r'chapter[\s\-_]*(\d+)[\s\-_]*(\d+)_(\(full\)|\(short\))[\s\-_]*([\s\S]+)', re.I)
@@ -52,123 +65,284 @@ class MoboReader:
     URL = 'https://overseas-en.cdreader.com/api'
     DEFAULT_NOVEL_NAME = 'Apotheosis' ##bookId=18325322
     DEFAULT_FILE_DEST = os.path.join(CURR_DIR, 'moboreader')
+    CHAPTER_LIST_PAGE_SIZE = 500
     Novel_Name_Map = {'Apotheosis': '18325322', "The Demon King's Destiny":'23998322'}
 
-    def __init__(self, novel_name=DEFAULT_NOVEL_NAME, file_dest=DEFAULT_FILE_DEST):
+    def __init__(self, novel_name=DEFAULT_NOVEL_NAME, file_dest=DEFAULT_FILE_DEST, http_pool=None, http_cache=True):
 
         self.novel_name = novel_name
         self.file_dest = os.path.normpath(file_dest)
+        self.http_pool = http_pool or transport.default_pool
+        # the book detail and chapter list pages are revalidated instead of downloaded again
+        self.http_cache = shared_cache(os.path.join(self.file_dest, 'http_cache.sqlite')) if http_cache else None
 
         if (not os.path.exists(self.file_dest)):
             os.makedirs(self.file_dest, 0o700)
         dir1 = os.path.normpath(os.path.join(self.file_dest, self.novel_name))
         if (not os.path.exists(dir1)):
             os.makedirs(dir1, 0o700)
+        self.chapter_index = ChapterIndex(dir1)
+        # the full and short chapter files on disk, shared by the conversions, the bundles and the search index
+        self.catalog = ChapterCatalog(dir1, self._file_kind, kinds=('full', 'short'))
+        self.cleaner = ChapterCleaner.for_site('cdreader', style)
+        self.toc = self._load_toc()
+        self._search_index = None
 
         self.acc_list = self._read_acc()
         self.current_token = ''
+        # requests in flight per token of the token pool, the library scheduler sets it from its network grant
+        self.requests_per_token = 2
 
-        handler = logging.FileHandler(os.path.normpath(os.path.join(self.file_dest, self.novel_name, '%s_main_logfile.log'%self.novel_name)))
-        logging.getLogger(__name__).addHandler(handler)
-        self.main_logger = logging.getLogger(__name__)
-        self.main_logger.setLevel(logging.DEBUG)
+        self.main_logger = get_logger('%s.%s' % (__name__, self.novel_name), os.path.normpath(
+            os.path.join(self.file_dest, self.novel_name, '%s_main_logfile.log' % self.novel_name)))
 
-    def _read_chapter_list(self):
+    def _read_chapter_list(self, full=False):
+        """
+        Bring the table of contents up to date: only the ChapterList pages past the last known chapter are fetched,
+        none when the book detail reports no new chapter. full=True lists the whole book again.
+        """
         #https://overseas-en.cdreader.com/api/Book/BookDetail?bookId=18325322
         book_detail_url = '%s/Book/BookDetail?bookId=%s' % (self.URL, self.Novel_Name_Map[self.novel_name])
-        book_detail_req = Request(book_detail_url, headers={'User-Agent': 'Mozilla/5.0'})
         try:
-            with urlopen(book_detail_req) as f1:
-                book_detail_json = f1.read()
-                book_detail = json.loads(book_detail_json)
-                book_detail_file = os.path.join(self.file_dest, self.novel_name, 'book_detail.json')
-                with open(book_detail_file, 'wt') as f2:
-                    f2.write(json.dumps(book_detail, indent=4))
-
-            page_index = 1
-            page_size = book_detail['data']['chapterNum']
-            chapter_list_url = '%s/Book/ChapterList?bookId=%s&pageIndex=%d&pageSize=%d' % \
-                               (self.URL, self.Novel_Name_Map[self.novel_name], page_index, page_size)
-            chapter_list_req = Request(chapter_list_url, headers={'User-Agent': 'Mozilla/5.0'})
-
-            with urlopen(chapter_list_req) as f2:
-                chapter_list = json.loads(f2.read().decode('utf-8'))
-                chapter_list_file = os.path.join(self.file_dest, self.novel_name, 'chapter_list.json')
-                with open(chapter_list_file, 'wt') as f3:
-                    f3.write(json.dumps(chapter_list, indent=4))
-
+            book_detail_json = self.http_pool.request('GET', book_detail_url, cache=self.http_cache).data
+            book_detail = json.loads(book_detail_json)
+            book_detail_file = os.path.join(self.file_dest, self.novel_name, 'book_detail.json')
+            with open(book_detail_file, 'wt') as f2:
+                f2.write(json.dumps(book_detail, indent=4))
+
+            if full:
+                self.toc.clear()
+            chapter_num = book_detail['data']['chapterNum']
+            page_index = len(self.toc) // self.CHAPTER_LIST_PAGE_SIZE + 1
+            while len(self.toc) < chapter_num:
+                chapter_list_url = '%s/Book/ChapterList?bookId=%s&pageIndex=%d&pageSize=%d' % \
+                                   (self.URL, self.Novel_Name_Map[self.novel_name], page_index,
+                                    self.CHAPTER_LIST_PAGE_SIZE)
+                chapter_list = json.loads(self.http_pool.request('GET', chapter_list_url, cache=self.http_cache).text())
+                chapter_list = chapter_list['data']['chapterList']
+                self.toc.update(chapter_list)
+                self._log('chapter list page %d: %d chapters' % (page_index, len(chapter_list)), self.main_logger)
+                if len(chapter_list) < self.CHAPTER_LIST_PAGE_SIZE:
+                    break
+                page_index += 1
         except Exception as e:
             self._log_exception(e, self.main_logger)
+        self.toc.save()
 
-    def read_by_chapter(self, first_chapter, last_chapter):
-        chapter_list_file = os.path.join(self.file_dest, self.novel_name, 'chapter_list.json')
+    def _load_toc(self):
+        dir1 = os.path.normpath(os.path.join(self.file_dest, self.novel_name))
+        toc = TableOfContents(os.path.join(dir1, 'toc.json'), ('serialNumber', 'chapterId', 'chapterName'))
+        chapter_list_file = os.path.join(dir1, 'chapter_list.json')
+        if not len(toc) and os.path.exists(chapter_list_file):
+            # the whole-list dump of earlier versions
+            with open(chapter_list_file, 'rt') as f1:
+                toc.update(json.loads(f1.read())['data']['chapterList'])
+            toc.save()
+        return toc
+
+    def read_by_chapter(self, first_chapter, last_chapter, accounts=0):
+        """accounts > 0 reads with a pool of that many logged in accounts at once, see _read_chapters_async."""
         try:
-            if not os.path.exists(chapter_list_file):
+            if self.toc.last_chapter_no() < last_chapter:
                 self._read_chapter_list()
-            with open(chapter_list_file, 'rt') as f1:
-                chapter_list = json.loads(f1.read())
-            chapter_list = list(filter(lambda c: first_chapter <= c['serialNumber'] <= last_chapter,
-                                       chapter_list['data']['chapterList']))
+            chapter_list = self.toc.range(first_chapter, last_chapter)
+            if accounts > 0:
+                self._read_chapters_async(chapter_list, accounts)
+            else:
+                self._read_chapters(chapter_list)
+        except Exception as e:
+            self._log_exception(e, self.main_logger)
 
-            main_dir = os.path.normpath(os.path.join(self.file_dest, self.novel_name))
+    def sync(self, accounts=0, full=False):
+        """
+        Refresh the chapter list and fetch only the chapters that are new, still short,
+        changed their chapterId or lost their file, according to the chapter index.
+        The chapter files on disk the chapter index does not know yet are indexed first.
+        Only new chapters are listed, full=True lists the whole book again to catch changed chapterIds.
+        accounts > 0 reads them with a token pool, like read_by_chapter.
+        """
+        try:
+            self._index_existing_files()
+            self._read_chapter_list(full)
+            chapter_list = self.toc.range(1, self.toc.last_chapter_no())
+            to_fetch = [c for c in chapter_list if self.chapter_index.needs_fetch(c['serialNumber'], chapter_id=c['chapterId'])]
+            self._log('sync: %d listed, %d to fetch' % (len(chapter_list), len(to_fetch)), self.main_logger)
+            if accounts > 0:
+                self._read_chapters_async(to_fetch, accounts)
+            else:
+                self._read_chapters(to_fetch)
+        except Exception as e:
+            self._log_exception(e, self.main_logger)
 
+    def _index_existing_files(self):
+        """The chapter files the chapter index has no file for, or only a short one when a full copy is on disk."""
+        for entry in self.catalog.range():
+            known = self.chapter_index.get(entry['chapter_no'])
+            # already indexed, a full copy wins over a short one of the same chapter
+            if known and known.get('file') and (known.get('status') == 'full' or not entry['full']): continue
+            status = 'full' if entry['full'] else 'short'
+            chapter_no_search = CHAPTER_NO_RE.search(os.path.basename(entry[status]))
+            self.chapter_index.record_file(entry['chapter_no'], entry[status],
+                                           chapter_id=int(chapter_no_search.group(2)), status=status)
+        self.catalog.save()
+
+    def _file_kind(self, file_name):
+        """(chapter_no, 'full' | 'short') of a chapter file of a bucket directory, None for the others."""
+        chapter_no_search = CHAPTER_NO_RE.search(file_name)
+        if FILTER_RE.search(file_name) or not chapter_no_search:
+            return None
+        return int(chapter_no_search.group(1)), chapter_no_search.group(3).strip('()')
+
+    def _read_chapters(self, chapter_list):
+        try:
             if not self.current_token:
                 self._get_token()
 
             for index, chapter in enumerate(chapter_list):
-                #https://overseas-en.cdreader.com/api/Book/ChapterRead?bookId=18325322&chapterId=389358
-                chapter_url = '%s/Book/ChapterRead?bookId=%s&chapterId=%d' % \
-                              (self.URL, self.Novel_Name_Map[self.novel_name], chapter['chapterId'])
-
-                chapter_req = Request(chapter_url,
-                                      headers={'User-Agent': 'Mozilla/5.0', 'Authorization': 'Bearer '+self.current_token})
-
-                with urlopen(chapter_req) as f2:
-                    chapter_content = json.loads(f2.read().decode('utf-8'))
-                    dir1 = str((chapter['serialNumber'] // 100) * 100).rjust(5, '0')
-                    dir1 = os.path.normpath(os.path.join(main_dir, dir1))
-                    if (not os.path.exists(dir1)):
-                        os.makedirs(dir1, 0o700)
-
-                    first_content = '<div>' + chapter_content['data']['firstContent'] + '</div>'
-                    last_content = '<div>' + chapter_content['data']['lastContent'] + '</div>'
-
-                    full_or_short = '(full)' if len(first_content) >= full_threshold else '(short)'
-
-                    file_name = CHAPTER_NO_CLEAR_RE.sub('', chapter['chapterName'])
-                    clean_file_name = 'Chapter_%05d_%05d_%s %s' % \
-                                      (chapter['serialNumber'], chapter['chapterId'], full_or_short, file_name)
-                    clean_file_name = FORBIDDEN_CHAR_RE.sub(' ', clean_file_name)
-
-                    msg = 'file_name:%s,first_content_size:%d,last_content_size:%d,timestamp:%s' % (
-                        clean_file_name, len(first_content), len(last_content), f'{datetime.now()}')
-                    self._log(msg, self.main_logger)
-
-                    if (len(first_content) < full_threshold and self._get_token()):
-                        chapter_list[index + 1:index + 1] = [chapter]
-
-                    first_content = html.fromstring(first_content)
-                    last_content = html.fromstring(last_content)
-                    chapter_content = html_builder.DIV(first_content, html_builder.HR(), last_content)
-
-                    novel_name_h = html_builder.H3(html_builder.CLASS("name"), self.novel_name)
-                    chapter_name_h = html_builder.H4(html_builder.CLASS("name"), chapter['chapterName'])
-                    gen_html = html_builder.HTML(
-                        html_builder.HEAD(html_builder.TITLE(chapter['chapterName']), html_builder.STYLE(style)),
-                        html_builder.BODY(novel_name_h, chapter_name_h, chapter_content,
-                                          html_builder.DIV(
-                                              html_builder.CLASS("end"),
-                                              html_builder.P('The End...'),
-                                              html_builder.A(chapter_url, href=chapter_url))
-                                          )
-                    )
-                    # gen_html = builder.E.html(builder.E.head(builder.E.title()))
-                    # gen_html.append(builder.E.body(chapter_content))
-                    full_file_name = os.path.join(dir1, '%s%s' % (clean_file_name, '.html'))
-                    with open(full_file_name, "wb") as f3:
-                        clean_size = f3.write(html.tostring(gen_html, pretty_print=True, method="html"))
+                chapter_url, chapter_content = self._fetch_chapter(chapter, self.current_token)
+                status = self._write_chapter(chapter, chapter_url, chapter_content)
+                if (status == 'short' and self._get_token()):
+                    chapter_list[index + 1:index + 1] = [chapter]
+            self._log('http_pool:%s' % self.http_pool.stats(), self.main_logger)
+            self._log('metrics:\n%s' % metrics.summary(), self.main_logger)
         except Exception as e:
             self._log_exception(e, self.main_logger)
+        self.chapter_index.save()
+
+    def _read_chapters_async(self, chapter_list, accounts, requests_per_token=None):
+        """
+        Log into up to `accounts` accounts of acc_list.json ahead of time and read the chapters with all the tokens
+        at once, requests_per_token (by default self.requests_per_token) requests in flight per token.
+        A token that returns a short chapter is retired, the chapter goes back to the queue for the other tokens,
+        a chapter whose request fails goes back too, within the same number of tries.
+        """
+        try:
+            asyncio.run(self._read_chapters_with_token_pool(chapter_list, accounts,
+                                                            requests_per_token or self.requests_per_token))
+            self._log('http_pool:%s' % self.http_pool.stats(), self.main_logger)
+            self._log('metrics:\n%s' % metrics.summary(), self.main_logger)
+        except Exception as e:
+            self._log_exception(e, self.main_logger)
+        self.chapter_index.save()
+
+    async def _read_chapters_with_token_pool(self, chapter_list, accounts, requests_per_token):
+        loop = asyncio.get_running_loop()
+        # the blocking http pool and file writes run on the executor, the event loop only schedules them
+        executor = ThreadPoolExecutor(max_workers=max(1, accounts * requests_per_token))
+        try:
+            emails = list(self.acc_list.keys())[:accounts]
+            tokens = await asyncio.gather(*[loop.run_in_executor(executor, self._login, email) for email in emails])
+            for email, token in zip(emails, tokens):
+                # as in _get_token, only an account that gave a token is used up
+                if token:
+                    del self.acc_list[email]
+            live_tokens = set(token for token in tokens if token)
+            self._log('token pool: %d of %d logins succeeded' % (len(live_tokens), len(emails)), self.main_logger)
+            if not live_tokens:
+                return
+
+            queue = asyncio.Queue()
+            for chapter in chapter_list:
+                queue.put_nowait((chapter, 0))
+
+            async def worker(token):
+                while token in live_tokens:
+                    chapter, tries = await queue.get()
+                    try:
+                        if token not in live_tokens:
+                            # retired by another request of the same token while this one waited
+                            if live_tokens:
+                                queue.put_nowait((chapter, tries))
+                            break
+                        try:
+                            chapter_url, chapter_content = await loop.run_in_executor(
+                                executor, self._fetch_chapter, chapter, token)
+                            status = await loop.run_in_executor(
+                                executor, self._write_chapter, chapter, chapter_url, chapter_content)
+                        except Exception as e:
+                            self._log_exception(e, self.main_logger)
+                            # sent again within the same limit as a short chapter, so it is not silently lost
+                            if live_tokens and tries < len(tokens):
+                                queue.put_nowait((chapter, tries + 1))
+                            else:
+                                self._log('chapter %s failed %d times, left for the next sync' %
+                                          (chapter['chapterId'], tries + 1), self.main_logger)
+                            continue
+                        if status == 'short':
+                            live_tokens.discard(token)
+                            self._log('token retired after a short chapter (%d live)' % len(live_tokens),
+                                      self.main_logger)
+                            # one retry per token at most, a chapter that is short for everybody stays short
+                            if live_tokens and tries < len(tokens):
+                                queue.put_nowait((chapter, tries + 1))
+                    finally:
+                        queue.task_done()
+                if not live_tokens:
+                    # no token is left to read the rest, let queue.join() return
+                    while not queue.empty():
+                        queue.get_nowait()
+                        queue.task_done()
+
+            # the workers wait on the queue instead of leaving when it is briefly empty,
+            # a chapter put back by a retired token is still read by the live ones
+            workers = [asyncio.create_task(worker(token)) for token in list(live_tokens) for _ in range(requests_per_token)]
+            await queue.join()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if live_tokens:
+                self.current_token = next(iter(live_tokens))
+        finally:
+            executor.shutdown()
+
+    def _fetch_chapter(self, chapter, token):
+        #https://overseas-en.cdreader.com/api/Book/ChapterRead?bookId=18325322&chapterId=389358
+        chapter_url = '%s/Book/ChapterRead?bookId=%s&chapterId=%d' % \
+                      (self.URL, self.Novel_Name_Map[self.novel_name], chapter['chapterId'])
+
+        chapter_res = self.http_pool.request('GET', chapter_url, headers={'Authorization': 'Bearer '+token})
+        with metrics.timer('parse'):
+            return chapter_url, json.loads(chapter_res.text())
+
+    def _write_chapter(self, chapter, chapter_url, chapter_content):
+        """Write the chapter page, returns its status: 'full' or 'short'."""
+        main_dir = os.path.normpath(os.path.join(self.file_dest, self.novel_name))
+        dir1 = str((chapter['serialNumber'] // 100) * 100).rjust(5, '0')
+        dir1 = os.path.normpath(os.path.join(main_dir, dir1))
+        os.makedirs(dir1, 0o700, exist_ok=True)
+
+        first_content = '<div>' + chapter_content['data']['firstContent'] + '</div>'
+        last_content = '<div>' + chapter_content['data']['lastContent'] + '</div>'
+
+        full_or_short = '(full)' if len(first_content) >= full_threshold else '(short)'
+
+        file_name = CHAPTER_NO_CLEAR_RE.sub('', chapter['chapterName'])
+        clean_file_name = 'Chapter_%05d_%05d_%s %s' % \
+                          (chapter['serialNumber'], chapter['chapterId'], full_or_short, file_name)
+        clean_file_name = FORBIDDEN_CHAR_RE.sub(' ', clean_file_name)
+
+        msg = 'file_name:%s,first_content_size:%d,last_content_size:%d,timestamp:%s' % (
+            clean_file_name, len(first_content), len(last_content), f'{datetime.now()}')
+        self._log(msg, self.main_logger)
+
+        with metrics.timer('clean'):
+            first_content = self.cleaner.strip(html.fromstring(first_content))
+            last_content = self.cleaner.strip(html.fromstring(last_content))
+            chapter_content = html_builder.DIV(first_content, html_builder.HR(), last_content)
+
+            novel_name_h = html_builder.H3(html_builder.CLASS("name"), self.novel_name)
+            chapter_name_h = html_builder.H4(html_builder.CLASS("name"), chapter['chapterName'])
+            clean_content = self.cleaner.page(chapter['chapterName'], chapter_content, chapter_url,
+                                              headings=(novel_name_h, chapter_name_h))
+        full_file_name = os.path.join(dir1, '%s%s' % (clean_file_name, '.html'))
+        with metrics.timer('write'):
+            clean_size = atomic_write(full_file_name, clean_content)
+        metrics.add_bytes('write', clean_size)
+        metrics.count('chapters_%s' % full_or_short.strip('()'))
+        self.chapter_index.record(chapter['serialNumber'], chapter_id=chapter['chapterId'], url=chapter_url,
+                                  file=os.path.relpath(full_file_name, main_dir), clean_size=clean_size,
+                                  content_hash=content_hash(clean_content), status=full_or_short.strip('()'))
+        return full_or_short.strip('()')
 
     def set_account(self, email, password):
         acc_file = os.path.join(self.file_dest, 'acc_list.json')
@@ -192,66 +366,122 @@ class MoboReader:
         except IndexError:
             self._log('*******All Tokens have been consumed******', self.main_logger)
             return ''
+        token = self._login(email)
+        if token:
+            self.current_token = token
+            del self.acc_list[email]
+        return token
+
+    def _login(self, email):
         passw = self.acc_list[email]['passw']
         #https://overseas-en.cdreader.com/api/User/Login
         chapter_url = '%s/User/Login' % self.URL
         data = json.dumps({"email": email, "pwd": passw, "loginType": 0}).encode('utf-8')
-        chapter_req = Request(chapter_url, headers={'User-Agent': 'Mozilla/5.0', 'Content-Type': 'application/json'},
-                              method='POST', data=data)
 
         try:
-            with urlopen(chapter_req) as f1:
-                response = json.loads(f1.read().decode('utf-8'))
-                self.current_token = response['data']['accesstoken']
-                del self.acc_list[email]
+            res = self.http_pool.request('POST', chapter_url, body=data, headers={'Content-Type': 'application/json'})
+            response = json.loads(res.text())
+            token = response['data']['accesstoken']
 
-                msg = 'User/Login (%s) Response:\n%s\n,timestamp:%s' % (email,json.dumps(response, indent=2), f'{datetime.now()}')
-                self._log(msg, self.main_logger)
+            msg = 'User/Login (%s) Response:\n%s\n,timestamp:%s' % (email,json.dumps(response, indent=2), f'{datetime.now()}')
+            self._log(msg, self.main_logger)
 
-                return self.current_token
+            return token
         except Exception as e:
             self._log_exception(e, self.main_logger)
             return ''
 
-    def convert_to_pdf(self, dest_dir, starting_dir= 0, starting_chapter= 1, ending_chapter=100000):
+    def convert_to_pdf(self, dest_dir, starting_dir= 0, starting_chapter= 1, ending_chapter=100000, workers=1,
+                       timeout=None, force=False, renderer='process', batch_size=50):
+        """renderer='batch' feeds each wkhtmltopdf process batch_size chapters instead of starting one per chapter."""
         if not dest_dir: raise Exception('dest_dir is required')
-        filter_re = re.compile(r'(Chapter_\d+_\d+_\(short\))|(\.log)')
-        sub_dir_no_re = re.compile(r'(\d+)')
         full_dest = os.path.normpath(os.path.join(dest_dir, self.novel_name))
         if not os.path.exists(full_dest):
             os.makedirs(full_dest, 0o700)
 
-        source_dir = os.path.normpath(os.path.join(self.file_dest, self.novel_name))
+        jobs = []
         try:
-            for sub_dir in os.listdir(source_dir):
-                if sub_dir.endswith('.log') or sub_dir.endswith('.json') or not sub_dir_no_re.search(sub_dir): continue
-                sub_dir_no = int(sub_dir_no_re.search(sub_dir).group(1))
-                dest_sub_dir = os.path.join(full_dest, sub_dir)
-                if not os.path.exists(dest_sub_dir):
-                    os.makedirs(dest_sub_dir, 0o700)
-                print('start sub-dir %s' % sub_dir)
-                for file in os.listdir(os.path.join(source_dir, sub_dir)):
-                    if filter_re.search(file): continue
-                    chapter_no = int(CHAPTER_NO_RE.search(file).group(1))
-                    if sub_dir_no < starting_dir or ending_chapter < chapter_no or chapter_no < starting_chapter: continue
-                    full_source_file = os.path.join(source_dir, sub_dir, file)
-                    full_dest_file = os.path.join(dest_sub_dir, file.replace('.html', '.pdf'))
-                    command = ['wkhtmltopdf', full_source_file, full_dest_file]
-                    try:
-                        # wkhtmltopdf_process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-                        completed_process = run(command, stdout=PIPE)
-                        completed_process.check_returncode() # If returncode is non - zero, raise a CalledProcessError.
-                        # for m, n in getmembers(completed_process, lambda m1: not callable(m1)):
-                        #     print('%s => %s' % (str(m), str(n)))
-                    except Exception as e:
-                        self._log_exception(e, self.main_logger)
+            dest_sub_dir = None
+            # only the full chapters, a short copy is not worth a pdf
+            for entry in self.catalog.range(starting_chapter, ending_chapter, kind='full'):
+                if int(entry['bucket']) < starting_dir: continue
+                if dest_sub_dir != os.path.join(full_dest, entry['bucket']):
+                    dest_sub_dir = os.path.join(full_dest, entry['bucket'])
+                    if not os.path.exists(dest_sub_dir):
+                        os.makedirs(dest_sub_dir, 0o700)
+                    print('start sub-dir %s' % entry['bucket'])
+                file = os.path.basename(entry['full'])
+                jobs.append((entry['full'], os.path.join(dest_sub_dir, file.replace('.html', '.pdf'))))
+            self.catalog.save()
         except Exception as e:
             self._log_exception(e, self.main_logger)
 
+        converter = make_converter(renderer, workers=workers, timeout=timeout, force=force, batch_size=batch_size)
+        summary = converter.convert(jobs)
+        msg = format_summary(summary)
+        print(msg)
+        self._log(msg, self.main_logger)
+        return summary
+
+    def convert_bundle(self, dest_dir, starting_chapter=1, ending_chapter=100000, fmt='pdf', bundle_size=100,
+                       ranges=None, workers=1, timeout=None, force=False):
+        """
+        One pdf/epub/html per `bundle_size` chapters (by default the 100-chapter bucket directories),
+        or per (first, last) chapter range in `ranges`, instead of one pdf per chapter.
+        """
+        if not dest_dir: raise Exception('dest_dir is required')
+        full_dest = os.path.normpath(os.path.join(dest_dir, self.novel_name))
+        if not os.path.exists(full_dest):
+            os.makedirs(full_dest, 0o700)
+        summary = bundler.bundle(self._list_chapter_files(starting_chapter, ending_chapter), full_dest, self.novel_name,
+                                 fmt=fmt, bundle_size=bundle_size, ranges=ranges, style=style, workers=workers,
+                                 timeout=timeout, force=force)
+        msg = format_summary(summary)
+        print(msg)
+        self._log(msg, self.main_logger)
+        return summary
+
+    def _list_chapter_files(self, starting_chapter=1, ending_chapter=100000):
+        """Sorted (chapter_no, full_path, title) of the full chapter files in the range, short copies are left out."""
+        chapters = []
+        for entry in self.catalog.range(starting_chapter, ending_chapter, kind='full'):
+            chapter_no_search = CHAPTER_NO_RE.search(os.path.basename(entry['full']))
+            title = 'Chapter %d %s' % (entry['chapter_no'], chapter_no_search.group(4)[:-5].strip())
+            chapters.append((entry['chapter_no'], entry['full'], title))
+        self.catalog.save()
+        return chapters
+
+    def index_chapters(self, workers=1):
+        """Bring the full-text search index up to date with the full chapter files, see search()."""
+        files = [(chapter_no, path) for chapter_no, path, _ in self._list_chapter_files()]
+        with metrics.timer('index'):
+            stats = self._get_search_index().update(files, workers)
+        msg = 'search index: %(buckets)d buckets, %(updated)d updated, %(read)d chapters read, %(dropped)d dropped' % stats
+        print(msg)
+        self._log(msg, self.main_logger)
+        return stats
+
+    def search(self, query, first_chapter=1, last_chapter=100000, limit=20, order='chapter'):
+        return self._get_search_index().search(query, first_chapter, last_chapter, limit, order)
+
+    def _get_search_index(self):
+        if self._search_index is None:
+            self._search_index = SearchIndex(os.path.normpath(os.path.join(self.file_dest, self.novel_name,
+                                                                            'search_index')))
+        return self._search_index
+
+    def dump_metrics(self, path=None, fmt='jsonl'):
+        """Write the metrics of this process, by default to metrics.jsonl (or metrics.prom) in the novel directory."""
+        path = path or os.path.join(self.file_dest, self.novel_name,
+                                    'metrics.prom' if fmt == 'prometheus' else 'metrics.jsonl')
+        metrics.dump(path, fmt)
+        return path
+
     def _log(self, msg, logger):
-        logger.log(logging.DEBUG, '*******************************************')
-        logger.log(logging.DEBUG, msg)
+        logger.debug(msg)
 
     def _log_exception(self, e, logger):
-        logger.log(logging.DEBUG, '*******************************************')
-        logger.log(logging.DEBUG, '[%s]' % (str(e)))
\ No newline at end of file
+        if isinstance(e, Exception):
+            metrics.error('reader', e)
+            e = '%s: %s' % (e.__class__.__name__, e)
+        logger.error('[%s]' % e)
@@ -0,0 +1,244 @@
+import json
+import time
+import hashlib
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib import parse
+
+"""
+Local stand-ins for the remote services, to measure the pipelines without a network.
+>>> from mock_servers import TranslatorStub
+>>> from translator import MicrosoftTranslator
+>>> stub = TranslatorStub(latency=0.05)
+>>> url = stub.start()
+>>> translator = MicrosoftTranslator(url=url)
+>>> stub.stop()
+>>> site = NovelFullStub(chapters=500, paragraphs=40, latency=0.02, error_rate=0.01)
+>>> reader = NovelFullReader(file_dest=tmp_dir); reader.URL = site.start()
+"""
+
+
+class MockServer:
+    """
+    A threaded http server on a free local port.
+    Every request waits `latency` seconds and fails with a 503 at `error_rate`, subclasses implement handle().
+    A GET is answered with an ETag, and with a 304 when If-None-Match still matches it.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.bytes_sent = 0
+        self.not_modified = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self.url = ''
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # without it the body waits for the ack of the headers on kept-alive connections
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._reply('GET', b'')
+
+            def do_POST(self):
+                self._reply('POST', self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+
+            def _reply(self, method, body):
+                status, headers, data = mock._dispatch(method, self.path, self.headers, body)
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+        return self.url
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _dispatch(self, method, path, headers, body):
+        with self._lock:
+            self.requests += 1
+            failed = self.random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            return 503, {'Retry-After': '1'}, b'Service Unavailable'
+        split_path = parse.urlsplit(path)
+        status, response_headers, data = self.handle(method, split_path.path, parse.parse_qs(split_path.query),
+                                                     headers, body)
+        if method == 'GET' and status == 200:
+            etag = '"%s"' % hashlib.sha1(data).hexdigest()[:20]
+            response_headers = dict(response_headers, ETag=etag)
+            if headers.get('If-None-Match') == etag:
+                with self._lock:
+                    self.not_modified += 1
+                return 304, response_headers, b''
+        with self._lock:
+            self.bytes_sent += len(data)
+        return status, response_headers, data
+
+    def handle(self, method, path, query, headers, body):
+        return 404, {}, b'Not Found'
+
+
+class TranslatorStub(MockServer):
+    """Imitates the /translate and /Dictionary/Lookup endpoints of the Microsoft translator v3 api."""
+
+    MAX_ELEMENTS = 100
+    MAX_CHARS = 10000
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        super().__init__(latency, error_rate, seed)
+        self.texts = 0
+
+    def handle(self, method, path, query, headers, body):
+        if method != 'POST' or path not in ('/translate', '/Dictionary/Lookup'):
+            return 404, {}, b'Not Found'
+        try:
+            texts = [item['Text'] for item in json.loads(body.decode('utf-8'))]
+        except Exception:
+            return 400, {}, b'{"error": {"code": 400000, "message": "The request body is not valid JSON."}}'
+        if len(texts) > self.MAX_ELEMENTS or sum(len(t) for t in texts) > self.MAX_CHARS:
+            return 400, {}, b'{"error": {"code": 400077, "message": "The maximum request size has been exceeded."}}'
+        with self._lock:
+            self.texts += len(texts)
+        to_lang = query.get('to', ['ar'])[0]
+        if path == '/translate':
+            result = [{'translations': [{'text': '[%s] %s' % (to_lang, text), 'to': to_lang}]} for text in texts]
+        else:
+            result = [{'normalizedSource': text.lower(), 'displaySource': text,
+                       'translations': [{'normalizedTarget': '[%s] %s' % (to_lang, text.lower()),
+                                         'displayTarget': '[%s] %s' % (to_lang, text), 'posTag': 'NOUN',
+                                         'confidence': 1.0, 'prefixWord': '', 'backTranslations': []}]}
+                      for text in texts]
+        return 200, {'Content-Type': 'application/json; charset=utf-8'}, json.dumps(result).encode('utf-8')
+
+
+def synthetic_words(count=3000, seed=0):
+    """A made-up vocabulary, so the chapters have a realistic spread of distinct words."""
+    rand = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rand.choice(letters) for _ in range(rand.randint(3, 10))) for _ in range(count)]
+
+
+class SyntheticNovel:
+    """chapters chapters of paragraphs paragraphs each, the same text for the same seed."""
+
+    def __init__(self, chapters=200, paragraphs=40, words_per_paragraph=60, seed=0):
+        self.chapters = chapters
+        self.paragraphs = paragraphs
+        self.words_per_paragraph = words_per_paragraph
+        self.seed = seed
+        self.words = synthetic_words(seed=seed)
+
+    def title(self, chapter_no):
+        return 'Chapter %d %s' % (chapter_no, ' '.join(random.Random(self.seed + chapter_no).sample(self.words, 3)))
+
+    def paragraph_texts(self, chapter_no):
+        rand = random.Random(self.seed * 100003 + chapter_no)
+        # a skewed choice, a few words are frequent and most are rare, like in real text
+        return [' '.join(self.words[int(len(self.words) * rand.random() ** 3)] for _ in range(self.words_per_paragraph))
+                .capitalize() + '.' for _ in range(self.paragraphs)]
+
+
+class NovelFullStub(MockServer):
+    """Serves a synthetic novel in the novelfull.com layout: /<novel>.html?page=N listings and chapter pages."""
+
+    CHAPTERS_PER_PAGE = 50
+
+    def __init__(self, novel_name='martial-peak', chapters=200, paragraphs=40, latency=0.0, error_rate=0.0, seed=0):
+        super().__init__(latency, error_rate, seed)
+        self.novel_name = novel_name
+        self.novel = SyntheticNovel(chapters, paragraphs, seed=seed)
+
+    def handle(self, method, path, query, headers, body):
+        if path == '/%s.html' % self.novel_name:
+            page = int(query.get('page', ['1'])[0])
+            first = (page - 1) * self.CHAPTERS_PER_PAGE + 1
+            links = ''.join('<li><a href="/%s/chapter-%d.html" title="%s"><span>%s</span></a></li>'
+                            % (self.novel_name, no, self.novel.title(no), self.novel.title(no))
+                            for no in range(first, min(first + self.CHAPTERS_PER_PAGE - 1, self.novel.chapters) + 1))
+            return 200, {'Content-Type': 'text/html'}, self._page('<ul id="list-chapter">%s</ul>' % links)
+        if path.startswith('/%s/chapter-' % self.novel_name):
+            chapter_no = int(path.rsplit('-', 1)[1].split('.')[0])
+            if not 1 <= chapter_no <= self.novel.chapters:
+                return 404, {}, b'Not Found'
+            body = []
+            for i, text in enumerate(self.novel.paragraph_texts(chapter_no)):
+                body.append('<p>%s</p>' % text)
+                if i % 10 == 5:
+                    body.append('<script>window.ads = window.ads || [];</script><ins class="adsbygoogle"></ins>'
+                                '<div class="ads ads-holder"><div class="google-auto-placed"></div></div>')
+            return 200, {'Content-Type': 'text/html'}, self._page('<div id="chapter-content">%s</div>' % ''.join(body))
+        return 404, {}, b'Not Found'
+
+    def _page(self, content):
+        chrome = ''.join('<li><a href="/genre/%d">Genre %d</a></li>' % (i, i) for i in range(40))
+        return ('<html><head><title>%s</title><script src="/app.js"></script></head><body><ul class="nav">%s</ul>'
+                '%s<script>track();</script></body></html>' % (self.novel_name, chrome, content)).encode('utf-8')
+
+
+class CdReaderStub(MockServer):
+    """
+    Imitates the cdreader api used by MoboReader: User/Login, Book/BookDetail, a paginated Book/ChapterList
+    and Book/ChapterRead. A token returns short chapters after token_budget reads (None: never).
+    """
+
+    def __init__(self, chapters=200, paragraphs=40, token_budget=None, latency=0.0, error_rate=0.0, seed=0):
+        super().__init__(latency, error_rate, seed)
+        self.novel = SyntheticNovel(chapters, paragraphs, seed=seed)
+        self.token_budget = token_budget
+        self.token_reads = {}
+        self.logins = 0
+
+    def _json(self, value):
+        return 200, {'Content-Type': 'application/json; charset=utf-8'}, json.dumps(value).encode('utf-8')
+
+    def handle(self, method, path, query, headers, body):
+        if path == '/User/Login' and method == 'POST':
+            with self._lock:
+                self.logins += 1
+                token = 'token-%d' % self.logins
+            return self._json({'data': {'accesstoken': token}})
+        if path == '/Book/BookDetail':
+            return self._json({'data': {'chapterNum': self.novel.chapters}})
+        if path == '/Book/ChapterList':
+            page_index = int(query.get('pageIndex', ['1'])[0])
+            page_size = int(query.get('pageSize', [str(self.novel.chapters)])[0])
+            first = (page_index - 1) * page_size + 1
+            return self._json({'data': {'chapterList': [
+                {'serialNumber': no, 'chapterId': 100000 + no, 'chapterName': self.novel.title(no)}
+                for no in range(first, min(first + page_size - 1, self.novel.chapters) + 1)]}})
+        if path == '/Book/ChapterRead':
+            chapter_no = int(query['chapterId'][0]) - 100000
+            token = (headers.get('Authorization') or '').replace('Bearer ', '')
+            with self._lock:
+                self.token_reads[token] = self.token_reads.get(token, 0) + 1
+                short = not token or (self.token_budget is not None and self.token_reads[token] > self.token_budget)
+            paragraphs = ['<p>%s</p>' % text for text in self.novel.paragraph_texts(chapter_no)]
+            if short:
+                paragraphs = paragraphs[:1]
+            half = len(paragraphs) // 2 or 1
+            return self._json({'data': {'firstContent': ''.join(paragraphs[:half]),
+                                        'lastContent': ''.join(paragraphs[half:])}})
+        return 404, {}, b'Not Found'
@@ -9,13 +9,34 @@ from inspect import getmembers
 from lxml import etree, builder, html
 from lxml.cssselect import CSSSelector
 from lxml.html import builder as html_builder
-from urllib.request import Request, urlopen
+from urllib import parse
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 import logging
 import logging.handlers
 from datetime import datetime
 
+import transport
+from http_cache import shared_cache
+from chapter_index import ChapterIndex, content_hash
+from instrumentation import Metrics, metrics, get_logger
+from chapter_cleaner import ChapterCleaner, SITE_RULES
+from crawl_journal import CrawlJournal, atomic_write
+from raw_archive import RawArchive, read_location
+from toc import TableOfContents
+from catalog import ChapterCatalog
+from pdf_converter import PdfConverter, make_converter, format_summary
+import bundler
+from pipeline import Pipeline, Stage
+from translator import MicrosoftTranslator
+from translation_memory import TranslationMemory
+from translation_store import TranslationStore
+from vocabulary import VocabularyIndex, SPLITTER_RE
+from search_index import SearchIndex
+
 # from collections import defaultdict
 
 """
@@ -34,9 +55,76 @@ style = """
     }
     """
 CURR_DIR = os.path.dirname(__file__)
-translations = {}
 not_translated_words = set()
 
+def chapter_dir(novel_dir, chapter_no):
+    """The 100-chapter bucket directory of a chapter, created when missing."""
+    dir2 = os.path.normpath(os.path.join(novel_dir, str((chapter_no // 100) * 100).rjust(5, '0')))
+    # exist_ok: several download workers may create the same bucket directory at once
+    os.makedirs(dir2, 0o700, exist_ok=True)
+    return dir2
+
+
+def _write_if_changed(path, content):
+    """Write content unless path already holds the same bytes, returns True when written."""
+    if os.path.exists(path) and os.path.getsize(path) == len(content):
+        with open(path, 'rb') as f1:
+            if content_hash(f1.read()) == content_hash(content):
+                return False
+    atomic_write(path, content)
+    return True
+
+
+def clean_raw_files(novel_dir, files, rules=SITE_RULES['novelfull'], archive_dir=None):
+    """
+    Worker of NovelFullReader.clean_raw (module level so a process pool can run it).
+    files are (full_raw_file_name, chapter_no, clean_file_name, chapter_url), returns (stats, chapter index records).
+    With archive_dir they are (raw archive location, ...) instead and no (raw).html copy is written.
+    """
+    started = time.perf_counter()
+    cleaner = ChapterCleaner(rules, style)
+    stats = {'pid': os.getpid(), 'files': 0, 'bytes_read': 0, 'raw_written': 0, 'clean_written': 0,
+             'seconds': 0.0, 'errors': []}
+    # a pool worker has its own copy of the module metrics, the parent merges this one instead
+    worker_metrics = Metrics()
+    records = []
+    for source, chapter_no, clean_file_name, chapter_url in files:
+        try:
+            if archive_dir:
+                raw_bytes = read_location(archive_dir, source)
+            else:
+                with open(source, 'rb') as f1:
+                    raw_bytes = f1.read()
+            stats['files'] += 1
+            stats['bytes_read'] += len(raw_bytes)
+            with worker_metrics.timer('parse'):
+                raw_material = etree.HTML(raw_bytes)
+            dir2 = chapter_dir(novel_dir, chapter_no)
+            if archive_dir:
+                raw_size = len(raw_bytes)
+            else:
+                raw_content = etree.tostring(raw_material, pretty_print=True, method="html")
+                raw_size = len(raw_content)
+                with worker_metrics.timer('write'):
+                    stats['raw_written'] += _write_if_changed(
+                        os.path.join(dir2, '%s%s' % (clean_file_name, '(raw).html')), raw_content)
+            full_file_name = os.path.join(dir2, '%s%s' % (clean_file_name, '.html'))
+            with worker_metrics.timer('clean'):
+                clean_content = cleaner.clean(raw_material, clean_file_name, chapter_url)
+            with worker_metrics.timer('write'):
+                written = _write_if_changed(full_file_name, clean_content)
+            stats['clean_written'] += written
+            worker_metrics.add_bytes('write', len(clean_content) if written else 0)
+            records.append((chapter_no, {'file': os.path.relpath(full_file_name, novel_dir), 'raw_size': raw_size,
+                                         'clean_size': len(clean_content), 'content_hash': content_hash(clean_content),
+                                         'status': 'full'}))
+        except Exception as e:
+            stats['errors'].append((str(source), str(e)))
+    stats['seconds'] = time.perf_counter() - started
+    stats['metrics'] = worker_metrics.snapshot()
+    return stats, records
+
+
 class NovelFullReader:
     URL = 'https://novelfull.com'
     DEFAULT_NOVEL_NAME = 'martial-peak'
@@ -45,257 +133,583 @@ class NovelFullReader:
     CHAPTER_NO_RE = re.compile(r'chapter[\s*\-_]*(\d+)', re.I)
     # FORBIDDEN_CHAR_RE = re.compile(r'[\*\?\\\/\:\!\"\>\<]', re.I)
     FORBIDDEN_CHAR_RE = re.compile(r'[^\w \s\-_\(\)\[\].\'\"]', re.I)
-    CLEAN_TEXT_SPLITTER_RE = re.compile(r'[^\w]', re.I)
+    CLEAN_TEXT_SPLITTER_RE = SPLITTER_RE
+    TRANSLATOR_URL = 'https://microsoft-translator-text.p.rapidapi.com'
+    CHAPTERS_PER_PAGE = 50
+    # refresh_toc stops here whatever the site answers, 2000 pages of 50 is well past any novel
+    MAX_TOC_PAGES = 2000
+    WORDS_PER_ROUND = 500
+    LIST_CHAPTER_SEL = CSSSelector('#list-chapter')
 
-    def __init__(self, novel_name=DEFAULT_NOVEL_NAME, file_dest=DEFAULT_FILE_DEST):
+    def __init__(self, novel_name=DEFAULT_NOVEL_NAME, file_dest=DEFAULT_FILE_DEST, workers=1, per_host_limit=4,
+                 http_pool=None, translator=None, raw_archive=False, http_cache=True):
 
         self.novel_name = novel_name
         self.file_dest = os.path.normpath(file_dest)
+        # workers == 1 keeps the old serial behaviour, per_host_limit caps the concurrent requests to one host
+        self.workers = max(1, workers)
+        self.per_host_limit = max(1, per_host_limit)
+        self._host_semaphores = {}
+        self._host_semaphores_lock = threading.Lock()
+        self.http_pool = http_pool or transport.default_pool
+        # listing pages are revalidated with If-None-Match/If-Modified-Since instead of downloaded again
+        self.http_cache = shared_cache(os.path.join(self.file_dest, 'http_cache.sqlite')) if http_cache else None
+        self._translation_store = None
+        self._vocabulary = None
+        self._search_index = None
+        translation_dir = os.path.normpath(os.path.join(self.file_dest, 'translation'))
+        os.makedirs(translation_dir, 0o700, exist_ok=True)
+        self.translator = translator or MicrosoftTranslator(
+            url=self.TRANSLATOR_URL, http_pool=self.http_pool,
+            memory=TranslationMemory(os.path.join(translation_dir, 'translation_memory.sqlite')))
 
         if (not os.path.exists(self.file_dest)):
             os.makedirs(self.file_dest, 0o700)
         dir1 = os.path.normpath(os.path.join(self.file_dest, self.novel_name))
         if (not os.path.exists(dir1)):
             os.makedirs(dir1, 0o700)
-
-        handler = logging.FileHandler(os.path.normpath(os.path.join(self.file_dest, self.novel_name, '%s_main_logfile.log'%self.novel_name)))
-        logging.getLogger(__name__).addHandler(handler)
-        self.main_logger = logging.getLogger(__name__)
-        self.main_logger.setLevel(logging.DEBUG)
+        self.chapter_index = ChapterIndex(dir1)
+        # chapter_no -> listing entry, so a chapter range resolves without reading the listing
+        self.toc = TableOfContents(os.path.join(dir1, 'toc.json'), ('chapter_no', 'href', 'file_name', 'page'))
+        # the chapter files on disk, shared by the conversions and the translations
+        self.catalog = ChapterCatalog(dir1, self._file_kind)
+        self.cleaner = ChapterCleaner.for_site('novelfull', style)
+        self.journal = CrawlJournal(os.path.join(dir1, 'crawl_journal.jsonl'))
+        # raw_archive=True keeps the fetched pages compressed in one archive instead of a (raw).html per chapter
+        self.raw_archive = RawArchive(os.path.join(dir1, 'raw_archive')) if raw_archive else None
+
+        self.main_logger = get_logger('%s.%s' % (__name__, self.novel_name), os.path.normpath(
+            os.path.join(self.file_dest, self.novel_name, '%s_main_logfile.log' % self.novel_name)))
 
     def read_by_chapter(self, first_chapter, last_chapter):
-        first_page = (first_chapter//50) if first_chapter % 50 == 0 else (first_chapter//50)+1
-        last_page = (last_chapter//50) if last_chapter % 50 == 0 else (last_chapter//50)+1
-        self._read_sub_page(first_page, first_chapter, direction='up')
-        if last_page - first_page >= 2:
-            self.read_by_page(first_page+1, last_page -1 )
-        if last_page > first_page:
-            self._read_sub_page(last_page, last_chapter, direction='down')
-
-    def _read_sub_page(self, page, anchor_chapter_no, direction):
-        total_size = {'raw_size': 0, 'clean_size': 0}
-        page_url = '%s/%s.html?page=%d' % (self.URL, self.novel_name, page)
-        page_req = Request(page_url, headers={'User-Agent': 'Mozilla/5.0'})
+        """The chapters come from the table of contents, the listing is only read when the range goes past its end."""
+        with self.journal:
+            if self.toc.last_chapter_no() < last_chapter:
+                self.refresh_toc()
+            chapters = [(entry['href'], entry['chapter_no'], entry['file_name'], entry['page'])
+                        for entry in self.toc.range(first_chapter, last_chapter)]
+            total_size = self._read_chapters(chapters)
+            self.chapter_index.save()
+            msg = '[[Total_Raw_Size:%(raw_size)d, Total_Clean_Size:%(clean_size)d]]' % total_size
+            self._log(msg, self.main_logger)
+            return msg
+
+    def refresh_toc(self, full=False):
+        """
+        Bring the table of contents up to date from the listing pages, starting at the page of its last chapter
+        (page 1 when it is empty or full=True) until an empty or short page, or a batch of pages without a chapter
+        not seen before (the site answers an out of range page with its last one). workers pages are read at a time.
+        """
+        page = 1 if full or not len(self.toc) else self.toc.get(self.toc.last_chapter_no())['page']
+        last_page = page
+        seen = set()
+        executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
         try:
-            with urlopen(page_req) as f1:
-                page_result = etree.HTML(f1.read())
-                sel = CSSSelector('#list-chapter')
-                list_chapter = sel(page_result)[0]
-                for a in list_chapter.iter('a'):
-                    chapter_href = a.get('href')
-                    if not self.CHAPTER_NO_RE.search(chapter_href):
-                        continue
-                    chapter_no = int(self.CHAPTER_NO_RE.search(chapter_href).group(1))
-                    if (direction == 'up' and chapter_no < anchor_chapter_no) or (direction == 'down' and chapter_no > anchor_chapter_no):
-                        continue
-                    chapter_title = a.get('title').strip()
-                    # for span in a:
-                    #     chapter_title = span.text.strip() or chapter_href.split('.')[0]
-                    file_name = self.CHAPTER_NO_RE.sub(r'%s%s' % ('Chapter_', str(chapter_no).rjust(5, '0')), chapter_title)
-                    file_name = self.FORBIDDEN_CHAR_RE.sub('', file_name)
-                    _, r, c = self._read_chapter(chapter_href, chapter_no, file_name)
-                    total_size['raw_size'] += r
-                    total_size['clean_size'] += c
+            while page <= self.MAX_TOC_PAGES:
+                pages = range(page, min(page + self.workers, self.MAX_TOC_PAGES + 1))
+                # the toc finds its own way back after a failure, its listing pages are not journaled
+                read_listing = lambda p: self._read_listing(p, journal=False)
+                listings = list(executor.map(read_listing, pages) if executor else map(read_listing, pages))
+                added = False
+                for listing_page, listing in zip(pages, listings):
+                    numbers = set(chapter[1] for chapter in listing) - seen
+                    if numbers:
+                        seen |= numbers
+                        last_page = listing_page
+                        added = True
+                if not added:
+                    break
+                short_listings = [listing for listing in listings if len(listing) < self.CHAPTERS_PER_PAGE]
+                if short_listings:
+                    break
+                page += self.workers
+            else:
+                self._log('toc: stopped at the %d pages limit' % self.MAX_TOC_PAGES, self.main_logger)
+        finally:
+            if executor:
+                executor.shutdown()
+        self.toc.save()
+        self._log('toc: %d chapters, last page %d' % (len(self.toc), last_page), self.main_logger)
+
+    def sync(self, full=False):
+        """
+        Fetch only the chapters missing since the last run: not in the chapter index, listed under another url
+        than the recorded one, or whose file is gone. The content of a chapter already fetched is not compared.
+        The table of contents is refreshed from its last page (or from page 1 when full=True), the clean files
+        on disk the chapter index does not know yet are indexed first.
+        """
+        with self.journal:
+            self._index_existing_files()
+            self.refresh_toc(full)
+            chapters = [(entry['href'], entry['chapter_no'], entry['file_name'], entry['page'])
+                        for entry in self.toc.range(1, self.toc.last_chapter_no())
+                        if self.chapter_index.needs_fetch(entry['chapter_no'], url='%s%s' % (self.URL, entry['href']))]
+            self._log('sync: %d listed, %d to fetch' % (len(self.toc), len(chapters)), self.main_logger)
+            total_size = self._read_chapters(chapters)
+            self.chapter_index.save()
+            msg = '[[Total_Raw_Size:%(raw_size)d, Total_Clean_Size:%(clean_size)d]]' % total_size
+            self._log(msg, self.main_logger)
+            return msg
+
+    def _index_existing_files(self):
+        """
+        Index the clean files the chapter index has no file for, e.g. downloaded before it existed or while it was
+        filled by read_by_chapter/clean_raw. Run on every sync, once indexed a file only costs a catalog lookup.
+        """
+        for entry in self.catalog.range(kind='clean'):
+            known = self.chapter_index.get(entry['chapter_no'])
+            if known and known.get('file') and known.get('status') == 'full':
+                continue
+            self.chapter_index.record_file(entry['chapter_no'], entry['clean'], status='full')
+        self.catalog.save()
+
+    def _file_kind(self, file_name):
+        """(chapter_no, 'clean' | 'raw' | 'translation') of a file of a bucket directory, None for the others."""
+        if not file_name.endswith('.html'):
+            return None
+        chapter_no_search = self.CHAPTER_NO_RE.search(file_name)
+        if not chapter_no_search:
+            return None
+        if file_name.endswith('(raw).html'):
+            return int(chapter_no_search.group(1)), 'raw'
+        if file_name.endswith('translation.html'):
+            return int(chapter_no_search.group(1)), 'translation'
+        return int(chapter_no_search.group(1)), 'clean'
 
+    def read_by_page(self, start_page, end_page):
+        with self.journal:
+            total_size = {'raw_size': 0, 'clean_size': 0}
+            pages = range(start_page, end_page + 1)
+            if self.workers == 1:
+                for page in pages:
+                    page_size = self._read_chapters(self._read_listing(page))
+                    total_size['raw_size'] += page_size['raw_size']
+                    total_size['clean_size'] += page_size['clean_size']
+            else:
+                # listing pages and chapters share one pool, chapters are queued as soon as their listing page arrives
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    listing_futures = [executor.submit(self._read_listing, page) for page in pages]
+                    chapter_futures = []
+                    for listing_future in as_completed(listing_futures):
+                        chapters = listing_future.result()
+                        self._plan_chapters(chapters)
+                        for chapter in chapters:
+                            chapter_futures.append(executor.submit(self._read_chapter, *chapter))
+                    for chapter_future in chapter_futures:
+                        self._add_chapter_size(total_size, chapter_future.result())
+            self.chapter_index.save()
+            self.toc.save()
+            msg = '[[Total_Raw_Size:%(raw_size)d, Total_Clean_Size:%(clean_size)d]]' % total_size
+            self._log(msg, self.main_logger)
+            self._log('http_pool:%s' % self.http_pool.stats(), self.main_logger)
+            self._log('metrics:\n%s' % metrics.summary(), self.main_logger)
+            return msg
+
+    def resume(self):
+        """Run again every listing page and chapter that the crawl journal still has as planned or failed."""
+        with self.journal:
+            chapters = {}
+            for _, args in self.journal.pending('listing:'):
+                for chapter in self._read_listing(*args):
+                    chapters[chapter[1]] = chapter
+            for _, args in self.journal.pending('chapter:'):
+                chapters.setdefault(args[1], tuple(args))
+            self._log('resume: %d chapters pending' % len(chapters), self.main_logger)
+            total_size = self._read_chapters([chapters[k] for k in sorted(chapters)])
+            self.chapter_index.save()
+            self.toc.save()
+            msg = '[[Total_Raw_Size:%(raw_size)d, Total_Clean_Size:%(clean_size)d]]' % total_size
+            self._log(msg, self.main_logger)
+            return msg
+
+    def _read_listing(self, page, anchor_chapter_no=None, direction=None, journal=True):
+        """Return the (chapter_href, chapter_no, file_name, page) entries of one listing page."""
+        chapters = []
+        page_url = '%s/%s.html?page=%d' % (self.URL, self.novel_name, page)
+        job = 'listing:%d:%s' % (page, direction or 'all')
+        if journal:
+            self.journal.plan(job, [page, anchor_chapter_no, direction])
+        try:
+            page_bytes = self._fetch(page_url)
+            with metrics.timer('parse'):
+                page_result = etree.HTML(page_bytes)
+            list_chapter = self.LIST_CHAPTER_SEL(page_result)[0]
+            listed = []
+            for a in list_chapter.iter('a'):
+                chapter_href = a.get('href')
+                chapter_no_search = self.CHAPTER_NO_RE.search(chapter_href or '')
+                if not chapter_no_search:
+                    continue
+                chapter_no = int(chapter_no_search.group(1))
+                chapter_title = a.get('title').strip()
+                # for span in a:
+                #     chapter_title = span.text.strip() or chapter_href.split('.')[0]
+                file_name = self.CHAPTER_NO_RE.sub(r'%s%s' % ('Chapter_', str(chapter_no).rjust(5, '0')), chapter_title)
+                file_name = self.FORBIDDEN_CHAR_RE.sub('', file_name)
+                listed.append((chapter_href, chapter_no, file_name, page))
+            # every listing read keeps the table of contents current, whatever part of the page is wanted
+            self.toc.update((no, href, file_name, page) for href, no, file_name, page in listed)
+            chapters = [chapter for chapter in listed
+                        if not (direction == 'up' and chapter[1] < anchor_chapter_no)
+                        and not (direction == 'down' and chapter[1] > anchor_chapter_no)]
+            if journal:
+                self.journal.done(job)
         except Exception as e:
             self._log_exception(e, self.main_logger)
-        msg = '[[Total_Raw_Size:%(raw_size)d, Total_Clean_Size:%(clean_size)d]]' % total_size
-        self._log(msg, self.main_logger)
-        return msg
+            if journal:
+                self.journal.failed(job, e)
+        return chapters
 
-    def read_by_page(self, start_page, end_page):
-        total_size = {'raw_size': 0, 'clean_size': 0}
-        for page in range(start_page, end_page + 1):
-            page_url = '%s/%s.html?page=%d' % (self.URL, self.novel_name, page)
-            page_req = Request(page_url, headers={'User-Agent': 'Mozilla/5.0'})
-            try:
-                with urlopen(page_req) as f1:
-                    page_result = etree.HTML(f1.read())
-                    sel = CSSSelector('#list-chapter')
-                    list_chapter = sel(page_result)[0]
-                    for a in list_chapter.iter('a'):
-                        chapter_href = a.get('href')
-                        if not self.CHAPTER_NO_RE.search(chapter_href):
-                            continue
-                        chapter_no = int(self.CHAPTER_NO_RE.search(chapter_href).group(1))
-                        chapter_title = a.get('title').strip()
-                        # for span in a:
-                        #     chapter_title = span.text.strip() or chapter_href.split('.')[0]
-                        file_name = self.CHAPTER_NO_RE.sub(r'%s%s' % ('Chapter_', str(chapter_no).rjust(5, '0')), chapter_title)
-                        file_name = self.FORBIDDEN_CHAR_RE.sub('', file_name)
-                        _, r, c = self._read_chapter(chapter_href, chapter_no, file_name)
-                        total_size['raw_size'] += r
-                        total_size['clean_size'] += c
-
-            except Exception as e:
-                self._log_exception(e, self.main_logger)
-        msg = '[[Total_Raw_Size:%(raw_size)d, Total_Clean_Size:%(clean_size)d]]' % total_size
-        self._log(msg, self.main_logger)
-        return msg
+    def _plan_chapters(self, chapters):
+        self.journal.plan_many([('chapter:%d' % chapter[1], list(chapter)) for chapter in chapters])
 
-    def _read_chapter(self, chapter_href, chapter_no, file_name):
+    def _read_chapters(self, chapters):
+        total_size = {'raw_size': 0, 'clean_size': 0}
+        self._plan_chapters(chapters)
+        if self.workers == 1:
+            results = (self._read_chapter(*chapter) for chapter in chapters)
+            for result in results:
+                self._add_chapter_size(total_size, result)
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for result in executor.map(lambda chapter: self._read_chapter(*chapter), chapters):
+                    self._add_chapter_size(total_size, result)
+        return total_size
+
+    def _add_chapter_size(self, total_size, result):
+        # a failed chapter returns None, it has already been logged by _read_chapter
+        if not result:
+            return
+        _, r, c = result
+        total_size['raw_size'] += r
+        total_size['clean_size'] += c
+
+    def _read_chapter(self, chapter_href, chapter_no, file_name, page=None):
         chapter_url = '%s%s' % (self.URL, chapter_href)
-        chapter_req = Request(chapter_url, headers={'User-Agent': 'Mozilla/5.0'})
         try:
-            with urlopen(chapter_req) as f1:
-                chapter_result = etree.HTML(f1.read())
-                return self._process_raw(chapter_result, chapter_no, file_name, chapter_url)
+            raw_bytes = self._fetch(chapter_url)
+            with metrics.timer('parse'):
+                chapter_result = etree.HTML(raw_bytes)
+            result = self._process_raw(chapter_result, chapter_no, file_name, chapter_url, raw_bytes)
+            self.chapter_index.record(chapter_no, page=page)
+            self.journal.done('chapter:%d' % chapter_no)
+            return result
         except Exception as e:
             self._log_exception(e, self.main_logger)
-
-    def clean_raw(self, sub_dir='raw', filter_not_raw=False):
+            self.journal.failed('chapter:%d' % chapter_no, e)
+
+    def _fetch(self, url):
+        host = parse.urlsplit(url).netloc
+        with self._host_semaphores_lock:
+            semaphore = self._host_semaphores.setdefault(host, threading.BoundedSemaphore(self.per_host_limit))
+        with semaphore:
+            return self.http_pool.request('GET', url, cache=self.http_cache).data
+
+    def clean_raw(self, sub_dir='raw', filter_not_raw=False, workers=1, from_archive=None):
+        """
+        Re-clean the raw chapter pages under sub_dir (recursively) into the bucket directories.
+        The raw copy is only rewritten when it changed and a clean file only when its content hash differs.
+        from_archive (by default when the reader has a raw archive) reads the pages from the archive instead,
+        in segment order.
+        With workers > 1 the files are sharded over a process pool, the per-worker throughput is logged and returned.
+        """
         chapter_no_re = re.compile(r'chapter[\s*\-_]*(\d+)([\s\S]+)', re.I)
         filter_re = re.compile(r'(\(raw\)\.html)|(\.log)')
         raw_dir = os.path.normpath(os.path.join(self.file_dest, self.novel_name, sub_dir))
+        if from_archive is None:
+            from_archive = self.raw_archive is not None
+        if from_archive and self.raw_archive is None:
+            raise Exception('clean_raw(from_archive=True) needs a reader created with raw_archive=True')
+        files = []
         try:
-            for file in os.listdir(raw_dir):
-                if os.path.isdir(os.path.join(raw_dir, file)):
-                    self.clean_raw(os.path.join(sub_dir, file), filter_not_raw)
-                if not (os.path.isfile(os.path.join(raw_dir, file)) and chapter_no_re.search(file)):
-                    continue
-                if filter_not_raw and not filter_re.search(file):
-                    continue
-                chapter_no_search = chapter_no_re.search(file)
-                chapter_no = chapter_no_search.group(1)
-                clean_file_name = 'Chapter_%s %s' % (chapter_no.rjust(5,'0'), chapter_no_search.group(2))
-                clean_file_name = self.FORBIDDEN_CHAR_RE.sub(' ', clean_file_name)
-                clean_file_name = filter_re.sub('', clean_file_name)
-                # clean_file_name = clean_file_name.rsplit('.', 1)[0]
-                full_raw_file_name = os.path.join(raw_dir, file)
-                with open(full_raw_file_name) as f1:
-                    raw_material = etree.HTML(f1.read())
-                    self._process_raw(raw_material, int(chapter_no), clean_file_name)
+            if from_archive:
+                files = [(location, meta['chapter_no'], meta['file_name'], meta.get('url', ''))
+                         for _, meta, location in self.raw_archive.entries('chapter:')]
+            else:
+                for dir_path, _, dir_files in os.walk(raw_dir):
+                    for file in dir_files:
+                        if not chapter_no_re.search(file):
+                            continue
+                        if filter_not_raw and not filter_re.search(file):
+                            continue
+                        chapter_no_search = chapter_no_re.search(file)
+                        chapter_no = chapter_no_search.group(1)
+                        clean_file_name = 'Chapter_%s %s' % (chapter_no.rjust(5,'0'), chapter_no_search.group(2))
+                        clean_file_name = self.FORBIDDEN_CHAR_RE.sub(' ', clean_file_name)
+                        clean_file_name = filter_re.sub('', clean_file_name)
+                        # clean_file_name = clean_file_name.rsplit('.', 1)[0]
+                        files.append((os.path.join(dir_path, file), int(chapter_no), clean_file_name, ''))
         except Exception as e:
             self._log_exception(e, self.main_logger)
 
-    def _process_raw(self, raw_material, chapter_no, file_name, chapter_url=''):
-        sel = CSSSelector('#chapter-content')
-        chapter_content = sel(raw_material)[0]
-
+        novel_dir = os.path.normpath(os.path.join(self.file_dest, self.novel_name))
+        archive_dir = self.raw_archive.path if from_archive else None
+        if not from_archive:
+            files.sort()
+        if workers > 1:
+            # a few shards per worker, so one slow shard does not leave the other workers idle,
+            # contiguous so each worker reads its part of the archive sequentially
+            shard_count = min(len(files), workers * 4) or 1
+            shard_size = -(-len(files) // shard_count) or 1
+            shards = [files[i:i + shard_size] for i in range(0, len(files), shard_size)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(clean_raw_files, [novel_dir] * len(shards), shards,
+                                            [self.cleaner.rules] * len(shards), [archive_dir] * len(shards)))
+        else:
+            results = [clean_raw_files(novel_dir, files, self.cleaner.rules, archive_dir)]
+
+        worker_stats = {}
+        for stats, records in results:
+            for chapter_no, fields in records:
+                self.chapter_index.record(chapter_no, **fields)
+            metrics.merge(stats.pop('metrics'))
+            for full_raw_file_name, error in stats.pop('errors'):
+                self._log_exception('%s: %s' % (full_raw_file_name, error), self.main_logger)
+            total = worker_stats.setdefault(stats['pid'], dict.fromkeys(stats, 0))
+            for k, v in stats.items():
+                total[k] = v if k == 'pid' else total[k] + v
+        self.chapter_index.save()
+
+        for stats in worker_stats.values():
+            stats['files_per_s'] = round(stats['files'] / stats['seconds'], 1) if stats['seconds'] else 0.0
+            stats['mb_per_s'] = round(stats['bytes_read'] / 1048576 / stats['seconds'], 2) if stats['seconds'] else 0.0
+            msg = 'clean_raw worker %(pid)d: files:%(files)d, clean_written:%(clean_written)d, ' \
+                  'raw_written:%(raw_written)d, %(files_per_s).1f files/s, %(mb_per_s).2f MB/s' % stats
+            self._log(msg, self.main_logger)
+        return list(worker_stats.values())
+
+    def _process_raw(self, raw_material, chapter_no, file_name, chapter_url='', raw_bytes=None):
+        raw_content, clean_content = self._clean_chapter(raw_material, file_name, chapter_url, raw_bytes)
+        return self._write_chapter(chapter_no, file_name, chapter_url, raw_bytes, raw_content, clean_content)[:3]
+
+    def _clean_chapter(self, raw_material, file_name, chapter_url='', raw_bytes=None):
+        """(raw page to write, None when it goes to the raw archive, clean page) of a parsed chapter."""
+        raw_content = None
+        if self.raw_archive is None or raw_bytes is None:
+            raw_content = etree.tostring(raw_material, pretty_print=True, method="html")
+        with metrics.timer('clean'):
+            clean_content = self.cleaner.clean(raw_material, file_name, chapter_url)
+        return raw_content, clean_content
+
+    def _write_chapter(self, chapter_no, file_name, chapter_url, raw_bytes, raw_content, clean_content):
         dir1 = os.path.normpath(os.path.join(self.file_dest, self.novel_name))
-        if (not os.path.exists(dir1)):
-            os.makedirs(dir1, 0o700)
-        dir2 = str((chapter_no // 100) * 100).rjust(5, '0')
-        dir2 = os.path.normpath(os.path.join(dir1, dir2))
-        if (not os.path.exists(dir2)):
-            os.makedirs(dir2, 0o700)
-        full_file_name_raw = os.path.join(dir2, '%s%s' % (file_name, '(raw).html'))
-        with open(full_file_name_raw, "wb") as f2:
-            raw_size = f2.write(etree.tostring(raw_material, pretty_print=True, method="html"))
-
-        for script in chapter_content.iter('script'):
-            s_parent = script.getparent()
-            s_parent.remove(script)
-        google_sel = CSSSelector('.google-auto-placed, .ads, .ads-holder')
-        google_contents = google_sel(chapter_content)
-        for google_content in google_contents:
-            google_content_parent = google_content.getparent()
-            google_content_parent.remove(google_content)
-        for ins in chapter_content.iter('ins'):
-            i_parent = ins.getparent()
-            i_parent.remove(ins)
-
-        gen_html = html_builder.HTML(
-            html_builder.HEAD(html_builder.TITLE(file_name), html_builder.STYLE(style)),
-            html_builder.BODY(chapter_content,
-                              html_builder.DIV(
-                                  html_builder.CLASS("end"),
-                                  html_builder.P('The End...'),
-                                  html_builder.A(chapter_url, href=chapter_url))
-                              ))
-        # gen_html = builder.E.html(builder.E.head(builder.E.title(file_name)))
-        # gen_html.append(builder.E.body(chapter_content))
-        full_file_name = os.path.join(dir2, '%s%s' % (file_name, '.html'))
-        with open(full_file_name, "wb") as f3:
-            clean_size = f3.write(etree.tostring(gen_html, pretty_print=True, method="html"))
+        dir2 = chapter_dir(dir1, chapter_no)
+        with metrics.timer('write'):
+            if raw_content is None:
+                self.raw_archive.put('chapter:%d' % chapter_no, raw_bytes, chapter_no=chapter_no,
+                                     file_name=file_name, url=chapter_url)
+                raw_size = len(raw_bytes)
+            else:
+                full_file_name_raw = os.path.join(dir2, '%s%s' % (file_name, '(raw).html'))
+                raw_size = atomic_write(full_file_name_raw, raw_content)
+            full_file_name = os.path.join(dir2, '%s%s' % (file_name, '.html'))
+            clean_size = atomic_write(full_file_name, clean_content)
+        metrics.add_bytes('write', raw_size + clean_size)
+        self.chapter_index.record(chapter_no, url=chapter_url or None, file=os.path.relpath(full_file_name, dir1),
+                                  raw_size=raw_size, clean_size=clean_size, content_hash=content_hash(clean_content),
+                                  status='full')
 
         msg = 'file_name:%s,raw_size:%d,clean_size:%d,timestamp:%s' % (
         file_name, raw_size, clean_size, f'{datetime.now()}')
         self._log(msg, self.main_logger)
-        return file_name, raw_size, clean_size
+        return file_name, raw_size, clean_size, full_file_name
 
-    def convert_to_pdf(self, dest_dir, starting_dir= 0, starting_chapter= 1, ending_chapter=100000):
+    def convert_to_pdf(self, dest_dir, starting_dir= 0, starting_chapter= 1, ending_chapter=100000, workers=1,
+                       timeout=None, force=False, renderer='process', batch_size=50):
+        """renderer='batch' feeds each wkhtmltopdf process batch_size chapters instead of starting one per chapter."""
         if not dest_dir: raise Exception('dest_dir is required')
-        filter_re = re.compile(r'(\(raw\)\.html)|(\.log)')
-        sub_dir_no_re = re.compile(r'(\d+)')
         full_dest = os.path.normpath(os.path.join(dest_dir, self.novel_name))
         if not os.path.exists(full_dest):
             os.makedirs(full_dest, 0o700)
 
-        source_dir = os.path.normpath(os.path.join(self.file_dest, self.novel_name))
+        jobs = []
+        sub_dir = None
         try:
-            for sub_dir in os.listdir(source_dir):
-                if sub_dir.endswith('.log') or not sub_dir_no_re.search(sub_dir): continue
-                sub_dir_no = int(sub_dir_no_re.search(sub_dir).group(1))
-                dest_sub_dir = os.path.join(full_dest, sub_dir)
-                if not os.path.exists(dest_sub_dir):
-                    os.makedirs(dest_sub_dir, 0o700)
-                print('start sub-dir %s' % sub_dir)
-                for file in os.listdir(os.path.join(source_dir, sub_dir)):
-                    if filter_re.search(file): continue
-                    chapter_no = int(self.CHAPTER_NO_RE.search(file).group(1))
-                    if sub_dir_no < starting_dir or chapter_no < starting_chapter or chapter_no > ending_chapter: continue
-                    full_source_file = os.path.join(source_dir, sub_dir, file)
-                    full_dest_file = os.path.join(dest_sub_dir, file.replace('.html', '.pdf'))
-                    command = ['wkhtmltopdf', full_source_file, full_dest_file]
-                    try:
-                        # wkhtmltopdf_process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-                        completed_process = run(command, stdout=PIPE)
-                        completed_process.check_returncode() # If returncode is non - zero, raise a CalledProcessError.
-                        # for m, n in getmembers(completed_process, lambda m1: not callable(m1)):
-                        #     print('%s => %s' % (str(m), str(n)))
-                    except Exception as e:
-                        self._log_exception(e, self.main_logger)
+            for entry in self.catalog.range(starting_chapter, ending_chapter):
+                if int(entry['bucket']) < starting_dir: continue
+                dest_sub_dir = os.path.join(full_dest, entry['bucket'])
+                if entry['bucket'] != sub_dir:
+                    sub_dir = entry['bucket']
+                    print('start sub-dir %s' % sub_dir)
+                    os.makedirs(dest_sub_dir, 0o700, exist_ok=True)
+                for full_source_file in (entry['clean'], entry['translation']):
+                    if not full_source_file: continue
+                    full_dest_file = os.path.join(dest_sub_dir, os.path.basename(full_source_file)[:-5] + '.pdf')
+                    jobs.append((full_source_file, full_dest_file))
+            self.catalog.save()
         except Exception as e:
             self._log_exception(e, self.main_logger)
 
+        converter = make_converter(renderer, workers=workers, timeout=timeout, force=force, batch_size=batch_size)
+        summary = converter.convert(jobs)
+        msg = format_summary(summary)
+        print(msg)
+        self._log(msg, self.main_logger)
+        return summary
+
+    def convert_bundle(self, dest_dir, starting_chapter=1, ending_chapter=100000, fmt='pdf', bundle_size=100,
+                       ranges=None, workers=1, timeout=None, force=False):
+        """
+        One pdf/epub/html per `bundle_size` chapters (by default the 100-chapter bucket directories),
+        or per (first, last) chapter range in `ranges`, instead of one pdf per chapter.
+        """
+        if not dest_dir: raise Exception('dest_dir is required')
+        full_dest = os.path.normpath(os.path.join(dest_dir, self.novel_name))
+        if not os.path.exists(full_dest):
+            os.makedirs(full_dest, 0o700)
+        summary = bundler.bundle(self._list_chapter_files(starting_chapter, ending_chapter), full_dest, self.novel_name,
+                                 fmt=fmt, bundle_size=bundle_size, ranges=ranges, style=style, workers=workers,
+                                 timeout=timeout, force=force)
+        msg = format_summary(summary)
+        print(msg)
+        self._log(msg, self.main_logger)
+        return summary
+
+    def read_and_convert(self, dest_dir, first_chapter=1, last_chapter=100000, fmt='pdf', bundle_size=None,
+                         clean_workers=2, convert_workers=2, queue_size=16, timeout=None, force=False):
+        """
+        Fetch, clean, write and convert a chapter range in one pass, the stages running at the same time:
+        chapters are converted while later ones are still downloading. `workers` chapters are fetched at a time,
+        the chapters already up to date are only converted.
+        fmt='pdf' without bundle_size converts every chapter like convert_to_pdf, with bundle_size the chapters
+        are bundled like convert_bundle, a bundle as soon as its last chapter is written.
+        At most queue_size chapters wait between two stages, whatever the size of the range.
+        """
+        with self.journal:
+            if not dest_dir: raise Exception('dest_dir is required')
+            if bundle_size is None and fmt != 'pdf': raise Exception('%s is only written in bundles' % fmt)
+            full_dest = os.path.normpath(os.path.join(dest_dir, self.novel_name))
+            os.makedirs(full_dest, 0o700, exist_ok=True)
+            dir1 = os.path.normpath(os.path.join(self.file_dest, self.novel_name))
+            if self.toc.last_chapter_no() < last_chapter:
+                self.refresh_toc()
+            chapters = [(entry['href'], entry['chapter_no'], entry['file_name'], entry['page'])
+                        for entry in self.toc.range(first_chapter, last_chapter)]
+            stale = {chapter[1] for chapter in chapters
+                     if self.chapter_index.needs_fetch(chapter[1], url='%s%s' % (self.URL, chapter[0]))}
+            self._plan_chapters([chapter for chapter in chapters if chapter[1] in stale])
+
+            def fetch(chapter):
+                chapter_href, chapter_no, file_name, page = chapter
+                if chapter_no not in stale:
+                    return {'chapter': chapter, 'file': os.path.join(dir1, self.chapter_index.get(chapter_no)['file'])}
+                return {'chapter': chapter, 'raw_bytes': self._fetch('%s%s' % (self.URL, chapter_href))}
+
+            def clean(item):
+                if 'file' not in item:
+                    with metrics.timer('parse'):
+                        raw_material = etree.HTML(item['raw_bytes'])
+                    item['raw_content'], item['clean_content'] = self._clean_chapter(
+                        raw_material, item['chapter'][2], '%s%s' % (self.URL, item['chapter'][0]), item['raw_bytes'])
+                return item
+
+            def write(item):
+                chapter_href, chapter_no, file_name, page = item['chapter']
+                if 'file' not in item:
+                    item['file'] = self._write_chapter(chapter_no, file_name, '%s%s' % (self.URL, chapter_href),
+                                                       item['raw_bytes'], item['raw_content'], item['clean_content'])[3]
+                    self.chapter_index.record(chapter_no, page=page)
+                    self.journal.done('chapter:%d' % chapter_no)
+                # only the file goes on, the pages are not kept in memory past this stage
+                return chapter_no, item['file'], os.path.basename(item['file'])[:-5]
+
+            converter = PdfConverter(timeout=timeout, force=force)
+            buckets = {bundle_range: {chapter[0] for chapter in bundle_chapters} for bundle_range, bundle_chapters
+                       in bundler.group_chapters([(chapter[1],) for chapter in chapters], bundle_size or 100).items()}
+            written = {}
+            buckets_lock = threading.Lock()
+
+            def convert(chapter):
+                chapter_no, path, title = chapter
+                if bundle_size is None:
+                    dest_sub_dir = os.path.join(full_dest, os.path.basename(os.path.dirname(path)))
+                    os.makedirs(dest_sub_dir, 0o700, exist_ok=True)
+                    return converter.convert([(path, os.path.join(dest_sub_dir, '%s.pdf' % title))])
+                with buckets_lock:
+                    bundle_range = next(r for r in buckets if r[0] <= chapter_no <= r[1])
+                    written.setdefault(bundle_range, []).append(chapter)
+                    buckets[bundle_range].discard(chapter_no)
+                    if buckets[bundle_range]:
+                        return None
+                    bundle_chapters = sorted(written.pop(bundle_range))
+                return bundler.bundle(bundle_chapters, full_dest, self.novel_name, fmt=fmt, bundle_size=bundle_size,
+                                      style=style, timeout=timeout, force=force)
+
+            def convert_rest():
+                # the bundles some chapters of which failed, with the chapters that made it
+                return [bundler.bundle(sorted(bundle_chapters), full_dest, self.novel_name, fmt=fmt,
+                                       bundle_size=bundle_size, style=style, timeout=timeout, force=force)
+                        for bundle_chapters in written.values()]
+
+            def on_error(stage, item, e):
+                chapter = item['chapter'] if isinstance(item, dict) else item
+                self._log_exception('%s %s: %s' % (stage, chapter and chapter[1], e), self.main_logger)
+                if stage == 'convert' or chapter is None:
+                    return
+                self.journal.failed('chapter:%d' % chapter[1], e)
+                with buckets_lock:
+                    for chapter_nos in buckets.values():
+                        chapter_nos.discard(chapter[1])
+
+            pipeline = Pipeline([Stage('fetch', fetch, self.workers), Stage('clean', clean, clean_workers),
+                                 Stage('write', write), Stage('convert', convert, convert_workers, convert_rest)],
+                                queue_size=queue_size, on_error=on_error)
+            summary = {'converted': 0, 'skipped': 0, 'failed': []}
+            for result in pipeline.run(chapters):
+                summary['converted'] += result['converted']
+                summary['skipped'] += result['skipped']
+                summary['failed'].extend(result['failed'])
+            self.chapter_index.save()
+            summary['fetched'] = len(stale)
+            summary['pipeline'] = pipeline.stats()
+            msg = format_summary(summary)
+            print(msg)
+            self._log(msg, self.main_logger)
+            self._log('pipeline:%s' % summary['pipeline'], self.main_logger)
+            return summary
+
+    def _list_chapter_files(self, starting_chapter=1, ending_chapter=100000):
+        """Sorted (chapter_no, full_path, title) of the clean chapter files in the range."""
+        chapters = [(entry['chapter_no'], entry['clean'], os.path.basename(entry['clean'])[:-5])
+                    for entry in self.catalog.range(starting_chapter, ending_chapter, kind='clean')]
+        self.catalog.save()
+        return chapters
+
     ##Tanslations
 
+    def _get_translation_store(self):
+        """The word translations store, created from translations_mini.json the first time."""
+        if self._translation_store is None:
+            full_dest = os.path.normpath(os.path.join(self.file_dest, 'translation'))
+            store_file = os.path.join(full_dest, 'translations_store.jsonl')
+            is_new = not os.path.exists(store_file)
+            self._translation_store = TranslationStore(store_file)
+            if is_new and os.path.exists(os.path.join(full_dest, 'translations_mini.json')):
+                self._translation_store.import_json(os.path.join(full_dest, 'translations_mini.json'))
+        return self._translation_store
+
     def humanize_translations(self):
-        global translations
         full_dest = os.path.normpath(os.path.join(self.file_dest, 'translation'))
         try:
-            with open(os.path.join(full_dest, 'translations_mini.json'), 'rt') as f1:
-                file_content1 = f1.read()
-                translations = json.loads(file_content1) if file_content1 else {}
-
-            translated_file = os.path.join(full_dest, 'translations_humanized.json')
-            with open(translated_file, 'wt') as f3:
-                f3.write(json.dumps(translations, indent=1))
-
-            import codecs
-            # opens a file and converts input to true Unicode
-            with codecs.open(os.path.join(full_dest, 'translations_humanized.json'), "rb", "unicode_escape") as my_input:
-                contents = my_input.read()
-                # type(contents) = unicode
-            # opens a file with UTF-8 encoding
-            with codecs.open(os.path.join(full_dest, 'translations_humanized.json'), "wb", "utf8") as my_output:
-                my_output.write(contents)
+            # ensure_ascii=False writes the arabic text itself instead of \u escapes
+            self._get_translation_store().export_json(os.path.join(full_dest, 'translations_humanized.json'),
+                                                      indent=1, ensure_ascii=False)
         except Exception as e:
             self._log_exception(e, self.main_logger)
 
     def merge_translations(self):
-        global translations
         full_dest = os.path.normpath(os.path.join(self.file_dest, 'translation'))
         try:
-            if os.path.exists(os.path.join(full_dest, 'translations_mini.json')):
-                with open(os.path.join(full_dest, 'translations_mini.json'), 'rt') as f1:
-                    file_content1 = f1.read()
-                    translations = json.loads(file_content1) if file_content1 else {}
+            store = self._get_translation_store()
+            # one *_translation.json file in memory at a time
             for file in os.listdir(full_dest):
                 if not file.endswith('_translation.json'): continue
-                with open(os.path.join(full_dest, file), 'rt') as f2:
-                    file_content2 = f2.read()
-                    file_content2 = json.loads(file_content2) if file_content2 else {}
-                    for k in file_content2:
-                        if not translations.get(k):
-                            translations[k] = file_content2[k]
-            # for ke in translations:
-            #     translations[ke] = eval(translations[ke])
+                store.import_json(os.path.join(full_dest, file))
+            if store.stale_ratio() > 0.5:
+                store.compact()
             translated_file = os.path.join(full_dest, 'translations_mini.json')
-            with open(translated_file, 'wt') as f3:
-                f3.write(json.dumps(translations))
-                self._log('Total merged words are: %d' % len(translations), self.main_logger)
+            total = store.export_json(translated_file)
+            self._log('Total merged words are: %d' % total, self.main_logger)
         except Exception as e:
             self._log_exception(e, self.main_logger)
 
@@ -303,13 +717,8 @@ class NovelFullReader:
         empty_words = set()
         full_dest = os.path.normpath(os.path.join(self.file_dest, 'translation'))
         try:
-            if os.path.exists(os.path.join(full_dest, 'translations_mini.json')):
-                with open(os.path.join(full_dest, 'translations_mini.json'), 'rt') as f1:
-                    file_content1 = f1.read()
-                    global translations
-                    translations = json.loads(file_content1) if file_content1 else {}
-            for k in list(translations.keys()):
-                entry = translations[k][0]
+            for k, v in self._get_translation_store().items():
+                entry = v[0]
                 if not entry['translations']:
                     print('Empty : %s' % k)
                     empty_words.add(k)
@@ -320,19 +729,19 @@ class NovelFullReader:
         except Exception as e:
             self._log_exception(e, self.main_logger)
 
-    def translate_by_word(self, starting_chapter= 1, ending_chapter=100000):
-        filter_re = re.compile(r'(\(raw\)\.html)|(\.log)')
-        sub_dir_no_re = re.compile(r'(\d+)')
+    def translate_by_word(self, starting_chapter= 1, ending_chapter=100000, workers=1, vocabulary_workers=None):
+        """
+        Look up every distinct word of the chapter range that has no translation yet, the most frequent first.
+        The words come from the novel's vocabulary index: only the chapters that are new or changed since the last run
+        are read (on a process pool of vocabulary_workers, by default workers), and the lookups are sent several words
+        per request on `workers` threads.
+        vocabulary_workers=0 leaves the vocabulary as it is, e.g. brought up to date by update_vocabulary() already.
+        """
         full_dest = os.path.normpath(os.path.join(self.file_dest, 'translation'))
         if not os.path.exists(full_dest):
             os.makedirs(full_dest, 0o700)
+        translations = self._get_translation_store()
         try:
-            if os.path.exists(os.path.join(full_dest, 'translations_mini.json')):
-                with open(os.path.join(full_dest, 'translations_mini.json'), 'rt') as f1:
-                    file_content1 = f1.read()
-                    global translations
-                    translations = json.loads(file_content1) if file_content1 else {}
-
             if os.path.exists(os.path.join(full_dest, 'not_translated_word.json')):
                 with open(os.path.join(full_dest, 'not_translated_word.json'), 'rt') as f2:
                     file_content2 = f2.read()
@@ -341,157 +750,167 @@ class NovelFullReader:
         except Exception as e:
             self._log_exception(e, self.main_logger)
 
-        source_dir = os.path.normpath(os.path.join(self.file_dest, self.novel_name))
+        executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
         try:
-            for sub_dir in os.listdir(source_dir):
-                if sub_dir.endswith('.log') or not sub_dir_no_re.search(sub_dir): continue
-                print('start sub-dir %s' % sub_dir)
-                for file in os.listdir(os.path.join(source_dir, sub_dir)):
-                    if filter_re.search(file): continue
-                    chapter_no = int(self.CHAPTER_NO_RE.search(file).group(1))
-                    if chapter_no < starting_chapter or chapter_no > ending_chapter: continue
-                    full_source_file = os.path.join(source_dir, sub_dir, file)
-                    try:
-                        with open(full_source_file) as f1:
-                            content = etree.HTML(f1.read())
-                            for p in content.iter('p'):
-                                p_text = p.text and p.text.strip()
-                                if not p_text: continue
-                                p_text = filter(lambda t: len(t)>2, self.CLEAN_TEXT_SPLITTER_RE.split(p_text))
-                                for text in p_text:
-                                    text = text.lower()
-                                    print('looking into : %s'%text)
-                                    if text in not_translated_words or translations.get(text) or text.isdigit(): continue
-                                    print('Translating  : %s' % text)
-                                    translate = self._microsoft_translate_word(text)
-                                    translations[text] = translate
-                    except Exception as e:
-                        self._log_exception(e, self.main_logger)
-                        self._dump_translation(full_dest)
-
+            chapters, scanned = self.update_vocabulary(starting_chapter, ending_chapter,
+                                                       workers if vocabulary_workers is None else vocabulary_workers)
+            frequencies = self._get_vocabulary().frequencies(starting_chapter, ending_chapter)
+            words = [word for word, _ in frequencies.most_common()
+                     if word not in not_translated_words and not (word in translations and translations.get(word))]
+            msg = 'translate_by_word: %d chapters (%d scanned), %d distinct words, %d to look up' % (
+                chapters, scanned, len(frequencies), len(words))
+            print(msg)
+            self._log(msg, self.main_logger)
+
+            # in rounds, so an interrupted run keeps what it has looked up
+            for i in range(0, len(words), self.WORDS_PER_ROUND):
+                round_words = words[i:i + self.WORDS_PER_ROUND]
+                for word, translate in zip(round_words, self._microsoft_translate_words(round_words, executor)):
+                    translations.put(word, translate)
+                translations.flush()
         except Exception as e:
             self._log_exception(e, self.main_logger)
-            self._dump_translation(full_dest)
+        finally:
+            if executor:
+                executor.shutdown()
         self._dump_translation(full_dest)
 
+    def update_vocabulary(self, starting_chapter=1, ending_chapter=100000, workers=1):
+        """
+        Read the clean chapters of the range that are new or changed into the vocabulary index, on a process pool
+        with workers > 1. workers=0 only counts them. Returns (chapters in the range, chapters read).
+        """
+        files = [(entry['chapter_no'], entry['clean'])
+                 for entry in self.catalog.range(starting_chapter, ending_chapter, kind='clean')]
+        self.catalog.save()
+        if not workers:
+            return len(files), 0
+        vocabulary = self._get_vocabulary()
+        with metrics.timer('vocabulary'):
+            scanned = vocabulary.update(files, workers)
+        vocabulary.save()
+        return len(files), scanned
+
+    def _get_vocabulary(self):
+        if self._vocabulary is None:
+            self._vocabulary = VocabularyIndex(
+                os.path.normpath(os.path.join(self.file_dest, self.novel_name, 'vocabulary.json')))
+        return self._vocabulary
+
     def _dump_translation(self, dest):
+        # every translated word is already in the store, only the not translated words are rewritten
+        translations = self._get_translation_store()
+        translations.flush()
         self._log('the total of Translations = %d' % len(translations), self.main_logger)
         self._log('the total of not_translated_words = %d' % len(not_translated_words), self.main_logger)
-        translation_file = os.path.join(dest, '%s_%s_%s' % (f'{datetime.now()}'.replace(':','.'), self.novel_name, 'translation.json'))
         not_translated_file = os.path.join(dest, 'not_translated_word.json')
-        with open(translation_file, 'wt') as f1:
-            f1.write(json.dumps(translations, indent=1))
         with open(not_translated_file, 'wt') as f2:
             f2.write(json.dumps(list(not_translated_words), indent=1))
 
-    def translate_py_chapter(self, starting_chapter= 1, ending_chapter=100000):
-        filter_re = re.compile(r'(\(raw\)\.html)|(\.log)')
-        sub_dir_no_re = re.compile(r'(\d+)')
+    def translate_py_chapter(self, starting_chapter= 1, ending_chapter=100000, workers=1, chapters_per_round=20):
+        """
+        Write <chapter>_translation.html with each paragraph followed by its translation.
+        The paragraphs of `chapters_per_round` chapters are packed into as few translator requests as the api limits
+        allow, and with workers > 1 those requests are sent concurrently.
+        """
         full_dest = os.path.normpath(os.path.join(self.file_dest, 'translation'))
         if not os.path.exists(full_dest):
             os.makedirs(full_dest, 0o700)
 
-        source_dir = os.path.normpath(os.path.join(self.file_dest, self.novel_name))
+        source_files = []
         try:
-            for sub_dir in os.listdir(source_dir):
-                if sub_dir.endswith('.log') or not sub_dir_no_re.search(sub_dir): continue
-                print('start sub-dir %s' % sub_dir)
-                for file in os.listdir(os.path.join(source_dir, sub_dir)):
-                    if filter_re.search(file): continue
-                    chapter_no = int(self.CHAPTER_NO_RE.search(file).group(1))
-                    if chapter_no < starting_chapter or chapter_no > ending_chapter: continue
-                    full_source_file = os.path.join(source_dir, sub_dir, file)
-                    try:
-                        chapter_translations = {}
-                        with open(full_source_file) as f1:
-                            content = etree.HTML(f1.read())
-                            # content_translated = content.copy
-                            for index, p in enumerate(content.iter('p')):
-                                p_text = p.text and p.text.strip()
-                                if p.find('p') or not p_text: continue
-                                p_text = p_text.replace("'", '').replace('"', '')
-                                print(p_text)
-                                chapter_translations[index] = self._microsoft_translate_text(p_text)
-                                translation = chapter_translations[index] and\
-                                              chapter_translations[index][0]['translations'] and\
-                                              chapter_translations[index][0]['translations'][0].get('text')
-                                p.addnext(html_builder.P(translation))
-                                print(translation)
-                                # p_text = filter(lambda t: len(t)>2, self.CLEAN_TEXT_SPLITTER_RE.split(p_text))
-                                # for text in p_text:
-                                #     text = text.lower()
-                                #     print('looking into : %s'%text)
-                                #     if text in not_translated_words or translations.get(text) or text.isdigit(): continue
-                                #     print('Translating  : %s' % text)
-                                #     translate = self._microsoft_translate(text)
-                                #     translations[text] = translate
-                        # with open('%s_%s' % (full_source_file[:-5], 'translation.json'), 'wt') as f2:
-                        #     f2.write(json.dumps(chapter_translations, indent=1))
-                        with open('%s_%s' % (full_source_file[:-5], 'translation.html'), 'wb') as f3:
-                            f3.write(html.tostring(content, pretty_print=True, method="html"))
-                    except Exception as e:
-                        self._log_exception(e, self.main_logger)
+            source_files = [entry['clean'] for entry in self.catalog.range(starting_chapter, ending_chapter, kind='clean')]
+            self.catalog.save()
         except Exception as e:
             self._log_exception(e, self.main_logger)
 
-    def _microsoft_translate_word(self, word):
-        import http.client
-
-        conn = http.client.HTTPSConnection("microsoft-translator-text.p.rapidapi.com")
-
-        payload = "[\r\n    {\r\n        \"Text\": \"%s\"\r\n    }\r\n]" % word
-
-        headers = {
-            'User-Agent': 'Mozilla/5.0',
-            'content-type': "application/json",
-            'x-rapidapi-host': "microsoft-translator-text.p.rapidapi.com",
-            'x-rapidapi-key': "fb635a8454msh796a79b3a00ad30p1dac5fjsn85374dd1956a"
-        }
-
-        conn.request("POST", "/Dictionary/Lookup?to=ar&api-version=3.0&from=en", payload.encode('utf-8'), headers)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for i in range(0, len(source_files), chapters_per_round):
+                try:
+                    self._translate_chapter_files(source_files[i:i + chapters_per_round], executor)
+                except Exception as e:
+                    self._log_exception(e, self.main_logger)
+
+    def _translate_chapter_files(self, source_files, executor):
+        contents = []
+        paragraphs = []
+        for full_source_file in source_files:
+            with open(full_source_file) as f1:
+                content = etree.HTML(f1.read())
+            contents.append((full_source_file, content))
+            for p in content.iter('p'):
+                p_text = p.text and p.text.strip()
+                if p.find('p') or not p_text: continue
+                paragraphs.append((p, p_text))
+
+        translations = self.translator.translate_texts([p_text for _, p_text in paragraphs], executor)
+        for (p, _), translation in zip(paragraphs, translations):
+            p.addnext(html_builder.P(translation or ''))
+
+        for full_source_file, content in contents:
+            with open('%s_%s' % (full_source_file[:-5], 'translation.html'), 'wb') as f3:
+                f3.write(html.tostring(content, pretty_print=True, method="html"))
+            print('translated %s' % os.path.basename(full_source_file))
+        self._log('translated %d chapters, %d paragraphs' % (len(contents), len(paragraphs)), self.main_logger)
+        if self.translator.memory:
+            self._log('translation_memory:%s' % self.translator.memory.stats(), self.main_logger)
 
+    def _microsoft_translate_word(self, word):
         try:
-            res = conn.getresponse()
-            data = res.read()
+            return self.translator.lookup_word(word)
+        except Exception as e:
+            self._log_exception(e, self.main_logger)
+            raise
 
-            # print(data.decode("utf-8"))
-            return eval(data.decode("utf-8"))
+    def _microsoft_translate_words(self, words, executor=None):
+        try:
+            return self.translator.lookup_words(words, executor)
         except Exception as e:
             self._log_exception(e, self.main_logger)
             raise
 
     def _microsoft_translate_text(self, text):
-        import http.client
-        conn = http.client.HTTPSConnection("microsoft-translator-text.p.rapidapi.com")
-        payload = """[\r
-            {\r
-                \"Text\": \"%s.\"\r
-            }\r            
-        ]""" % text
-
-        headers = {
-            'content-type': "application/json",
-            'x-rapidapi-host': "microsoft-translator-text.p.rapidapi.com",
-            'x-rapidapi-key': "fb635a8454msh796a79b3a00ad30p1dac5fjsn85374dd1956a"
-        }
-
-        conn.request("POST", "/translate?to=ar&api-version=3.0&from=en&profanityAction=NoAction&textType=plain", payload.encode('utf-8'),
-                 headers)
         try:
-            res = conn.getresponse()
-            data = res.read()
-            # print(data.decode("utf-8"))
-            return eval(data.decode("utf-8"))
+            return self.translator.translate_items([text])
         except Exception as e:
             self._log_exception(e, self.main_logger)
             raise
 
+    ##Search
+
+    def index_chapters(self, workers=1):
+        """Bring the full-text search index up to date with the clean chapters, a bucket per process with workers > 1."""
+        files = [(entry['chapter_no'], entry['clean']) for entry in self.catalog.range(kind='clean')]
+        self.catalog.save()
+        with metrics.timer('index'):
+            stats = self._get_search_index().update(files, workers)
+        msg = 'search index: %(buckets)d buckets, %(updated)d updated, %(read)d chapters read, %(dropped)d dropped' % stats
+        print(msg)
+        self._log(msg, self.main_logger)
+        return stats
+
+    def search(self, query, first_chapter=1, last_chapter=100000, limit=20, order='chapter'):
+        """The chapters with every word of the query, with a snippet each, see SearchIndex.search."""
+        return self._get_search_index().search(query, first_chapter, last_chapter, limit, order)
+
+    def _get_search_index(self):
+        if self._search_index is None:
+            self._search_index = SearchIndex(os.path.normpath(os.path.join(self.file_dest, self.novel_name,
+                                                                            'search_index')), self.CLEAN_TEXT_SPLITTER_RE)
+        return self._search_index
+
+    def dump_metrics(self, path=None, fmt='jsonl'):
+        """Write the metrics of this process, by default to metrics.jsonl (or metrics.prom) in the novel directory."""
+        path = path or os.path.join(self.file_dest, self.novel_name,
+                                    'metrics.prom' if fmt == 'prometheus' else 'metrics.jsonl')
+        metrics.dump(path, fmt)
+        return path
+
     def _log(self, msg, logger):
-        logger.log(logging.DEBUG, '*******************************************')
-        logger.log(logging.DEBUG, msg)
-        logger.log(logging.DEBUG, '*******************************************')
+        logger.debug(msg)
 
     def _log_exception(self, e, logger):
-        logger.log(logging.DEBUG, '*******************************************')
-        logger.log(logging.DEBUG, '[%s]' % (str(e)))
-        logger.log(logging.DEBUG, '*******************************************')
+        if isinstance(e, Exception):
+            metrics.error('reader', e)
+            e = '%s: %s' % (e.__class__.__name__, e)
+        logger.error('[%s]' % e)
@@ -0,0 +1,150 @@
+import os
+import time
+from subprocess import PIPE, run, TimeoutExpired, CalledProcessError
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import metrics
+
+"""
+>>> from pdf_converter import PdfConverter
+>>> converter = PdfConverter(workers=8, timeout=120)
+>>> summary = converter.convert([('Chapter_00001 x.html', 'Chapter_00001 x.pdf')])
+>>> summary['failed']
+>>> converter = BatchPdfConverter(workers=2, batch_size=50)  # wkhtmltopdf started once per 50 chapters
+"""
+
+WKHTMLTOPDF = 'wkhtmltopdf'
+
+
+class PdfConverter:
+    """Runs one wkhtmltopdf process per (source_html, dest_pdf) job, up to `workers` at a time."""
+
+    def __init__(self, workers=1, timeout=None, command=WKHTMLTOPDF, force=False):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.command = command
+        # force converts again even when the pdf is newer than its html
+        self.force = force
+
+    def convert(self, jobs):
+        """Convert the jobs and return {'converted': n, 'skipped': n, 'failed': [(source, error), ...]}"""
+        summary = {'converted': 0, 'skipped': 0, 'failed': []}
+        pending = []
+        for source, dest in jobs:
+            if not self.force and self.is_up_to_date(source, dest):
+                summary['skipped'] += 1
+            else:
+                pending.append((source, dest))
+
+        for (source, dest), error in zip(pending, self._convert_all(pending)):
+            if error:
+                summary['failed'].append((source, error))
+            else:
+                summary['converted'] += 1
+        return summary
+
+    def _convert_all(self, pending):
+        """The error (None when converted) of every job."""
+        # each job is its own wkhtmltopdf process, the threads only wait on them
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(self._convert_one, pending))
+
+    def is_up_to_date(self, source, dest):
+        return os.path.exists(dest) and os.path.getmtime(dest) >= os.path.getmtime(source)
+
+    def _convert_one(self, job):
+        source, dest = job
+        command = [self.command, source, dest]
+        try:
+            with metrics.timer('convert'):
+                completed_process = run(command, stdout=PIPE, stderr=PIPE, timeout=self.timeout)
+                completed_process.check_returncode()  # If returncode is non - zero, raise a CalledProcessError.
+            metrics.add_bytes('convert', os.path.getsize(dest))
+        except TimeoutExpired:
+            self._remove_partial(dest)
+            return 'timeout after %ss' % self.timeout
+        except CalledProcessError as e:
+            self._remove_partial(dest)
+            return 'exit code %d: %s' % (e.returncode, (e.stderr or b'').decode('utf-8', 'replace').strip()[-300:])
+        except Exception as e:
+            self._remove_partial(dest)
+            return str(e)
+        return None
+
+    def _remove_partial(self, dest):
+        # a half written pdf would be newer than its html and skipped on the next run
+        if os.path.exists(dest):
+            os.remove(dest)
+
+
+class BatchPdfConverter(PdfConverter):
+    """
+    Keeps wkhtmltopdf warm: each of `workers` processes converts a batch of up to batch_size documents,
+    one command line per document on its stdin (--read-args-from-stdin), so the engine starts once per batch
+    instead of once per chapter. A document left without its pdf by the batch is converted again on its own,
+    so the errors are still per chapter.
+    """
+
+    def __init__(self, workers=1, timeout=None, command=WKHTMLTOPDF, force=False, batch_size=50):
+        super().__init__(workers, timeout, command, force)
+        self.batch_size = max(1, batch_size)
+
+    def _convert_all(self, pending):
+        # contiguous batches, at least one per worker
+        batch_size = min(self.batch_size, -(-len(pending) // self.workers)) or 1
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return [error for errors in executor.map(self._convert_batch, batches) for error in errors]
+
+    def _convert_batch(self, batch):
+        for _, dest in batch:
+            # a pdf present after the batch is then one the batch wrote
+            self._remove_partial(dest)
+        lines = ''.join('%s %s\n' % (_stdin_arg(source), _stdin_arg(dest)) for source, dest in batch)
+        started = time.perf_counter()
+        complete = len(batch)
+        try:
+            with metrics.timer('convert_batch'):
+                run([self.command, '--read-args-from-stdin'], input=lines.encode('utf-8'), stdout=PIPE, stderr=PIPE,
+                    timeout=self.timeout and self.timeout * len(batch))
+        except TimeoutExpired:
+            # the documents are converted in order, the last one written may be cut short
+            complete = max(0, len([dest for _, dest in batch if os.path.exists(dest)]) - 1)
+        except Exception as e:
+            return [str(e)] * len(batch)
+        converted = [i < complete and os.path.exists(dest) and os.path.getsize(dest) > 0
+                     for i, (_, dest) in enumerate(batch)]
+        for _ in range(sum(converted)):
+            metrics.observe('convert', (time.perf_counter() - started) / len(batch))
+        errors = []
+        for (source, dest), ok in zip(batch, converted):
+            if ok:
+                metrics.add_bytes('convert', os.path.getsize(dest))
+                errors.append(None)
+            else:
+                errors.append(self._convert_one((source, dest)))
+        return errors
+
+
+def _stdin_arg(path):
+    """A path quoted for a --read-args-from-stdin line."""
+    return '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"')
+
+
+# the renderer option of convert_to_pdf
+RENDERERS = {'process': PdfConverter, 'batch': BatchPdfConverter}
+
+
+def make_converter(renderer='process', workers=1, timeout=None, force=False, batch_size=50):
+    if renderer not in RENDERERS:
+        raise Exception('unknown renderer %s, expected one of %s' % (renderer, ', '.join(RENDERERS)))
+    if renderer == 'batch':
+        return BatchPdfConverter(workers=workers, timeout=timeout, force=force, batch_size=batch_size)
+    return RENDERERS[renderer](workers=workers, timeout=timeout, force=force)
+
+
+def format_summary(summary):
+    lines = ['converted:%(converted)d, skipped:%(skipped)d, failed:%(failed_count)d' %
+             dict(summary, failed_count=len(summary['failed']))]
+    lines.extend('  failed %s => %s' % (source, error) for source, error in summary['failed'])
+    return '\n'.join(lines)
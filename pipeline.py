@@ -0,0 +1,157 @@
+import time
+import queue
+import logging
+import threading
+
+from instrumentation import metrics
+
+"""
+Stages that run at the same time, each on its own threads, connected by bounded queues.
+>>> from pipeline import Pipeline, Stage
+>>> pipeline = Pipeline([Stage('fetch', fetch, workers=8), Stage('clean', clean, workers=2),
+...                      Stage('write', write), Stage('convert', convert, workers=2)], queue_size=16)
+>>> results = pipeline.run(chapters)
+>>> pipeline.stats()
+"""
+
+# end of the stream, passed from stage to stage once all the workers of a stage have seen it
+_DONE = object()
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """
+    handle(item) returns the item for the next stage, or None to pass nothing on.
+    finish(), when given, runs once after the last item and returns a list of items for the next stage.
+    """
+
+    def __init__(self, name, handle, workers=1, finish=None):
+        self.name = name
+        self.handle = handle
+        self.workers = max(1, workers)
+        self.finish = finish
+
+
+class Pipeline:
+    """
+    A stage waits when the queue of the next one is full, so a slow stage holds back the ones before it
+    and at most about queue_size items wait between two stages, whatever the number of items.
+    A failed item is counted, reported to on_error(stage_name, item, exception) and dropped,
+    an exception raised by on_error itself is logged.
+    """
+
+    def __init__(self, stages, queue_size=16, on_error=None):
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        self.on_error = on_error
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def run(self, items):
+        """Feed the items through every stage, returns what the last stage passed on."""
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        results = []
+        self._stats = {stage.name: {'in': 0, 'out': 0, 'failed': 0, 'busy': 0.0, 'blocked': 0.0, 'max_queue': 0}
+                       for stage in self.stages}
+        started = time.perf_counter()
+        threads = []
+        for i, stage in enumerate(self.stages):
+            alive = [stage.workers]
+            out_queue = queues[i + 1] if i + 1 < len(queues) else None
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(stage, queues[i], out_queue, results, alive),
+                                          name='pipeline-%s' % stage.name, daemon=True)
+                thread.start()
+                threads.append(thread)
+        try:
+            for item in items:
+                self._put(queues[0], item, None)
+        finally:
+            queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+        self._stats['seconds'] = time.perf_counter() - started
+        return results
+
+    def _work(self, stage, in_queue, out_queue, results, alive):
+        stats = self._stats[stage.name]
+        try:
+            while True:
+                item = in_queue.get()
+                if item is _DONE:
+                    break
+                with self._lock:
+                    stats['in'] += 1
+                    stats['max_queue'] = max(stats['max_queue'], in_queue.qsize() + 1)
+                started = time.perf_counter()
+                try:
+                    result = stage.handle(item)
+                except Exception as e:
+                    result = None
+                    self._failed(stage, item, e)
+                with self._lock:
+                    stats['busy'] += time.perf_counter() - started
+                if result is not None:
+                    self._put(out_queue, result, results, stats)
+        finally:
+            # even a worker that died hands the end on, or run() would wait on the next stage forever
+            with self._lock:
+                alive[0] -= 1
+                last = alive[0] == 0
+            if not last:
+                # let the other workers of the stage see the end too
+                in_queue.put(_DONE)
+            else:
+                self._finish(stage, out_queue, results, stats)
+
+    def _finish(self, stage, out_queue, results, stats):
+        try:
+            if stage.finish:
+                try:
+                    for result in stage.finish() or ():
+                        self._put(out_queue, result, results, stats)
+                except Exception as e:
+                    self._failed(stage, None, e)
+        finally:
+            if out_queue is not None:
+                out_queue.put(_DONE)
+
+    def _put(self, out_queue, item, results, stats=None):
+        if out_queue is None:
+            with self._lock:
+                results.append(item)
+                stats['out'] += 1
+            return
+        started = time.perf_counter()
+        out_queue.put(item)
+        if stats is not None:
+            with self._lock:
+                stats['out'] += 1
+                stats['blocked'] += time.perf_counter() - started
+
+    def _failed(self, stage, item, e):
+        metrics.error(stage.name, e)
+        with self._lock:
+            self._stats[stage.name]['failed'] += 1
+        if self.on_error:
+            try:
+                self.on_error(stage.name, item, e)
+            except Exception:
+                # a failing callback must not kill the worker, the item is dropped all the same
+                logger.exception('on_error failed for an item of stage %s', stage.name)
+
+    def stats(self):
+        """
+        Per stage: items in/out/failed, busy seconds (summed over its workers), seconds blocked on a full queue
+        and the longest queue seen. The busiest stage (busy / workers closest to the wall time) sets the pace.
+        """
+        with self._lock:
+            stats = {name: dict(values) if isinstance(values, dict) else values for name, values in self._stats.items()}
+        for stage in self.stages:
+            values = stats[stage.name]
+            values['busy'] = round(values['busy'], 3)
+            values['blocked'] = round(values['blocked'], 3)
+            values['utilization'] = round(values['busy'] / stage.workers / stats['seconds'], 3) \
+                if stats.get('seconds') else 0.0
+        return stats
@@ -0,0 +1,145 @@
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+"""
+>>> from rate_limit import AdaptiveRateLimiter, RetryPolicy
+>>> limiter = AdaptiveRateLimiter(initial_rate=5)
+>>> limiter.acquire('novelfull.com')
+>>> limiter.on_success('novelfull.com', latency=0.3)
+>>> RetryPolicy().delay(attempt=2, retry_after=None)
+"""
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+THROTTLE_STATUSES = frozenset((429, 503))
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, given either as seconds or as an http date."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """`rate` requests per second with bursts of up to `capacity`, acquire() blocks until a token is free."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class AdaptiveRateLimiter:
+    """
+    One token bucket per host whose rate follows the server: additive increase after each success,
+    multiplicative decrease on a throttling status (429/503) or when the latency climbs well above its usual level.
+    A Retry-After from the server pauses the whole host.
+    """
+
+    def __init__(self, initial_rate=4.0, min_rate=0.2, max_rate=50.0, increase=0.2, decrease=0.5,
+                 latency_factor=3.0):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        # latency above latency_factor times the usual latency counts as a (soft) congestion signal
+        self.latency_factor = latency_factor
+        self._buckets = {}
+        self._latency = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host):
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(self.initial_rate)
+                self._stats[host] = {'requests': 0, 'throttled': 0, 'slow': 0}
+            return bucket
+
+    def acquire(self, host):
+        self._bucket(host).acquire()
+        with self._lock:
+            self._stats[host]['requests'] += 1
+
+    def _set_rate(self, bucket, rate):
+        bucket.rate = min(self.max_rate, max(self.min_rate, rate))
+        bucket.capacity = max(1.0, bucket.rate)
+
+    def on_success(self, host, latency):
+        bucket = self._bucket(host)
+        with self._lock:
+            usual = self._latency.get(host)
+            # slow moving average, so one slow response does not become the new normal
+            self._latency[host] = latency if usual is None else usual * 0.9 + latency * 0.1
+            if usual is not None and latency > usual * self.latency_factor:
+                self._stats[host]['slow'] += 1
+                self._set_rate(bucket, bucket.rate * (1 - (1 - self.decrease) / 2))
+            else:
+                self._set_rate(bucket, bucket.rate + self.increase)
+
+    def on_error(self, host, status=None, retry_after=None):
+        bucket = self._bucket(host)
+        with self._lock:
+            if status in THROTTLE_STATUSES:
+                self._stats[host]['throttled'] += 1
+                self._set_rate(bucket, bucket.rate * self.decrease)
+        if retry_after:
+            bucket.pause(retry_after)
+
+    def stats(self):
+        with self._lock:
+            return {host: dict(self._stats[host], rate=round(bucket.rate, 3),
+                               latency=round(self._latency.get(host) or 0.0, 4))
+                    for host, bucket in self._buckets.items()}
+
+
+class RetryPolicy:
+    """Up to max_retries retries with full-jitter exponential backoff, never sooner than the server's Retry-After."""
+
+    def __init__(self, max_retries=4, base_delay=1.0, max_delay=60.0, statuses=RETRY_STATUSES):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.statuses = statuses
+
+    def should_retry(self, attempt, status=None):
+        """status None means a network error (connection refused/reset, timeout)."""
+        return attempt < self.max_retries and (status is None or status in self.statuses)
+
+    def delay(self, attempt, retry_after=None):
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        return max(backoff, retry_after or 0.0)
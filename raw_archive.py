@@ -0,0 +1,171 @@
+import os
+import gzip
+import json
+import hashlib
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+The raw chapter pages, exactly as received, compressed and deduplicated in packed segment files.
+>>> from raw_archive import RawArchive
+>>> archive = RawArchive('/path/to/novel_dir/raw_archive')
+>>> archive.put('chapter:12', raw_bytes, file_name='Chapter_00012 x', url='https://novelfull.com/x/chapter-12.html')
+>>> archive.get('chapter:12')
+>>> for key, meta, location in archive.entries(): archive.read(location)
+"""
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_CODEC = 'zstd' if zstandard else 'gzip'
+
+
+def compress(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('the archive holds zstd blobs, install zstandard to read them')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def read_location(archive_dir, location):
+    """The original bytes of a blob location (segment, offset, length, codec), usable without opening the archive."""
+    segment, offset, length, codec = location
+    with open(os.path.join(archive_dir, segment), 'rb') as f1:
+        f1.seek(offset)
+        return decompress(f1.read(length), codec)
+
+
+class RawArchive:
+    """
+    Blobs are keyed by the sha1 of their original bytes, so a page stored twice takes the space once.
+    They are appended to segment_NNNNN.dat files, a new segment is started past segment_size.
+    index.jsonl holds one line per blob ({"h", "s", "o", "n", "c"}) and per entry ({"k", "h", "m"}),
+    a blob line is only written after its bytes, the last line of a key wins.
+    """
+
+    def __init__(self, path, segment_size=DEFAULT_SEGMENT_SIZE, codec=DEFAULT_CODEC):
+        self.path = path
+        self.segment_size = segment_size
+        self.codec = codec
+        self._lock = threading.Lock()
+        self._blobs = {}
+        self._entries = {}
+        self._stats = {'puts': 0, 'deduplicated': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+        os.makedirs(self.path, 0o700, exist_ok=True)
+        self._index_path = os.path.join(self.path, 'index.jsonl')
+        if os.path.exists(self._index_path):
+            self._load_index()
+        self._index_file = open(self._index_path, 'ab')
+        self._segment_file = None
+        self._segment_no = max([int(s[8:13]) for s, _, _, _ in self._blobs.values()] or [0])
+
+    def _load_index(self):
+        offset = 0
+        with open(self._index_path, 'rb+') as f1:
+            for line in f1:
+                if not line.endswith(b'\n'):
+                    # cut short by a crash, the blob it describes is not referenced and is skipped
+                    f1.truncate(offset)
+                    break
+                offset += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'k' in record:
+                    self._entries[record['k']] = (record['h'], record.get('m') or {})
+                else:
+                    self._blobs[record['h']] = (record['s'], record['o'], record['n'], record['c'])
+
+    def _segment(self, size):
+        if self._segment_file is not None and 0 < self._segment_file.tell() and \
+                self._segment_file.tell() + size > self.segment_size:
+            self._segment_file.close()
+            self._segment_file = None
+            self._segment_no += 1
+        if self._segment_file is None:
+            # a segment reopened after a restart or a crash may be full already, or past the cap
+            while 0 < self._segment_size(self._segment_no) and \
+                    self._segment_size(self._segment_no) + size > self.segment_size:
+                self._segment_no += 1
+            self._segment_file = open(os.path.join(self.path, 'segment_%05d.dat' % self._segment_no), 'ab')
+            self._segment_file.seek(0, os.SEEK_END)
+        return self._segment_file
+
+    def _segment_size(self, segment_no):
+        try:
+            return os.path.getsize(os.path.join(self.path, 'segment_%05d.dat' % segment_no))
+        except FileNotFoundError:
+            return 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, key, data, **meta):
+        """Store data under key with some metadata (file_name, url, ...), returns the content hash."""
+        digest = hashlib.sha1(data).hexdigest()
+        records = []
+        with self._lock:
+            self._stats['puts'] += 1
+            self._stats['raw_bytes'] += len(data)
+            if digest in self._blobs:
+                self._stats['deduplicated'] += 1
+            else:
+                blob = compress(data, self.codec)
+                segment_file = self._segment(len(blob))
+                offset = segment_file.tell()
+                segment_file.write(blob)
+                segment_file.flush()
+                location = (os.path.basename(segment_file.name), offset, len(blob), self.codec)
+                self._blobs[digest] = location
+                self._stats['stored_bytes'] += len(blob)
+                records.append({'h': digest, 's': location[0], 'o': offset, 'n': len(blob), 'c': self.codec})
+            self._entries[key] = (digest, meta)
+            records.append({'k': key, 'h': digest, 'm': meta})
+            self._index_file.write(b''.join(json.dumps(r).encode('utf-8') + b'\n' for r in records))
+            self._index_file.flush()
+        return digest
+
+    def location(self, key):
+        return self._blobs[self._entries[key][0]]
+
+    def get(self, key, default=None):
+        if key not in self._entries:
+            return default
+        with self._lock:
+            if self._segment_file is not None:
+                self._segment_file.flush()
+        return read_location(self.path, self.location(key))
+
+    def read(self, location):
+        return read_location(self.path, location)
+
+    def entries(self, prefix=''):
+        """(key, meta, location) of every entry, sorted by segment and offset so reading them is sequential."""
+        with self._lock:
+            entries = [(k, m, self._blobs[h]) for k, (h, m) in self._entries.items() if k.startswith(prefix)]
+        return sorted(entries, key=lambda entry: entry[2][:2])
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries), blobs=len(self._blobs))
+        stats['disk_bytes'] = sum(os.path.getsize(os.path.join(self.path, f)) for f in os.listdir(self.path))
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._index_file.close()
+            if self._segment_file is not None:
+                self._segment_file.close()
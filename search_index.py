@@ -0,0 +1,309 @@
+import os
+import re
+import json
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree
+
+from crawl_journal import atomic_write
+from vocabulary import SPLITTER_RE, file_key
+
+"""
+Full-text search over the <p> text of a novel's clean chapters.
+>>> from search_index import SearchIndex
+>>> index = SearchIndex('/path/to/novel_dir/search_index')
+>>> index.update([(12, '/path/to/novel_dir/00000/Chapter_00012 x.html'), ...], workers=4)
+>>> index.search('yang kai', limit=5)
+[{'chapter_no': 12, 'count': 9, 'paragraph': 3, 'path': '...', 'snippet': '... Yang Kai looked at ...'}, ...]
+"""
+
+BUCKET_SIZE = 100
+SNIPPET_CHARS = 80
+FORMAT_VERSION = 1
+
+
+def encode_varints(values):
+    """Unsigned LEB128, 7 bits a byte."""
+    encoded = bytearray()
+    for value in values:
+        while value > 0x7f:
+            encoded.append((value & 0x7f) | 0x80)
+            value >>= 7
+        encoded.append(value)
+    return bytes(encoded)
+
+
+def decode_varints(data):
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def encode_postings(postings):
+    """Sorted (chapter_no, count, first paragraph) as varints, the chapter numbers as deltas."""
+    values = []
+    previous = 0
+    for chapter_no, count, paragraph in postings:
+        values.extend((chapter_no - previous, count, paragraph))
+        previous = chapter_no
+    return encode_varints(values)
+
+
+def decode_postings(data):
+    values = decode_varints(data)
+    postings = []
+    chapter_no = 0
+    for i in range(0, len(values), 3):
+        chapter_no += values[i]
+        postings.append((chapter_no, values[i + 1], values[i + 2]))
+    return postings
+
+
+def tokenize(text, splitter_re=SPLITTER_RE):
+    return [token.lower() for token in splitter_re.split(text) if token]
+
+
+def chapter_paragraphs(path):
+    """The texts of the <p> elements of a chapter page that have some."""
+    with open(path, 'rb') as f1:
+        content = etree.HTML(f1.read())
+    return [p.text.strip() for p in content.iter('p') if p.text and p.text.strip()]
+
+
+def chapter_terms(path, splitter_re=SPLITTER_RE):
+    """{term: [count, first paragraph]} of a chapter page."""
+    terms = {}
+    for paragraph_no, text in enumerate(chapter_paragraphs(path)):
+        for term in tokenize(text, splitter_re):
+            entry = terms.get(term)
+            if entry is None:
+                terms[term] = [1, paragraph_no]
+            else:
+                entry[0] += 1
+    return terms
+
+
+class Segment:
+    """
+    The index of one bucket of chapters, one file: a json header line (the indexed chapters and their file keys),
+    the sorted terms joined by newlines, an array of the offsets of their postings, then the postings.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.chapters = {}
+        self.terms = []
+        self.offsets = array('I', [0])
+        self.postings = b''
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'rb') as f1:
+            header = json.loads(f1.readline())
+            if header.get('version') != FORMAT_VERSION:
+                return
+            terms = f1.read(header['terms_bytes']).decode('utf-8')
+            self.offsets = array('I')
+            self.offsets.frombytes(f1.read(4 * (header['term_count'] + 1)))
+            self.postings = f1.read()
+        self.chapters = {int(no): value for no, value in header['chapters'].items()}
+        self.terms = terms.split('\n') if terms else []
+
+    def lookup(self, term):
+        i = bisect_left(self.terms, term)
+        if i == len(self.terms) or self.terms[i] != term:
+            return []
+        return decode_postings(self.postings[self.offsets[i]:self.offsets[i + 1]])
+
+    def all_postings(self):
+        return {term: decode_postings(self.postings[self.offsets[i]:self.offsets[i + 1]])
+                for i, term in enumerate(self.terms)}
+
+    def save(self, postings):
+        """Write {term: sorted postings} with the current chapters."""
+        self.terms = sorted(postings)
+        encoded = [encode_postings(postings[term]) for term in self.terms]
+        self.offsets = array('I', [0])
+        for blob in encoded:
+            self.offsets.append(self.offsets[-1] + len(blob))
+        self.postings = b''.join(encoded)
+        terms = '\n'.join(self.terms).encode('utf-8')
+        header = {'version': FORMAT_VERSION, 'chapters': {str(no): value for no, value in sorted(self.chapters.items())},
+                  'term_count': len(self.terms), 'terms_bytes': len(terms)}
+        atomic_write(self.path, b''.join([json.dumps(header).encode('utf-8'), b'\n', terms, self.offsets.tobytes(),
+                                          self.postings]))
+
+
+def update_segment(segment_path, files, splitter_re=SPLITTER_RE):
+    """
+    Bring the segment of one bucket up to date with its chapter files [(chapter_no, path)]:
+    only new and changed chapters are read, the ones gone are dropped. Module level for the process pool.
+    Returns (chapters read, chapters dropped).
+    """
+    segment = Segment(segment_path)
+    current = {chapter_no: (path, file_key(path)) for chapter_no, path in files}
+    stale = [(chapter_no, path) for chapter_no, (path, key) in current.items()
+             if segment.chapters.get(chapter_no, [None])[0] != key]
+    dropped = set(segment.chapters) - set(current)
+    if not stale and not dropped:
+        return 0, 0
+    replaced = dropped | {chapter_no for chapter_no, _ in stale}
+    postings = {}
+    for term, term_postings in segment.all_postings().items():
+        kept = [posting for posting in term_postings if posting[0] not in replaced]
+        if kept:
+            postings[term] = kept
+    for chapter_no, path in stale:
+        for term, (count, paragraph) in chapter_terms(path, splitter_re).items():
+            postings.setdefault(term, []).append((chapter_no, count, paragraph))
+    for term_postings in postings.values():
+        term_postings.sort()
+    segment.chapters = {chapter_no: [key, path] for chapter_no, (path, key) in current.items()}
+    segment.save(postings)
+    return len(stale), len(dropped)
+
+
+def _snippet(paragraphs, terms, paragraph_no, snippet_chars=SNIPPET_CHARS):
+    """(paragraph number, text around the first term) of the first paragraph from paragraph_no with all the terms."""
+    patterns = [re.compile(r'(?<!\w)%s(?!\w)' % re.escape(term), re.I) for term in terms]
+    found = paragraph_no
+    for i in range(paragraph_no, len(paragraphs)):
+        if all(pattern.search(paragraphs[i]) for pattern in patterns):
+            found = i
+            break
+    if found >= len(paragraphs):
+        return paragraph_no, ''
+    text = paragraphs[found]
+    match = patterns[0].search(text)
+    start = max(0, (match.start() if match else 0) - snippet_chars)
+    end = min(len(text), (match.end() if match else 0) + snippet_chars)
+    return found, '%s%s%s' % ('...' if start else '', text[start:end], '...' if end < len(text) else '')
+
+
+class SearchIndex:
+    """
+    An inverted index term -> (chapter, count, first paragraph) kept as one segment per 100-chapter bucket
+    under `path`, so an update only rewrites the buckets with new, changed or removed chapters
+    and the buckets are indexed in parallel.
+    """
+
+    def __init__(self, path, splitter_re=SPLITTER_RE):
+        self.path = path
+        self.splitter_re = splitter_re
+        self._segments = {}
+        os.makedirs(self.path, 0o700, exist_ok=True)
+
+    def _segment_path(self, bucket):
+        return os.path.join(self.path, 'bucket_%05d.idx' % bucket)
+
+    def update(self, files, workers=1):
+        """
+        Index the (chapter_no, path) chapter files, with workers > 1 one bucket per process at a time.
+        The files are every chapter of the novel: a chapter indexed before and missing here is dropped,
+        the segment of a bucket with no file left is deleted.
+        Returns {'buckets', 'updated', 'read', 'dropped'}.
+        """
+        buckets = {}
+        for chapter_no, path in files:
+            buckets.setdefault(chapter_no // BUCKET_SIZE * BUCKET_SIZE, []).append((chapter_no, path))
+        jobs = sorted(buckets.items())
+        paths = [self._segment_path(bucket) for bucket, _ in jobs]
+        arguments = (paths, [bucket_files for _, bucket_files in jobs], [self.splitter_re] * len(jobs))
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(update_segment, *arguments))
+        else:
+            results = list(map(update_segment, *arguments))
+        stats = {'buckets': len(jobs), 'updated': 0, 'read': 0, 'dropped': 0}
+        for segment_path in set(self._buckets(0, 10 ** 9)) - set(paths):
+            stats['updated'] += 1
+            stats['dropped'] += len(Segment(segment_path).chapters)
+            self._segments.pop(segment_path, None)
+            os.remove(segment_path)
+        for path, (read, dropped) in zip(paths, results):
+            if read or dropped:
+                stats['updated'] += 1
+                self._segments.pop(path, None)
+            stats['read'] += read
+            stats['dropped'] += dropped
+        return stats
+
+    def _segment(self, path):
+        # kept loaded while the file is unchanged, so the next queries only cost the lookups
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._segments.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = self._segments[path] = (mtime, Segment(path))
+        return cached[1]
+
+    def _buckets(self, first_chapter, last_chapter):
+        buckets = []
+        for file_name in sorted(os.listdir(self.path)):
+            if not (file_name.startswith('bucket_') and file_name.endswith('.idx')):
+                continue
+            bucket = int(file_name[7:-4])
+            if bucket <= last_chapter and bucket + BUCKET_SIZE - 1 >= first_chapter:
+                buckets.append(os.path.join(self.path, file_name))
+        return buckets
+
+    def search(self, query, first_chapter=1, last_chapter=100000, limit=20, order='chapter', snippets=True):
+        """
+        The chapters with every word of the query, in chapter order (the first appearance first)
+        or with order='count' the most occurrences first: [{'chapter_no', 'count', 'paragraph', 'path', 'snippet'}]
+        """
+        terms = list(dict.fromkeys(tokenize(query, self.splitter_re)))
+        if not terms:
+            return []
+        results = []
+        for segment_path in self._buckets(first_chapter, last_chapter):
+            segment = self._segment(segment_path)
+            matches = None
+            for term in terms:
+                postings = {chapter_no: (count, paragraph) for chapter_no, count, paragraph in segment.lookup(term)
+                            if first_chapter <= chapter_no <= last_chapter}
+                if matches is None:
+                    matches = {chapter_no: [count, paragraph] for chapter_no, (count, paragraph) in postings.items()}
+                else:
+                    matches = {chapter_no: [match[0] + postings[chapter_no][0], max(match[1], postings[chapter_no][1])]
+                               for chapter_no, match in matches.items() if chapter_no in postings}
+                if not matches:
+                    break
+            for chapter_no, (count, paragraph) in (matches or {}).items():
+                results.append({'chapter_no': chapter_no, 'count': count, 'paragraph': paragraph,
+                                'path': segment.chapters[chapter_no][1]})
+            if order == 'chapter' and len(results) >= limit:
+                # the buckets come in chapter order, the later ones cannot come first
+                break
+        if order == 'count':
+            results.sort(key=lambda result: (-result['count'], result['chapter_no']))
+        else:
+            results.sort(key=lambda result: result['chapter_no'])
+        results = results[:limit]
+        if snippets:
+            for result in results:
+                try:
+                    result['paragraph'], result['snippet'] = _snippet(chapter_paragraphs(result['path']), terms,
+                                                                      result['paragraph'])
+                except OSError:
+                    result['snippet'] = ''
+        return results
+
+    def stats(self):
+        stats = {'segments': 0, 'chapters': 0, 'terms': 0, 'bytes': 0}
+        for segment_path in self._buckets(0, 10 ** 9):
+            segment = self._segment(segment_path)
+            stats['segments'] += 1
+            stats['chapters'] += len(segment.chapters)
+            stats['terms'] += len(segment.terms)
+            stats['bytes'] += os.path.getsize(segment_path)
+        return stats
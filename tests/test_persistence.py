@@ -0,0 +1,212 @@
+import os
+import json
+
+import pytest
+
+import transport
+from crawl_journal import CrawlJournal, atomic_write
+from http_cache import HttpCache
+from mock_servers import MockServer
+from raw_archive import RawArchive
+from search_index import SearchIndex, decode_postings, encode_postings
+from translation_memory import TranslationMemory
+from translation_store import TranslationStore, iter_json_items
+
+
+class ListingStub(MockServer):
+    """One listing page, changed by setting `body`."""
+
+    body = b'<html><body>page 1</body></html>'
+
+    def handle(self, method, path, query, headers, body):
+        return 200, {'Content-Type': 'text/html'}, self.body
+
+
+def test_http_cache_revalidates_after_reopening(tmp_path):
+    stub = ListingStub()
+    url = '%s/martial-peak.html?page=1' % stub.start()
+    path = str(tmp_path / 'http_cache.sqlite')
+    try:
+        cache = HttpCache(path)
+        assert transport.HttpPool().request('GET', url, cache=cache).data == stub.body
+        assert cache.stats()['misses'] == 1
+        cache.close()
+
+        reopened = HttpCache(path)
+        res = transport.HttpPool().request('GET', url, cache=reopened)
+        assert res.status == 200 and res.data == stub.body
+        assert stub.not_modified == 1
+        assert reopened.stats()['revalidated'] == 1
+
+        stub.body = b'<html><body>page 1, one more chapter</body></html>'
+        assert transport.HttpPool().request('GET', url, cache=reopened).data == stub.body
+        assert reopened.get(url)['data'] == stub.body
+        reopened.close()
+    finally:
+        stub.stop()
+
+
+def test_http_cache_skips_what_it_cannot_reuse(tmp_path):
+    cache = HttpCache(str(tmp_path / 'http_cache.sqlite'))
+    listing = 'https://novelfull.com/martial-peak.html?page=3'
+    assert not cache.put('https://novelfull.com/martial-peak/chapter-1.html', 200, 'OK', {'ETag': '"a"'}, b'x')
+    assert not cache.put(listing, 200, 'OK', {}, b'no validators')
+    assert not cache.put(listing, 404, 'Not Found', {'ETag': '"a"'}, b'')
+    assert cache.put(listing, 200, 'OK', {'ETag': '"a"'}, b'listing')
+    assert cache.stats()['entries'] == 1
+    cache.close()
+
+
+def test_translation_memory_reopen(tmp_path):
+    path = str(tmp_path / 'memory.sqlite')
+    memory = TranslationMemory(path)
+    memory.put('translate', 'en-ar', 'Hello there.', {'translations': [{'text': 'hi'}]})
+    memory.close()
+    reopened = TranslationMemory(path)
+    assert reopened.get('translate', 'en-ar', '  Hello   there. ') == {'translations': [{'text': 'hi'}]}
+    assert reopened.get('translate', 'en-fr', 'Hello there.') is None
+    assert reopened.stats()['disk_hits'] == 1
+    reopened.close()
+
+
+def test_translation_store_reopen_and_truncated_tail(tmp_path):
+    path = str(tmp_path / 'store.jsonl')
+    store = TranslationStore(path)
+    store.put('sword', ['saif'])
+    store.put('shield', ['turs'])
+    store.put('sword', ['saif', 'husam'])
+    store.close()
+    with open(path, 'ab') as f1:
+        # a put cut short by a crash
+        f1.write(b'{"k": "spear", "v": ["ru')
+
+    reopened = TranslationStore(path)
+    assert reopened.get('sword') == ['saif', 'husam']
+    assert reopened.get('shield') == ['turs']
+    assert 'spear' not in reopened
+    reopened.put('spear', ['rumh'])
+    reopened.close()
+
+    again = TranslationStore(path)
+    assert again.keys() == ['sword', 'shield', 'spear']
+    assert again.get('spear') == ['rumh']
+    again.compact()
+    assert again.stale_ratio() == 0.0
+    assert dict(again.items()) == {'sword': ['saif', 'husam'], 'shield': ['turs'], 'spear': ['rumh']}
+    again.close()
+
+
+def test_iter_json_items_across_chunk_boundaries(tmp_path):
+    path = str(tmp_path / 'translations.json')
+    translations = {'sword': [{'translations': ['saif']}], 'a "quoted"\\ w\u00e9rd': None, 'one': 7.25, 'two': -12,
+                    'empty': [], 'nested': {'x': [True, False, 'y']}}
+    for indent in (None, 2):
+        with open(path, 'wt', encoding='utf-8') as f1:
+            f1.write(json.dumps(translations, indent=indent, ensure_ascii=False))
+        for chunk_size in (1, 2, 3, 7, 1024):
+            assert list(iter_json_items(path, chunk_size)) == list(translations.items())
+
+    with open(path, 'wt') as f1:
+        f1.write('{"sword": ["saif"], "shield": ["tu')
+    with pytest.raises(ValueError):
+        list(iter_json_items(path, 4))
+
+    store = TranslationStore(str(tmp_path / 'store.jsonl'))
+    store.put('sword', [])
+    with open(path, 'wt') as f1:
+        f1.write(json.dumps({'sword': ['saif'], 'shield': ['turs']}))
+    assert store.import_json(path) == 2
+    assert dict(store.items()) == {'sword': ['saif'], 'shield': ['turs']}
+    store.close()
+
+
+def test_crawl_journal_reopen_and_truncated_tail(tmp_path):
+    path = str(tmp_path / 'crawl_journal.jsonl')
+    journal = CrawlJournal(path)
+    journal.plan_many([('chapter:1', ['/c-1.html', 1]), ('chapter:2', ['/c-2.html', 2]), ('chapter:3', ['/c-3.html', 3])])
+    journal.done('chapter:1')
+    journal.failed('chapter:3', 'HTTP 503')
+    journal.close()
+    with open(path, 'at') as f1:
+        # the record of a killed process
+        f1.write('{"job": "chapter:2", "sta')
+
+    reopened = CrawlJournal(path)
+    assert sorted(reopened.pending()) == [('chapter:2', ['/c-2.html', 2]), ('chapter:3', ['/c-3.html', 3])]
+    reopened.done('chapter:2')
+    reopened.close()
+    # the done jobs are compacted away on the next open
+    compacted = CrawlJournal(path)
+    assert compacted.pending() == [('chapter:3', ['/c-3.html', 3])]
+    compacted.close()
+
+
+def test_atomic_write_replaces_the_whole_file(tmp_path):
+    path = str(tmp_path / 'file.json')
+    atomic_write(path, b'first version, a bit longer')
+    atomic_write(path, b'second')
+    with open(path, 'rb') as f1:
+        assert f1.read() == b'second'
+    assert os.listdir(str(tmp_path)) == ['file.json']
+
+
+def test_postings_round_trip():
+    postings = [(3, 1, 0), (4, 12, 7), (250, 1, 40), (100000, 300, 2)]
+    assert decode_postings(encode_postings(postings)) == postings
+
+
+def _chapter(tmp_path, chapter_no, *paragraphs):
+    path = tmp_path / ('Chapter_%05d.html' % chapter_no)
+    path.write_text('<html><body>%s</body></html>' % ''.join('<p>%s</p>' % p for p in paragraphs))
+    return chapter_no, str(path)
+
+
+def test_search_index_reopen_and_update(tmp_path):
+    files = [_chapter(tmp_path, 5, 'Yang Kai looked at the sword.'),
+             _chapter(tmp_path, 150, 'The sword fell.', 'Yang Kai smiled at the sword.')]
+    index = SearchIndex(str(tmp_path / 'search_index'))
+    assert index.update(files)['read'] == 2
+
+    reopened = SearchIndex(str(tmp_path / 'search_index'))
+    results = reopened.search('yang kai sword')
+    assert [(r['chapter_no'], r['count'], r['paragraph']) for r in results] == [(5, 3, 0), (150, 4, 1)]
+    assert 'Yang Kai smiled' in results[1]['snippet']
+    assert reopened.update(files) == {'buckets': 2, 'updated': 0, 'read': 0, 'dropped': 0}
+
+    os.remove(files[1][1])
+    assert reopened.update(files[:1])['dropped'] == 1
+    assert [r['chapter_no'] for r in SearchIndex(str(tmp_path / 'search_index')).search('sword')] == [5]
+
+
+def test_crawl_journal_closes_and_reopens_on_append(tmp_path):
+    path = str(tmp_path / 'crawl_journal.jsonl')
+    with CrawlJournal(path) as journal:
+        journal.plan('chapter:1', ['/c-1.html', 1])
+    assert journal._file is None
+    # a reader keeps its journal between crawls, the next append opens the file again
+    journal.plan('chapter:2', ['/c-2.html', 2])
+    journal.close()
+    reopened = CrawlJournal(path)
+    assert sorted(job for job, _ in reopened.pending()) == ['chapter:1', 'chapter:2']
+    reopened.close()
+
+
+def test_raw_archive_rolls_over_a_full_segment_after_reopening(tmp_path):
+    path = str(tmp_path / 'raw_archive')
+    pages = [os.urandom(3000) for _ in range(6)]
+    archive = RawArchive(path, segment_size=5000, codec='gzip')
+    for i, page in enumerate(pages[:3]):
+        archive.put('chapter:%d' % i, page, chapter_no=i)
+    archive.close()
+
+    for _ in range(2):
+        reopened = RawArchive(path, segment_size=5000, codec='gzip')
+        for i in range(3):
+            reopened.put('chapter:%d' % (i + 3), pages[i + 3], chapter_no=i + 3)
+        reopened.close()
+    reopened = RawArchive(path, segment_size=5000, codec='gzip')
+    assert [reopened.get('chapter:%d' % i) for i in range(6)] == pages
+    segments = [f for f in os.listdir(path) if f.startswith('segment_')]
+    # one incompressible page per segment, no segment grows past the cap across the restarts
+    assert all(os.path.getsize(os.path.join(path, f)) < 5000 for f in segments)
+    reopened.close()
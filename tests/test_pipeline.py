@@ -0,0 +1,52 @@
+import threading
+
+from pipeline import Pipeline, Stage
+
+
+def _run(pipeline, items, timeout=10):
+    """run() in a thread, a worker that never hands the end on would otherwise hang the test run."""
+    results = []
+    thread = threading.Thread(target=lambda: results.append(pipeline.run(items)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'the pipeline did not finish'
+    return results[0]
+
+
+def _parse(item):
+    if item % 3 == 0:
+        raise ValueError('bad item %d' % item)
+    return item * 10
+
+
+def test_items_flow_through_every_stage():
+    pipeline = Pipeline([Stage('double', lambda item: item * 2, workers=3), Stage('add', lambda item: item + 1),
+                         Stage('tail', lambda item: item, finish=lambda: [-1])], queue_size=2)
+    results = _run(pipeline, range(50))
+    assert sorted(results) == [-1] + [i * 2 + 1 for i in range(50)]
+    stats = pipeline.stats()
+    assert stats['double']['in'] == 50 and stats['tail']['out'] == 51
+
+
+def test_run_returns_when_on_error_raises():
+    errors = []
+
+    def on_error(stage_name, item, e):
+        errors.append((stage_name, item))
+        raise RuntimeError('the error report failed too')
+
+    pipeline = Pipeline([Stage('parse', _parse, workers=2), Stage('collect', lambda item: item)],
+                        queue_size=1, on_error=on_error)
+    results = _run(pipeline, range(1, 31))
+    assert sorted(results) == [i * 10 for i in range(1, 31) if i % 3]
+    assert sorted(errors) == [('parse', i) for i in range(3, 31, 3)]
+    assert pipeline.stats()['parse']['failed'] == 10
+
+
+def test_a_failing_finish_still_ends_the_stream():
+    def finish():
+        raise RuntimeError('finish failed')
+
+    pipeline = Pipeline([Stage('first', lambda item: item, finish=finish), Stage('second', lambda item: item)])
+    assert sorted(_run(pipeline, range(5))) == list(range(5))
+    assert pipeline.stats()['first']['failed'] == 1
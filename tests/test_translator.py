@@ -0,0 +1,85 @@
+import pytest
+
+import transport
+from mock_servers import TranslatorStub
+from translation_memory import TranslationMemory
+from translator import MicrosoftTranslator
+
+
+@pytest.fixture
+def stub():
+    stub = TranslatorStub()
+    stub.start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def translator(stub):
+    return MicrosoftTranslator(url=stub.url, http_pool=transport.HttpPool())
+
+
+def test_batches_fit_the_api_limits(translator):
+    texts = ['paragraph %03d %s' % (i, 'x' * (i % 7 * 40)) for i in range(250)]
+    batches = list(translator.batches(texts))
+    assert [text for batch in batches for text in batch] == texts
+    for batch in batches:
+        assert len(batch) <= translator.MAX_ELEMENTS
+        assert sum(len(text) for text in batch) <= translator.MAX_CHARS
+
+
+def test_translate_texts_keeps_the_order(translator, stub):
+    texts = ['Sentence %d.' % i for i in range(230)]
+    assert translator.translate_texts(texts) == ['[ar] %s' % text for text in texts]
+    # 100 elements per request at most
+    assert stub.requests == 3
+
+
+def test_split_text_cuts_at_sentence_ends(translator):
+    text = ' '.join('Sentence number %d is here.' % i for i in range(800))
+    pieces = translator.split_text(text)
+    assert len(pieces) > 1
+    assert all(len(piece) <= translator.MAX_CHARS for piece in pieces)
+    assert all(piece.endswith('.') for piece in pieces)
+    assert ' '.join(pieces) == text
+
+
+def test_split_text_cuts_a_sentence_too_long(translator):
+    text = 'x' * 25000
+    pieces = translator.split_text(text)
+    assert [len(piece) for piece in pieces] == [10000, 10000, 5000]
+
+
+def test_oversized_text_is_sent_in_pieces_and_joined_in_order(translator, stub):
+    big = ' '.join('Sentence number %d is here.' % i for i in range(800))
+    translated = translator.translate_texts(['Before.', big, 'After.'])
+    pieces = translator.split_text(big)
+    assert translated[0] == '[ar] Before.'
+    assert translated[1] == ' '.join('[ar] %s' % piece for piece in pieces)
+    assert translated[2] == '[ar] After.'
+    # the stub answers a request over the limits with a 400, every request went through
+    assert stub.texts == len(pieces) + 2
+
+
+def test_memory_hits_and_misses(stub, tmp_path):
+    memory = TranslationMemory(str(tmp_path / 'memory.sqlite'))
+    translator = MicrosoftTranslator(url=stub.url, http_pool=transport.HttpPool(), memory=memory)
+    texts = ['One.', 'Two.', 'One.', 'Three.']
+    assert translator.translate_texts(texts) == ['[ar] One.', '[ar] Two.', '[ar] One.', '[ar] Three.']
+    assert stub.texts == 3
+    assert memory.stats()['misses'] == 4
+
+    assert translator.translate_texts(texts + ['Four.']) == ['[ar] One.', '[ar] Two.', '[ar] One.', '[ar] Three.',
+                                                           '[ar] Four.']
+    assert stub.texts == 4
+    stats = memory.stats()
+    assert stats['lru_hits'] == 4
+    assert stats['misses'] == 5
+    memory.close()
+
+    reopened = TranslationMemory(str(tmp_path / 'memory.sqlite'))
+    translator = MicrosoftTranslator(url=stub.url, http_pool=transport.HttpPool(), memory=reopened)
+    assert translator.translate_texts([' One. ', 'Four.']) == ['[ar] One.', '[ar] Four.']
+    assert stub.texts == 4
+    assert reopened.stats()['disk_hits'] == 2
+    reopened.close()
@@ -0,0 +1,85 @@
+import os
+import json
+import threading
+from bisect import bisect_left, bisect_right
+
+from crawl_journal import atomic_write
+
+"""
+A novel's table of contents: chapter number -> a few fields, kept sorted for range lookups.
+>>> from toc import TableOfContents
+>>> toc = TableOfContents('/path/to/novel_dir/toc.json', ('serialNumber', 'chapterId', 'chapterName'))
+>>> toc.update([{'serialNumber': 12, 'chapterId': 389358, 'chapterName': 'Chapter 12 x'}])
+>>> toc.range(10, 20)
+>>> toc.save()
+"""
+
+
+class TableOfContents:
+    """
+    The first field is the chapter number. Stored compactly as {"fields": [...], "rows": [[...], ...]},
+    the sorted numbers are kept next to the rows so a range is two bisections.
+    """
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = tuple(fields)
+        self._lock = threading.Lock()
+        self._numbers = []
+        self._rows = []
+        self._dirty = False
+        if os.path.exists(self.path):
+            with open(self.path, 'rt') as f1:
+                content = json.loads(f1.read() or '{}')
+            if tuple(content.get('fields', ())) == self.fields:
+                self._rows = [list(row) for row in content['rows']]
+                self._numbers = [row[0] for row in self._rows]
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _row(self, entry):
+        return [entry.get(field) for field in self.fields] if isinstance(entry, dict) else list(entry)
+
+    def update(self, entries):
+        """Add or replace entries (dicts with the fields, or rows in the fields order)."""
+        with self._lock:
+            for entry in entries:
+                row = self._row(entry)
+                i = bisect_left(self._numbers, row[0])
+                if i < len(self._numbers) and self._numbers[i] == row[0]:
+                    if self._rows[i] == row:
+                        continue
+                    self._rows[i] = row
+                else:
+                    self._numbers.insert(i, row[0])
+                    self._rows.insert(i, row)
+                self._dirty = True
+
+    def clear(self):
+        with self._lock:
+            self._numbers, self._rows = [], []
+            self._dirty = True
+
+    def get(self, chapter_no):
+        i = bisect_left(self._numbers, chapter_no)
+        if i < len(self._numbers) and self._numbers[i] == chapter_no:
+            return dict(zip(self.fields, self._rows[i]))
+        return None
+
+    def range(self, first_chapter, last_chapter):
+        """The entries first_chapter <= chapter number <= last_chapter, as dicts, in order."""
+        start = bisect_left(self._numbers, first_chapter)
+        end = bisect_right(self._numbers, last_chapter)
+        return [dict(zip(self.fields, row)) for row in self._rows[start:end]]
+
+    def last_chapter_no(self):
+        return self._numbers[-1] if self._numbers else 0
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            content = json.dumps({'fields': self.fields, 'rows': self._rows}, separators=(',', ':'))
+            atomic_write(self.path, content.encode('utf-8'))
+            self._dirty = False
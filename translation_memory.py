@@ -0,0 +1,128 @@
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+"""
+>>> from translation_memory import TranslationMemory
+>>> memory = TranslationMemory('translation/translation_memory.sqlite')
+>>> memory.put('translate', 'en-ar', 'Hello there.', {'translations': [{'text': '...'}]})
+>>> memory.get('translate', 'en-ar', 'Hello  there. ')
+>>> memory.stats()
+"""
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_LRU_SIZE = 20000
+
+
+def normalize(text):
+    """The cache key of a source text: surrounding and repeated whitespace does not matter."""
+    return ' '.join(text.split())
+
+
+class TranslationMemory:
+    """
+    Translation results keyed by (kind, language pair, normalized source text).
+    An in-process LRU in front of an indexed SQLite table, the least recently used rows are evicted
+    once the stored results exceed max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, lru_size=DEFAULT_LRU_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lru_size = lru_size
+        self._lru = OrderedDict()
+        self._lock = threading.RLock()
+        self._conn = None
+        self._total_bytes = 0
+        self._stats = {'lru_hits': 0, 'disk_hits': 0, 'misses': 0, 'puts': 0, 'evicted': 0}
+
+    def _connection(self):
+        # opened on first use, so a memory can be created before forking workers
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS memory (kind TEXT NOT NULL, pair TEXT NOT NULL, '
+                               'source TEXT NOT NULL, value TEXT NOT NULL, size INTEGER NOT NULL, '
+                               'last_used REAL NOT NULL, PRIMARY KEY (kind, pair, source))')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS memory_last_used ON memory (last_used)')
+            self._total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM memory').fetchone()[0]
+        return self._conn
+
+    def get(self, kind, pair, text):
+        key = (kind, pair, normalize(text))
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self._stats['lru_hits'] += 1
+                return self._lru[key]
+            conn = self._connection()
+            row = conn.execute('SELECT value FROM memory WHERE kind=? AND pair=? AND source=?', key).fetchone()
+            if row is None:
+                self._stats['misses'] += 1
+                return None
+            conn.execute('UPDATE memory SET last_used=? WHERE kind=? AND pair=? AND source=?', (time.time(),) + key)
+            conn.commit()
+            self._stats['disk_hits'] += 1
+            value = json.loads(row[0])
+            self._remember(key, value)
+            return value
+
+    def put(self, kind, pair, text, value):
+        self.put_many(kind, pair, [(text, value)])
+
+    def put_many(self, kind, pair, items):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            for text, value in items:
+                key = (kind, pair, normalize(text))
+                encoded = json.dumps(value)
+                old = conn.execute('SELECT size FROM memory WHERE kind=? AND pair=? AND source=?', key).fetchone()
+                conn.execute('INSERT OR REPLACE INTO memory VALUES (?, ?, ?, ?, ?, ?)',
+                             key + (encoded, len(encoded), now))
+                self._total_bytes += len(encoded) - (old[0] if old else 0)
+                self._remember(key, value)
+                self._stats['puts'] += 1
+            conn.commit()
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _remember(self, key, value):
+        self._lru[key] = value
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def _evict(self):
+        # drop the least recently used rows down to 90% of max_bytes, so eviction does not run on every put
+        conn = self._connection()
+        target = self.max_bytes * 0.9
+        rows = conn.execute('SELECT kind, pair, source, size FROM memory ORDER BY last_used')
+        evicted = []
+        for kind, pair, source, size in rows:
+            if self._total_bytes <= target:
+                break
+            evicted.append((kind, pair, source))
+            self._total_bytes -= size
+        conn.executemany('DELETE FROM memory WHERE kind=? AND pair=? AND source=?', evicted)
+        conn.commit()
+        for key in evicted:
+            self._lru.pop(key, None)
+        self._stats['evicted'] += len(evicted)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats['lru_hits'] + stats['disk_hits'] + stats['misses']
+            stats['hit_rate'] = round((stats['lru_hits'] + stats['disk_hits']) / lookups, 4) if lookups else 0.0
+            stats['bytes'] = self._total_bytes
+            stats['entries'] = self._connection().execute('SELECT COUNT(*) FROM memory').fetchone()[0]
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
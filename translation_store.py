@@ -0,0 +1,217 @@
+import os
+import json
+import threading
+
+"""
+The word translations as an append-only log of json lines with an in-memory offset index.
+>>> from translation_store import TranslationStore
+>>> store = TranslationStore('translation/translations_store.jsonl')
+>>> store.put('sword', [{'translations': [...]}])
+>>> store.get('sword')
+>>> store.export_json('translation/translations_mini.json')
+"""
+
+
+READ_CHUNK = 1024 * 1024
+VALUE_ENDS = ' \t\r\n,:}'
+
+
+def iter_json_items(path, chunk_size=READ_CHUNK):
+    """
+    The (key, value) pairs of a file holding one json object, read chunk_size characters at a time:
+    only the chunk and the entry being parsed are in memory, whatever the size of the file.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'rt', encoding='utf-8') as f1:
+        buffer, position, eof = '', 0, False
+
+        def more():
+            nonlocal buffer, position, eof
+            chunk = f1.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            return not eof
+
+        def skip(chars):
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position] in chars:
+                    position += 1
+                if position < len(buffer) or not more():
+                    return
+
+        def decode():
+            nonlocal position
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                    # a number cut by the chunk end decodes as its prefix ('7.' -> 7), wait for what follows it
+                    if eof or (end < len(buffer) and buffer[end] in VALUE_ENDS):
+                        position = end
+                        return value
+                except ValueError:
+                    if eof:
+                        raise
+                more()
+
+        skip(' \t\r\n')
+        if not buffer:
+            return
+        if buffer[position] != '{':
+            raise ValueError('%s does not hold a json object' % path)
+        position += 1
+        while True:
+            skip(' \t\r\n,')
+            if position >= len(buffer):
+                raise ValueError('%s: unexpected end of file' % path)
+            if buffer[position] == '}':
+                return
+            key = decode()
+            skip(' \t\r\n')
+            if position >= len(buffer) or buffer[position] != ':':
+                raise ValueError('%s: expected ":" after %r' % (path, key))
+            position += 1
+            skip(' \t\r\n')
+            yield key, decode()
+
+
+class TranslationStore:
+    """
+    Every put appends one {"k": key, "v": value} line, the last line of a key wins.
+    Only the key -> (offset, length) index is kept in memory, values are read back from the log on demand.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index = {}
+        self._stale_records = 0
+        if not os.path.exists(self.path):
+            open(self.path, 'ab').close()
+        self._build_index()
+        self._append_file = open(self.path, 'ab')
+        self._read_file = open(self.path, 'rb')
+
+    def _build_index(self):
+        offset = 0
+        with open(self.path, 'rb+') as f1:
+            for line in f1:
+                if not line.endswith(b'\n'):
+                    # the last put was cut short by a crash, drop it so the next put starts on a new line
+                    f1.truncate(offset)
+                    break
+                try:
+                    key = json.loads(line)['k']
+                except ValueError:
+                    offset += len(line)
+                    continue
+                if key in self._index:
+                    self._stale_records += 1
+                self._index[key] = (offset, len(line))
+                offset += len(line)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return list(self._index)
+
+    def get(self, key, default=None):
+        with self._lock:
+            position = self._index.get(key)
+            if position is None:
+                return default
+            return self._read(position)
+
+    def _read(self, position):
+        offset, length = position
+        self._append_file.flush()
+        self._read_file.seek(offset)
+        return json.loads(self._read_file.read(length))['v']
+
+    def put(self, key, value):
+        line = (json.dumps({'k': key, 'v': value}) + '\n').encode('utf-8')
+        with self._lock:
+            self._append_file.seek(0, os.SEEK_END)
+            offset = self._append_file.tell()
+            self._append_file.write(line)
+            if key in self._index:
+                self._stale_records += 1
+            self._index[key] = (offset, len(line))
+
+    def merge(self, key, value):
+        """put only when the key is missing or its translation is empty, the merge_translations rule."""
+        if not self.get(key) and (value or key not in self):
+            self.put(key, value)
+            return True
+        return False
+
+    def items(self):
+        """(key, value) pairs in insertion order, read one at a time."""
+        for key in self.keys():
+            yield key, self.get(key)
+
+    def flush(self):
+        with self._lock:
+            self._append_file.flush()
+
+    def import_json(self, path):
+        """
+        Merge a whole {word: translation} json file, e.g. an old *_translation.json dump, one entry in memory
+        at a time. Returns the merged count.
+        """
+        merged = 0
+        for k, v in iter_json_items(path):
+            merged += self.merge(k, v)
+        self.flush()
+        return merged
+
+    def export_json(self, path, indent=None, ensure_ascii=True):
+        """Stream the store into the json.dumps(translations, indent=indent) format, one entry in memory at a time."""
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wt', encoding='utf-8') as f1:
+            f1.write('{')
+            for i, (k, v) in enumerate(self.items()):
+                if indent is None:
+                    f1.write('%s%s: %s' % (', ' if i else '', json.dumps(k, ensure_ascii=ensure_ascii),
+                                           json.dumps(v, ensure_ascii=ensure_ascii)))
+                else:
+                    pad = ' ' * indent
+                    value = json.dumps(v, indent=indent, ensure_ascii=ensure_ascii).replace('\n', '\n' + pad)
+                    f1.write('%s\n%s%s: %s' % (',' if i else '', pad, json.dumps(k, ensure_ascii=ensure_ascii), value))
+            f1.write('\n}' if indent is not None and self._index else '}')
+        os.replace(tmp_path, path)
+        return len(self._index)
+
+    def compact(self):
+        """Rewrite the log with only the last record of each key."""
+        with self._lock:
+            self._append_file.flush()
+            tmp_path = '%s.tmp' % self.path
+            index = {}
+            with open(tmp_path, 'wb') as f1:
+                for key, position in self._index.items():
+                    self._read_file.seek(position[0])
+                    line = self._read_file.read(position[1])
+                    index[key] = (f1.tell(), len(line))
+                    f1.write(line)
+            self._append_file.close()
+            self._read_file.close()
+            os.replace(tmp_path, self.path)
+            self._index = index
+            self._stale_records = 0
+            self._append_file = open(self.path, 'ab')
+            self._read_file = open(self.path, 'rb')
+
+    def stale_ratio(self):
+        total = len(self._index) + self._stale_records
+        return self._stale_records / total if total else 0.0
+
+    def close(self):
+        with self._lock:
+            self._append_file.close()
+            self._read_file.close()
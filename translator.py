@@ -0,0 +1,148 @@
+import re
+import json
+
+import transport
+from instrumentation import metrics
+
+"""
+>>> from translator import MicrosoftTranslator
+>>> t = MicrosoftTranslator()
+>>> t.translate_texts(['Hello there.', 'Goodbye.'])
+>>> t.lookup_word('sword')
+"""
+
+DEFAULT_URL = 'https://microsoft-translator-text.p.rapidapi.com'
+DEFAULT_KEY = 'fb635a8454msh796a79b3a00ad30p1dac5fjsn85374dd1956a'
+SENTENCE_END_RE = re.compile(r'(?<=[.!?;])\s+')
+
+
+class MicrosoftTranslator:
+    """The Microsoft translator (through rapidapi), sending many texts per request."""
+
+    # per request limits of the translator v3 api
+    MAX_ELEMENTS = 100
+    MAX_CHARS = 10000
+    LOOKUP_MAX_ELEMENTS = 10
+
+    def __init__(self, url=DEFAULT_URL, key=DEFAULT_KEY, from_lang='en', to_lang='ar', http_pool=None, memory=None):
+        self.url = url
+        self.key = key
+        self.from_lang = from_lang
+        self.to_lang = to_lang
+        self.http_pool = http_pool or transport.default_pool
+        # an optional TranslationMemory, only its misses are sent to the api
+        self.memory = memory
+
+    @property
+    def pair(self):
+        return '%s-%s' % (self.from_lang, self.to_lang)
+
+    def _post(self, path, texts):
+        headers = {
+            'content-type': "application/json",
+            'x-rapidapi-host': "microsoft-translator-text.p.rapidapi.com",
+            'x-rapidapi-key': self.key,
+        }
+        payload = json.dumps([{'Text': text} for text in texts])
+        with metrics.timer('translate'):
+            res = self.http_pool.request('POST', '%s%s' % (self.url, path), payload, headers)
+            result = json.loads(res.text())
+        metrics.count('translated_texts', len(texts))
+        return result
+
+    def translate_raw(self, texts):
+        """One /translate request, returns the api result items in the order of texts."""
+        return self._post('/translate?to=%s&api-version=3.0&from=%s&profanityAction=NoAction&textType=plain' %
+                          (self.to_lang, self.from_lang), texts)
+
+    def lookup_raw(self, words):
+        """One /Dictionary/Lookup request, returns the api result items in the order of words."""
+        return self._post('/Dictionary/Lookup?to=%s&api-version=3.0&from=%s' % (self.to_lang, self.from_lang), words)
+
+    def split_text(self, text):
+        """A text longer than MAX_CHARS in pieces that fit, cut at sentence ends (a sentence too long is cut anywhere)."""
+        pieces, piece = [], ''
+        for sentence in SENTENCE_END_RE.split(text):
+            while len(sentence) > self.MAX_CHARS:
+                if piece:
+                    pieces.append(piece)
+                    piece = ''
+                pieces.append(sentence[:self.MAX_CHARS])
+                sentence = sentence[self.MAX_CHARS:]
+            if piece and len(piece) + 1 + len(sentence) > self.MAX_CHARS:
+                pieces.append(piece)
+                piece = ''
+            piece = '%s %s' % (piece, sentence) if piece else sentence
+        if piece:
+            pieces.append(piece)
+        return pieces
+
+    def _joined_item(self, items):
+        """One api result item for a text sent in pieces, None when a piece was not translated."""
+        texts = [item and item.get('translations') and item['translations'][0].get('text') for item in items]
+        if not all(texts):
+            return None
+        return {'translations': [{'text': ' '.join(texts), 'to': self.to_lang}]}
+
+    def batches(self, texts):
+        """Split texts into consecutive lists that fit MAX_ELEMENTS and MAX_CHARS, a text too long is sent alone."""
+        batch, batch_chars = [], 0
+        for text in texts:
+            if batch and (len(batch) >= self.MAX_ELEMENTS or batch_chars + len(text) > self.MAX_CHARS):
+                yield batch
+                batch, batch_chars = [], 0
+            batch.append(text)
+            batch_chars += len(text)
+        if batch:
+            yield batch
+
+    def translate_items(self, texts, executor=None):
+        """
+        The api result item per text, with as few requests as the limits allow.
+        Texts found in the memory and repeated texts are not sent, with an executor the batches are sent concurrently.
+        A text longer than MAX_CHARS is sent in pieces (split_text) and its item holds the joined translation.
+        """
+        items = [self.memory.get('translate', self.pair, text) if self.memory else None for text in texts]
+        missing = list(dict.fromkeys(text for text, item in zip(texts, items) if item is None))
+        pieces = {text: self.split_text(text) for text in missing if len(text) > self.MAX_CHARS}
+        batches = list(self.batches(list(dict.fromkeys(piece for text in missing for piece in pieces.get(text, [text])))))
+        results = executor.map(self.translate_raw, batches) if executor else map(self.translate_raw, batches)
+        translated = {}
+        for batch, batch_result in zip(batches, results):
+            translated.update(zip(batch, batch_result))
+            if self.memory:
+                self.memory.put_many('translate', self.pair, zip(batch, batch_result))
+        for text, text_pieces in pieces.items():
+            translated[text] = self._joined_item([translated.get(piece) for piece in text_pieces])
+            if self.memory and translated[text]:
+                self.memory.put('translate', self.pair, text, translated[text])
+        return [item if item is not None else translated.get(text) for text, item in zip(texts, items)]
+
+    def translate_texts(self, texts, executor=None):
+        """Translated text per input text (None when the api returned nothing for it)."""
+        return [item and item.get('translations') and item['translations'][0].get('text')
+                for item in self.translate_items(texts, executor)]
+
+    def lookup_words(self, words, executor=None):
+        """
+        lookup_word for many words: [item] per word, LOOKUP_MAX_ELEMENTS words per request.
+        The words in the memory are not sent, with an executor the requests are sent concurrently.
+        """
+        items = [self.memory.get('lookup', self.pair, word) if self.memory else None for word in words]
+        missing = list(dict.fromkeys(word for word, item in zip(words, items) if item is None))
+        batches = [missing[i:i + self.LOOKUP_MAX_ELEMENTS] for i in range(0, len(missing), self.LOOKUP_MAX_ELEMENTS)]
+        results = executor.map(self.lookup_raw, batches) if executor else map(self.lookup_raw, batches)
+        looked_up = {}
+        for batch, batch_result in zip(batches, results):
+            looked_up.update(zip(batch, batch_result))
+            if self.memory:
+                self.memory.put_many('lookup', self.pair, zip(batch, batch_result))
+        return [[item if item is not None else looked_up.get(word)] for word, item in zip(words, items)]
+
+    def lookup_word(self, word):
+        item = self.memory.get('lookup', self.pair, word) if self.memory else None
+        if item is None:
+            item = self.lookup_raw([word])[0]
+            if self.memory:
+                self.memory.put('lookup', self.pair, word, item)
+        return [item]
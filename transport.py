@@ -0,0 +1,249 @@
+import gzip
+import zlib
+import time
+import threading
+import http.client
+from contextlib import nullcontext
+from urllib import parse
+from urllib.error import HTTPError
+
+from rate_limit import AdaptiveRateLimiter, RetryPolicy, parse_retry_after
+from instrumentation import metrics
+
+"""
+>>> import transport
+>>> res = transport.default_pool.request('GET', 'https://novelfull.com/martial-peak.html?page=1')
+>>> res.status, len(res.data)
+>>> transport.default_pool.stats()
+>>> transport.default_pool.request('GET', url, cache=cache)  # cache: an http_cache.HttpCache
+"""
+
+DEFAULT_TIMEOUT = 30  ## seconds
+DEFAULT_HEADERS = {'User-Agent': 'Mozilla/5.0', 'Accept-Encoding': 'gzip, deflate'}
+# errors raised when a kept-alive connection has been closed by the server in the meantime
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                           http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)
+# network errors worth sending a request again for, a bad body (gzip, deflate) or a local OSError is not one
+RETRY_ERRORS = (ConnectionError, TimeoutError, http.client.IncompleteRead, http.client.BadStatusLine)
+# sent again after a failure unless the caller says otherwise, a POST may have been acted on already
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+
+
+class Response:
+
+    def __init__(self, url, status, reason, headers, data):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+
+    def text(self, encoding='utf-8'):
+        return self.data.decode(encoding)
+
+
+class HttpPool:
+    """
+    Keep-alive connections per (scheme, host, port), shared by the readers and the translators.
+    With a rate_limiter every request waits for its host's token, with a retry policy failed GET requests
+    (connection errors and timeouts, 429/5xx) are sent again after a backoff.
+    With max_connections at most that many requests are in flight at once, whatever the host and the caller.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_idle_per_host=8, rate_limiter=None, retry=None,
+                 max_connections=None):
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self.rate_limiter = rate_limiter
+        self.retry = retry
+        self._connections = threading.BoundedSemaphore(max_connections) if max_connections else None
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'hits': 0, 'misses': 0, 'stale': 0, 'retries': 0}
+
+    def request(self, method, url, body=None, headers=None, timeout=None, cache=None, retry=None):
+        """
+        With a cache (an http_cache.HttpCache) a GET whose url has a ttl there is answered or revalidated by it.
+        retry=True lets a request other than GET/HEAD/OPTIONS be retried too, retry=False never retries.
+        """
+        if retry is None:
+            retry = method in IDEMPOTENT_METHODS
+        if cache is not None and method == 'GET' and 'Authorization' not in (headers or {}):
+            ttl = cache.ttl(url)
+            if ttl is not None:
+                return self._cached_request(url, headers, timeout, cache, ttl, retry)
+        return self._request(method, url, body, headers, timeout, retry)
+
+    def _cached_request(self, url, headers, timeout, cache, ttl, retry=True):
+        entry = cache.get(url)
+        if entry is not None and entry['age'] < ttl:
+            cache.touch(url)
+            metrics.count('http_cache_fresh')
+            return self._cached_response(url, entry)
+        all_headers = dict(headers or {})
+        if entry is not None:
+            all_headers.update(cache.validators(entry))
+        res = self._request('GET', url, None, all_headers, timeout, retry)
+        if res.status == 304 and entry is not None:
+            cache.touch(url, revalidated=True)
+            metrics.count('http_cache_revalidated')
+            return self._cached_response(url, entry)
+        # a response the cache cannot use again (an error, no validators) is neither stored nor counted
+        if cache.put(url, res.status, res.reason, res.headers, res.data):
+            cache.miss()
+            metrics.count('http_cache_misses')
+        return res
+
+    def _cached_response(self, url, entry):
+        headers = http.client.HTTPMessage()
+        for name, value in entry['headers']:
+            headers[name] = value
+        return Response(url, entry['status'], entry['reason'], headers, entry['data'])
+
+    def _request(self, method, url, body=None, headers=None, timeout=None, retry=True):
+        host = parse.urlsplit(url).netloc
+        policy = self.retry if retry else None
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire(host)
+            started = time.monotonic()
+            try:
+                # the slot is held for the exchange only, not for the rate limiter wait or the retry backoff
+                with self._connections or nullcontext(), metrics.timer('http'):
+                    res = self._request_once(method, url, body, headers, timeout)
+            except RETRY_ERRORS:
+                if self.rate_limiter:
+                    self.rate_limiter.on_error(host)
+                if not (policy and policy.should_retry(attempt)):
+                    raise
+                self._count('retries')
+                metrics.count('http_retries')
+                time.sleep(policy.delay(attempt))
+                attempt += 1
+                continue
+
+            if res.status >= 400:
+                metrics.error('http', 'HTTP %d' % res.status)
+                retry_after = parse_retry_after(res.headers.get('Retry-After'))
+                if self.rate_limiter:
+                    self.rate_limiter.on_error(host, res.status, retry_after)
+                if policy and policy.should_retry(attempt, res.status):
+                    self._count('retries')
+                    metrics.count('http_retries')
+                    time.sleep(policy.delay(attempt, retry_after))
+                    attempt += 1
+                    continue
+                raise HTTPError(url, res.status, res.reason, res.headers, None)
+            if self.rate_limiter:
+                self.rate_limiter.on_success(host, time.monotonic() - started)
+            metrics.add_bytes('http', len(res.data))
+            return res
+
+    def _request_once(self, method, url, body=None, headers=None, timeout=None):
+        split_url = parse.urlsplit(url)
+        key = (split_url.scheme, split_url.hostname, split_url.port)
+        path = split_url.path or '/'
+        if split_url.query:
+            path = '%s?%s' % (path, split_url.query)
+        all_headers = dict(DEFAULT_HEADERS)
+        all_headers.update(headers or {})
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        self._count('requests')
+        conn, reused = self._acquire(key, timeout)
+        try:
+            res = self._send(conn, method, path, body, all_headers)
+        except STALE_CONNECTION_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+            # the server dropped the idle connection, retry once on a fresh one
+            self._count('stale')
+            conn, reused = self._acquire(key, timeout, fresh=True)
+            try:
+                res = self._send(conn, method, path, body, all_headers)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        try:
+            data = res.read()
+        except BaseException:
+            # cut short in the middle of the body, the connection is in no state to be reused
+            conn.close()
+            raise
+        if res.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+
+        data = self._decode(data, res.getheader('Content-Encoding', ''))
+        return Response(url, res.status, res.reason, res.headers, data)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = sum(len(conns) for conns in self._idle.values())
+        if self.rate_limiter:
+            stats['hosts'] = self.rate_limiter.stats()
+        return stats
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body=body, headers=headers)
+        return conn.getresponse()
+
+    def _acquire(self, key, timeout, fresh=False):
+        if not fresh:
+            with self._lock:
+                conns = self._idle.get(key)
+                if conns:
+                    self._stats['hits'] += 1
+                    conn = conns.pop()
+                    conn.timeout = timeout or self.timeout
+                    if conn.sock:
+                        conn.sock.settimeout(conn.timeout)
+                    return conn, True
+        self._count('misses')
+        scheme, host, port = key
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return connection_class(host, port, timeout=timeout or self.timeout), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.max_idle_per_host:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _decode(self, data, content_encoding):
+        content_encoding = content_encoding.lower()
+        if content_encoding == 'gzip':
+            return gzip.decompress(data)
+        if content_encoding == 'deflate':
+            try:
+                return zlib.decompress(data)
+            except zlib.error:
+                # some servers send a raw deflate stream without the zlib header
+                return zlib.decompress(data, -zlib.MAX_WBITS)
+        return data
+
+
+# the readers and translators share this one, so they are throttled together per host
+default_pool = HttpPool(rate_limiter=AdaptiveRateLimiter(), retry=RetryPolicy())
@@ -0,0 +1,130 @@
+import os
+import re
+import json
+import base64
+import threading
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from lxml import etree
+
+from crawl_journal import atomic_write
+
+"""
+Word frequencies of a novel's clean chapters, kept per chapter so a range is summed without reading a chapter again.
+>>> from vocabulary import VocabularyIndex
+>>> vocabulary = VocabularyIndex('/path/to/novel_dir/vocabulary.json')
+>>> vocabulary.update([(12, '/path/to/novel_dir/00000/Chapter_00012 x.html')], workers=4)
+>>> vocabulary.frequencies(1, 100).most_common(20)
+>>> vocabulary.save()
+"""
+
+SPLITTER_RE = re.compile(r'[^\w]', re.I)
+
+
+def chapter_words(path, splitter_re=SPLITTER_RE):
+    """Counter of the lowercased words (longer than 2 letters, not numbers) in the <p> texts of a chapter page."""
+    words = Counter()
+    with open(path, 'rb') as f1:
+        content = etree.HTML(f1.read())
+    for p in content.iter('p'):
+        p_text = p.text and p.text.strip()
+        if not p_text: continue
+        words.update(text.lower() for text in splitter_re.split(p_text) if len(text) > 2 and not text.isdigit())
+    return words
+
+
+def file_key(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def scan_chapters(files):
+    """Worker of VocabularyIndex.update (module level for the process pool): [(chapter_no, file key, {word: n})]."""
+    return [(chapter_no, file_key(path), dict(chapter_words(path))) for chapter_no, path in files]
+
+
+def _pack(values):
+    return base64.b64encode(array('I', values).tobytes()).decode('ascii')
+
+
+def _unpack(text):
+    values = array('I')
+    values.frombytes(base64.b64decode(text))
+    return values
+
+
+class VocabularyIndex:
+    """
+    A word table (word -> id) and per chapter two parallel arrays of word ids and counts, plus the mtime and size
+    of the file they were read from, so only new or changed chapters are scanned again.
+    Stored as json, the arrays base64 packed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.words = []
+        self._ids = {}
+        self.chapters = {}
+        self._dirty = False
+        if os.path.exists(self.path):
+            with open(self.path, 'rt') as f1:
+                content = json.loads(f1.read() or '{}')
+            self.words = content.get('words', [])
+            self._ids = {word: i for i, word in enumerate(self.words)}
+            self.chapters = {int(no): (entry['key'], _unpack(entry['ids']), _unpack(entry['counts']))
+                             for no, entry in content.get('chapters', {}).items()}
+
+    def _word_id(self, word):
+        word_id = self._ids.get(word)
+        if word_id is None:
+            word_id = self._ids[word] = len(self.words)
+            self.words.append(word)
+        return word_id
+
+    def stale(self, files):
+        """The (chapter_no, path) of files that are not indexed or changed since."""
+        stale = []
+        for chapter_no, path in files:
+            entry = self.chapters.get(chapter_no)
+            if entry is None or entry[0] != file_key(path):
+                stale.append((chapter_no, path))
+        return stale
+
+    def update(self, files, workers=1):
+        """Scan the stale files among (chapter_no, path), with workers > 1 on a process pool. Returns their count."""
+        stale = self.stale(files)
+        if workers > 1 and len(stale) > 1:
+            shard_count = min(len(stale), workers * 4)
+            shards = [stale[i::shard_count] for i in range(shard_count)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = [entry for shard in executor.map(scan_chapters, shards) for entry in shard]
+        else:
+            results = scan_chapters(stale)
+        with self._lock:
+            for chapter_no, key, words in results:
+                ids = array('I', (self._word_id(word) for word in words))
+                self.chapters[chapter_no] = (key, ids, array('I', words.values()))
+            self._dirty = self._dirty or bool(results)
+        return len(results)
+
+    def frequencies(self, first_chapter=1, last_chapter=100000):
+        """Counter word -> occurrences over the indexed chapters of the range."""
+        totals = array('Q', bytes(8 * len(self.words)))
+        for chapter_no, (_, ids, counts) in self.chapters.items():
+            if first_chapter <= chapter_no <= last_chapter:
+                for word_id, n in zip(ids, counts):
+                    totals[word_id] += n
+        return Counter({self.words[word_id]: n for word_id, n in enumerate(totals) if n})
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            content = {'words': self.words,
+                       'chapters': {str(no): {'key': key, 'ids': _pack(ids), 'counts': _pack(counts)}
+                                    for no, (key, ids, counts) in sorted(self.chapters.items())}}
+            atomic_write(self.path, json.dumps(content, ensure_ascii=False).encode('utf-8'))
+            self._dirty = False